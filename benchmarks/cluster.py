@@ -0,0 +1,258 @@
+""" Multi-node cluster benchmark on a single host
+
+Starts N headless nodes as subprocesses on loopback, each on its own port and driven through its control
+socket, joins them into one ledger over a chosen topology, injects blocks from one or more writers and measures
+time to convergence, bandwidth and CPU per node.
+
+    $ python benchmarks/cluster.py [--nodes 10] [--topology star|chain|random] [--writers 1] [--blocks 50]
+                                   [--base-port 30000] [--hb-freq 1] [--report cluster.json]
+
+Exits non-zero if the cluster does not converge within --timeout seconds.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class Node:
+    """A headless privledge process and a connection to its control socket"""
+
+    def __init__(self, index, port, workdir, hb_freq):
+        self.index = index
+        self.port = port
+        self.path = os.path.join(workdir, 'node-{}.sock'.format(index))
+        self._log = open(os.path.join(workdir, 'node-{}.log'.format(index)), 'w')
+        self._socket = None
+        self._file = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        self.process = subprocess.Popen([sys.executable, '-m', 'privledge.main', '--port', str(port),
+                                         '--hb-freq', str(hb_freq), 'headless', self.path],
+                                        env=env, cwd=ROOT, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def connect(self, timeout=30):
+        deadline = time.time() + timeout
+        while not os.path.exists(self.path):
+            if time.time() > deadline or self.process.poll() is not None:
+                raise RuntimeError('Node {} did not start, see {}'.format(self.index, self._log.name))
+            time.sleep(0.05)
+
+        # The socket file appears when it is bound, a moment before the node listens on it
+        while True:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self._socket.connect(self.path)
+                break
+            except ConnectionRefusedError:
+                self._socket.close()
+                if time.time() > deadline or self.process.poll() is not None:
+                    raise RuntimeError('Node {} did not start, see {}'.format(self.index, self._log.name))
+                time.sleep(0.05)
+        self._file = self._socket.makefile('rw')
+
+    def request(self, cmd, **args):
+        with self._lock:
+            self._file.write(json.dumps({'id': self._next_id, 'cmd': cmd, 'args': args}) + '\n')
+            self._file.flush()
+            self._next_id += 1
+            response = json.loads(self._file.readline())
+
+        if not response['ok']:
+            raise RuntimeError('Node {} {}: {}'.format(self.index, cmd, response['error']))
+        return response['result']
+
+    def pipeline(self, requests):
+        """Send (cmd, args) requests in one write and return their results in order"""
+        with self._lock:
+            for cmd, args in requests:
+                self._file.write(json.dumps({'id': self._next_id, 'cmd': cmd, 'args': args}) + '\n')
+                self._next_id += 1
+            self._file.flush()
+            responses = [json.loads(self._file.readline()) for _ in requests]
+
+        failed = [r['error'] for r in responses if not r['ok']]
+        if len(failed) > 0:
+            raise RuntimeError('Node {}: {} request(s) failed: {}'.format(self.index, len(failed), failed[0]))
+        return [r['result'] for r in responses]
+
+    def cpu_seconds(self):
+        """User plus system CPU time of the process, from /proc"""
+        with open('/proc/{}/stat'.format(self.process.pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def bytes_sent(self):
+        values = self.request('metrics')
+        return {protocol: values.get('message_bytes_sum{{direction="out",protocol="{}"}}'.format(protocol), 0)
+                for protocol in ('tcp', 'udp')}
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._log.close()
+
+
+def member_for(index, topology):
+    """The index of the node that node index joins through"""
+    if topology == 'star':
+        return 0
+    elif topology == 'chain':
+        return index - 1
+    return random.randrange(index)
+
+
+def wait_converged(nodes, ledger_id, height, timeout):
+    """Poll every node until all report the same tail at the expected height; returns {node index: seconds}"""
+    start = time.perf_counter()
+    converged = dict()
+
+    while time.perf_counter() - start < timeout:
+        tails = dict()
+        for node in nodes:
+            status = node.request('status')
+            ledger = next(l for l in status['ledgers'] if l['ledger'] == ledger_id)
+            tails[node.index] = (ledger['height'], ledger['tail'])
+
+        if len(set(tails.values())) == 1 and next(iter(tails.values()))[0] >= height:
+            for index in tails:
+                converged.setdefault(index, time.perf_counter() - start)
+            return converged
+
+        # Record when each node first reached the final height; the tail may still change through forks
+        for index, (node_height, tail) in tails.items():
+            if node_height >= height:
+                converged.setdefault(index, time.perf_counter() - start)
+        time.sleep(0.05)
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--topology', choices=('star', 'chain', 'random'), default='star')
+    parser.add_argument('--writers', type=int, default=1, help='nodes that add blocks concurrently')
+    parser.add_argument('--blocks', type=int, default=50, help='blocks added by each writer')
+    parser.add_argument('--base-port', type=int, default=30000)
+    parser.add_argument('--hb-freq', type=float, default=1, help='seconds between heartbeats')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for convergence')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', default=None, help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='privledge-cluster-')
+    nodes = []
+    converged = None
+
+    try:
+        print('Starting {} nodes (logs in {})'.format(args.nodes, workdir))
+        nodes = [Node(i, args.base_port + i, workdir, args.hb_freq) for i in range(args.nodes)]
+        for node in nodes:
+            node.connect()
+
+        # Node 0 creates the ledger and authorizes the other writers' keys
+        ledger_id = nodes[0].request('init')['ledger']
+        writers = nodes[:args.writers]
+        for node in writers[1:]:
+            public = node.request('key')['key']
+            nodes[0].request('block', type='key', message=public)
+
+        start = time.perf_counter()
+        for node in nodes[1:]:
+            member = nodes[member_for(node.index, args.topology)]
+            node.request('join', ledger=ledger_id, member=['127.0.0.1', member.port])
+        joined = time.perf_counter() - start
+        print('Joined {} nodes over a {} topology in {:.2f}s'.format(args.nodes - 1, args.topology, joined))
+
+        # Let the joined nodes meet through heartbeats before measuring
+        height = 1 + len(writers) - 1
+        if wait_converged(nodes, ledger_id, height, args.timeout) is None:
+            raise RuntimeError('Cluster did not converge after joining')
+
+        cpu_before = [node.cpu_seconds() for node in nodes]
+        bytes_before = [node.bytes_sent() for node in nodes]
+
+        # Inject blocks from every writer at once
+        start = time.perf_counter()
+        threads = [threading.Thread(target=node.pipeline,
+                                    args=([('block', {'message': 'w{} b{}'.format(node.index, i)})
+                                           for i in range(args.blocks)],))
+                   for node in writers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        committed = time.perf_counter() - start
+
+        height += len(writers) * args.blocks
+        converged = wait_converged(nodes, ledger_id, height, args.timeout)
+        total = time.perf_counter() - start
+
+        cpu = [node.cpu_seconds() - before for node, before in zip(nodes, cpu_before)]
+        sent = [{protocol: node.bytes_sent()[protocol] - before[protocol] for protocol in before}
+                for node, before in zip(nodes, bytes_before)]
+
+        report = {
+            'nodes': args.nodes,
+            'topology': args.topology,
+            'writers': len(writers),
+            'blocks': len(writers) * args.blocks,
+            'hb_freq': args.hb_freq,
+            'seed': args.seed,
+            'join_seconds': joined,
+            'commit_seconds': committed,
+            'converged': converged is not None,
+            'convergence_seconds': total if converged is not None else None,
+            'node_convergence_seconds': converged,
+            'cpu_seconds': cpu,
+            'bytes_sent': sent,
+        }
+
+        print('Committed {} blocks in {:.2f}s ({:.0f} blocks/s)'.format(
+            report['blocks'], committed, report['blocks'] / committed))
+        if converged is None:
+            print('FAIL: did not converge within {:.0f}s'.format(args.timeout))
+        else:
+            times = sorted(converged.values())
+            print('Converged in {:.2f}s (per node: median {:.2f}s, max {:.2f}s)'.format(
+                total, statistics.median(times), times[-1]))
+        print('CPU per node: median {:.2f}s, max {:.2f}s, total {:.2f}s'.format(
+            statistics.median(cpu), max(cpu), sum(cpu)))
+        out = [s['tcp'] + s['udp'] for s in sent]
+        print('Sent per node: median {:.0f}KB, max {:.0f}KB, total {:.0f}KB'.format(
+            statistics.median(out) / 1024, max(out) / 1024, sum(out) / 1024))
+
+        if args.report is not None:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+            print('Wrote {}'.format(args.report))
+
+    finally:
+        for node in nodes:
+            node.close()
+
+    sys.exit(0 if converged is not None else 1)
+
+
+if __name__ == '__main__':
+    main()
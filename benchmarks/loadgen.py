@@ -0,0 +1,219 @@
+""" Load generator for sizing a deployment
+
+Runs a privledge node in this process, submits text blocks at a fixed rate through the node's write path
+(daemon.submit_block) and measures, for every block:
+
+    commit latency       from its scheduled send time to being appended to the local ledger
+    propagation latency  from its scheduled send time to every peer announcing a tail at or past it
+
+Latencies are measured from the schedule rather than the actual submission, so a node that falls behind shows
+up in the numbers. Propagation is read from the tails peers send in their heartbeats, so its resolution is the
+peers' heartbeat interval.
+
+By default the load generator creates a ledger and starts --peers headless nodes (see cluster.py) that join it:
+
+    $ python benchmarks/loadgen.py [--rate 20] [--duration 30] [--peers 4] [--hb-freq 0.5] [--report load.json]
+
+or joins an existing ledger through a member, signing with a key authorized on it:
+
+    $ python benchmarks/loadgen.py --join <ledger id> --member 10.0.0.5:2525 --key id_rsa --port 2600
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from privledge import daemon
+from privledge import settings
+from privledge import utils
+
+
+def percentiles(values):
+    """Nearest-rank p50/p95/p99 and max of a list of seconds, in milliseconds"""
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    result = {'p{}'.format(p): values[min(len(values) - 1, int(len(values) * p / 100))] * 1000
+              for p in (50, 95, 99)}
+    result['max'] = values[-1] * 1000
+    return result
+
+
+class Load:
+    """The schedule, submissions and observed latencies of one run"""
+
+    def __init__(self, node, rate, count, seed):
+        self.node = node
+        self.rate = rate
+        self.count = count
+        self.random = random.Random(seed)
+        self.scheduled = []     # Block i: scheduled send time
+        self.committed = dict() # Block i: commit time
+        self.hashes = dict()    # Block hash -> i
+        self.errors = 0
+        self.propagated = dict()    # Block i: time the last peer announced it
+        self._lock = threading.Lock()
+
+    def message(self, i):
+        # Deterministic for a seed, so runs can be repeated block for block
+        return 'load {} {:016x}'.format(i, self.random.getrandbits(64))
+
+    def run(self):
+        start = time.perf_counter()
+        for i in range(self.count):
+            at = start + i / self.rate
+            delay = at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.scheduled.append(at)
+            future = daemon.submit_block(self.node, 'text', self.message(i))
+            future.add_done_callback(lambda f, i=i: self._done(i, f))
+
+    def _done(self, i, future):
+        now = time.perf_counter()
+        with self._lock:
+            if future.exception() is not None:
+                self.errors += 1
+                return
+            self.committed[i] = now
+            self.hashes[future.result()] = i
+
+    def observe(self, peers):
+        """Record blocks every peer has announced; peers is the set of peer addresses expected to have them"""
+        ledger = self.node.ledger.snapshot()
+        heights = []
+        for peer in peers:
+            pos = ledger.position(self.node.peer_tails.get(peer, ''))
+            heights.append(-1 if pos is None else pos)
+        if len(heights) == 0:
+            return
+
+        now = time.perf_counter()
+        lowest = min(heights)
+        with self._lock:
+            for block_hash, i in self.hashes.items():
+                if i not in self.propagated and ledger.position(block_hash) is not None \
+                        and ledger.position(block_hash) <= lowest:
+                    self.propagated[i] = now
+
+    def done(self):
+        return len(self.committed) + self.errors >= self.count and len(self.propagated) >= len(self.committed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=20, help='blocks per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--peers', type=int, default=4, help='headless peers to start (when creating a ledger)')
+    parser.add_argument('--port', type=int, default=32000, help='port this node listens on')
+    parser.add_argument('--hb-freq', type=float, default=0.5, help='seconds between heartbeats')
+    parser.add_argument('--join', default=None, metavar='LEDGER', help='join this ledger instead of creating one')
+    parser.add_argument('--member', default=None, metavar='IP:PORT', help='member to join the ledger through')
+    parser.add_argument('--key', default=None, help='key file to sign with (default: generate one)')
+    parser.add_argument('--drain', type=float, default=60, help='seconds to wait for the last blocks to spread')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', default=None, help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    settings.init()
+    settings.BIND_PORT = args.port
+    settings.MSG_HB_FREQ = args.hb_freq
+
+    if args.key is not None:
+        with open(args.key) as f:
+            key = utils.get_key(f.read())
+    else:
+        key = utils.gen_privkey()
+    daemon.set_key(key)
+
+    peers = []
+    try:
+        if args.join is not None:
+            ip, port = args.member.rsplit(':', 1)
+            node = daemon.join_ledger(args.join, (ip, int(port)))
+            if node is None:
+                sys.exit('Could not join ledger {} through {}'.format(args.join, args.member))
+        else:
+            from cluster import Node
+            import tempfile
+
+            node = daemon.create_ledger(key)
+            workdir = tempfile.mkdtemp(prefix='privledge-load-')
+            peers = [Node(i, args.port + 1 + i, workdir, args.hb_freq) for i in range(args.peers)]
+            for peer in peers:
+                peer.connect()
+                peer.request('join', ledger=node.id, member=['127.0.0.1', args.port])
+
+        # Wait for the peers to announce themselves
+        expected = args.peers if args.join is None else 1
+        deadline = time.time() + 30
+        while len(node.peer_tails) < expected and time.time() < deadline:
+            time.sleep(0.1)
+        targets = set(node.peer_tails.keys())
+        print('Loading ledger {} with {} peer(s) at {:.0f} blocks/s for {:.0f}s'.format(
+            node.id, len(targets), args.rate, args.duration))
+
+        load = Load(node, args.rate, int(args.rate * args.duration), args.seed)
+        start = time.perf_counter()
+        submitter = threading.Thread(target=load.run)
+        submitter.start()
+
+        while submitter.is_alive() or not load.done():
+            load.observe(targets)
+            if not submitter.is_alive() and time.perf_counter() - start > args.duration + args.drain:
+                break
+            time.sleep(0.01)
+        elapsed = max(load.committed.values(), default=start) - start
+
+        commit = [load.committed[i] - load.scheduled[i] for i in load.committed]
+        propagation = [load.propagated[i] - load.scheduled[i] for i in load.propagated]
+
+        report = {
+            'config': {k: v for k, v in vars(args).items() if k not in ('report', 'key')},
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'cpus': os.cpu_count(), 'key_length': key.size_in_bits()},
+            'peers': len(targets),
+            'submitted': load.count,
+            'committed': len(load.committed),
+            'errors': load.errors,
+            'propagated': len(load.propagated),
+            'throughput': len(load.committed) / elapsed if elapsed > 0 else None,
+            'commit_latency_ms': percentiles(commit),
+            'propagation_latency_ms': percentiles(propagation),
+        }
+
+        print('Committed {}/{} blocks ({} errors), {:.1f} blocks/s'.format(
+            report['committed'], report['submitted'], report['errors'], report['throughput'] or 0))
+        for name in ('commit_latency_ms', 'propagation_latency_ms'):
+            if report[name] is not None:
+                print('{:<24} p50 {p50:8.1f}ms  p95 {p95:8.1f}ms  p99 {p99:8.1f}ms  max {max:8.1f}ms'.format(
+                    name.replace('_ms', ''), **report[name]))
+        if report['propagated'] < report['committed']:
+            print('{} block(s) did not reach every peer within {:.0f}s'.format(
+                report['committed'] - report['propagated'], args.drain))
+
+        if args.report is not None:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+            print('Wrote {}'.format(args.report))
+
+    finally:
+        for peer in peers:
+            peer.close()
+        for ledger_id in list(daemon.nodes.keys()):
+            daemon.leave_ledger(ledger_id)
+
+
+if __name__ == '__main__':
+    main()
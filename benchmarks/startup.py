@@ -0,0 +1,89 @@
+""" Startup time benchmark for the privledge shell
+
+Measures interpreter-to-prompt time for the interactive shell and for one-shot commands, and checks
+`python -X importtime` for modules that should only be loaded on first use.
+
+    $ python benchmarks/startup.py [--runs 20] [--max-ms 60]
+
+Exits non-zero if the median prompt time exceeds --max-ms or a lazily loaded module is imported at startup.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported before they are needed
+LAZY_MODULES = ('Crypto', 'xtermcolor', 'base58', 'http.server', 'cProfile', 'pstats', 'tracemalloc')
+
+
+def run(args, stdin=None):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, input=stdin, env=env, cwd=ROOT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def measure(label, args, runs, stdin=None):
+    # One warm up run so bytecode caches exist
+    run(args, stdin)
+    times = [run(args, stdin) for _ in range(runs)]
+    print('{:<28} min {:7.1f}ms  median {:7.1f}ms  max {:7.1f}ms'.format(
+        label, min(times), statistics.median(times), max(times)))
+    return statistics.median(times)
+
+
+def import_times():
+    """Return {module: cumulative microseconds} from python -X importtime"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import privledge.main, privledge.shell'],
+                            env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+
+    modules = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        modules[fields[2].strip()] = int(fields[1])
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if the median time to prompt exceeds this many milliseconds')
+    args = parser.parse_args()
+
+    failed = False
+
+    baseline = measure('python -c pass', ['-c', 'pass'], args.runs)
+    prompt = measure('shell to prompt', ['-m', 'privledge.main'], args.runs, stdin=b'quit\n')
+    measure('one-shot `help`', ['-m', 'privledge.main', 'help'], args.runs)
+    print('{:<28} {:7.1f}ms over the bare interpreter'.format('startup overhead', prompt - baseline))
+
+    modules = import_times()
+    print('\n{:<28} {:7.1f}ms'.format('import privledge.shell', modules.get('privledge.shell', 0) / 1000))
+    for name in sorted(modules, key=modules.get, reverse=True)[:10]:
+        print('    {:<24} {:7.1f}ms'.format(name, modules[name] / 1000))
+
+    eager = [name for name in modules if name.split('.')[0] in LAZY_MODULES or name in LAZY_MODULES]
+    if len(eager) > 0:
+        print('\nFAIL: imported at startup but should be lazy: {}'.format(', '.join(sorted(eager))))
+        failed = True
+
+    if args.max_ms is not None and prompt > args.max_ms:
+        print('\nFAIL: median time to prompt {:.1f}ms exceeds {:.1f}ms'.format(prompt, args.max_ms))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
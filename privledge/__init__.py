@@ -1 +1,7 @@
-from .shell import PrivledgeShell
+# The shell (and everything it pulls in) is only imported when PrivledgeShell is first accessed,
+# so importing a single privledge module stays cheap
+def __getattr__(name):
+    if name == 'PrivledgeShell':
+        from .shell import PrivledgeShell
+        return PrivledgeShell
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
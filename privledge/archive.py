@@ -0,0 +1,98 @@
+""" Ledger archives for offline bootstrap
+
+An archive is a gzip compressed file of lines, written and read a block at a time so a ledger of any length
+streams through it:
+
+    {"archive": "privledge", "version": 1, "ledger": <id>}     header
+    <block>                                                    one per line, in its wire encoding
+    {"blocks": <n>, "tail": <hash>, "sha256": <digest>}        trailer
+
+The digest covers every line before the trailer, so a truncated or damaged file is caught before the ledger
+read from it is used. It says nothing about who wrote the file: imported blocks are checked against their keys
+like synced ones.
+"""
+
+from privledge import utils
+from privledge.block import LazyBlock
+
+import gzip
+import hashlib
+import json
+
+FORMAT = 'privledge'
+VERSION = 1
+
+
+def export(ledger, path):
+    """Write a ledger snapshot to an archive at path; returns the number of blocks written"""
+    digest = hashlib.sha256()
+
+    with gzip.open(path, 'wb') as f:
+        def write(line):
+            data = (line + '\n').encode()
+            digest.update(data)
+            f.write(data)
+
+        write(json.dumps({'archive': FORMAT, 'version': VERSION, 'ledger': ledger.id}))
+        for block in ledger:
+            write(block.wire)
+
+        trailer = {'blocks': len(ledger), 'tail': ledger.tail.hash, 'sha256': digest.hexdigest()}
+        f.write((json.dumps(trailer) + '\n').encode())
+
+    return len(ledger)
+
+
+class Archive:
+    """An archive being read. Iterating yields its blocks as LazyBlocks and checks the trailer once they have
+    all been read; ValueError is raised for a file that is not an archive, or is truncated or damaged."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tail = None
+        self._file = gzip.open(path, 'rb')
+        self._digest = hashlib.sha256()
+
+        try:
+            data = self._file.readline()
+            header = json.loads(data.decode())
+        except (OSError, EOFError, ValueError) as e:
+            self._file.close()
+            raise ValueError('Not a ledger archive', path, e)
+
+        if not isinstance(header, dict) or header.get('archive') != FORMAT or header.get('version') != VERSION:
+            self._file.close()
+            raise ValueError('Not a ledger archive', path)
+
+        self._digest.update(data)
+        self.ledger = header.get('ledger')
+
+    def __iter__(self):
+        count = 0
+        try:
+            for data in self._file:
+                try:
+                    record = json.loads(data.decode(), object_hook=utils.message_decoder)
+                except ValueError:
+                    raise ValueError('Archive is damaged after {} block(s)'.format(count), self.path)
+
+                if isinstance(record, dict):
+                    # Trailer: everything before it must match what it recorded
+                    if record.get('sha256') != self._digest.hexdigest() or record.get('blocks') != count:
+                        raise ValueError('Archive checksum does not match, the file is damaged', self.path)
+                    self.tail = record.get('tail')
+                    return
+                if not isinstance(record, LazyBlock):
+                    raise ValueError('Archive record is not a block', self.path, count)
+
+                self._digest.update(data)
+                count += 1
+                yield record
+
+        except (OSError, EOFError) as e:
+            raise ValueError('Could not read archive', self.path, e)
+
+        raise ValueError('Archive ends before its trailer, the file is truncated', self.path)
+
+    def close(self):
+        self._file.close()
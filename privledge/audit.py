@@ -0,0 +1,164 @@
+""" Full-chain ledger audit
+
+verify() re-checks a ledger end to end instead of trusting the checks made when its blocks were appended:
+
+    every block's hash matches its contents
+    every block's predecessor is the block before it, and the first block is a self-signed root key
+    every block is signed by a key that is active at its height, and the signature verifies
+
+Walking the chain and replaying its key and revoke blocks is cheap and done in order in this process. The
+signature checks, which are nearly all of the cost, are sent in chunks to a pool of worker processes while the
+walk continues, so an audit runs on every core and never holds more than a few chunks in memory.
+"""
+
+from privledge import keypool
+from privledge import metrics
+from privledge import settings
+from privledge import utils
+from privledge.block import BlockType, LazyBlock
+
+import os
+import time
+
+
+def _verify_chunk(items):
+    """Worker process entry point: verify (height, body, signature, public key) items; returns the heights
+    whose signature does not verify"""
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+
+    verifiers = dict()
+    failed = []
+    for height, body, signature, public_key in items:
+        try:
+            verifier = verifiers.get(public_key)
+            if verifier is None:
+                verifier = verifiers[public_key] = PKCS1_v1_5.new(RSA.importKey(utils.decode(public_key)))
+            if not verifier.verify(SHA256.new(body.encode('utf-8')), utils.decode(signature)):
+                failed.append(height)
+        except ValueError:
+            failed.append(height)
+
+    return failed
+
+
+def _walk(ledger):
+    """Yield (height, problem, signature item) for every block in order; problem describes the first thing
+    wrong with the block apart from its signature, and the item is what _verify_chunk needs to check that"""
+    keys = dict()       # Key hash -> public key while active, None once revoked
+    predecessor = None
+
+    for height, block in enumerate(ledger):
+        if isinstance(block, LazyBlock):
+            try:
+                block = block.materialize()
+            except ValueError:
+                yield height, 'block hash does not match its contents', None
+                continue
+
+        if utils.gen_hash(block.__repr__()) != block.hash:
+            yield height, 'block hash does not match its contents', None
+            continue
+        if block.predecessor != predecessor:
+            yield height, 'predecessor is not the previous block', None
+            continue
+        predecessor = block.hash
+
+        if height == 0:
+            if block.blocktype is not BlockType.key or not block.is_self_signed:
+                yield height, 'root block is not a self-signed key', None
+                continue
+            signer = block.message
+        else:
+            signer = keys.get(block.signatory_hash)
+            if signer is None:
+                yield height, 'signed by a key that is not active', None
+                continue
+
+        # The block's own key or revoke takes effect after it
+        if block.blocktype is BlockType.key:
+            keys[block.message_hash] = block.message
+        elif block.blocktype is BlockType.revoke:
+            keys[block.message_hash] = None
+
+        yield height, None, (height, block.body, block.signature, signer)
+
+
+def verify(ledger, processes=None, chunk=settings.AUDIT_CHUNK, progress=None):
+    """Verify every block of a ledger snapshot, or of any iterable of blocks in chain order such as an archive
+    being read, checking signatures on processes worker processes (default: all cores; 1 checks them in this
+    process). progress(verified, total) is called as chunks complete; total is None for an iterable without a
+    length.
+
+    Returns a dict with the ledger height, the number of signatures verified, the time taken, the throughput
+    in blocks per second and the first invalid height with the reason, both None if the ledger is valid."""
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    start = time.perf_counter()
+    total = len(ledger) if hasattr(ledger, '__len__') else None
+    walked = 0
+    workers = processes if processes is not None else os.cpu_count()
+    executor = keypool.process_pool(workers) if workers > 1 else None
+    in_flight = dict()      # Future -> chunk size
+    failures = []           # (height, reason)
+    verified = 0
+
+    def collect(futures):
+        nonlocal verified
+        for future in futures:
+            failures.extend((height, 'signature does not verify') for height in future.result())
+            verified += in_flight.pop(future)
+            if progress is not None:
+                progress(verified, total)
+
+    def submit(items):
+        nonlocal verified
+        if executor is None:
+            failures.extend((height, 'signature does not verify') for height in _verify_chunk(items))
+            verified += len(items)
+            if progress is not None:
+                progress(verified, total)
+            return
+
+        # Keep a couple of chunks per worker queued, so the walk never runs far ahead of verification
+        while len(in_flight) >= 2 * workers:
+            collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+        in_flight[executor.submit(_verify_chunk, items)] = len(items)
+
+    try:
+        items = []
+        for height, problem, item in _walk(ledger):
+            walked = height + 1
+            if problem is not None:
+                # Everything after the first broken block is suspect, so the audit stops here
+                failures.append((height, problem))
+                break
+
+            # Signature failures beyond one already found do not change the outcome
+            if len(failures) > 0:
+                break
+
+            items.append(item)
+            if len(items) >= chunk:
+                submit(items)
+                items = []
+
+        if len(items) > 0:
+            submit(items)
+        collect(list(in_flight))
+
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    metrics.histogram('audit_seconds', 'Duration of a full-chain ledger audit').observe(elapsed)
+
+    invalid, reason = min(failures) if len(failures) > 0 else (None, None)
+    return {'height': total if total is not None else walked,
+            'verified': verified,
+            'seconds': elapsed,
+            'rate': verified / elapsed if elapsed > 0 else None,
+            'invalid': invalid,
+            'reason': reason}
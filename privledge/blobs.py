@@ -0,0 +1,186 @@
+""" Content-addressed blob store for large payloads
+
+A blob block carries only a reference to its content, the root hash and size, so chain sync stays small
+however large the payloads are. The content lives in a local store, split into fixed-size chunks that are each
+kept once under their SHA-256 hash, so a chunk shared by several documents (or a document added twice) is
+stored once. The root hash addresses a manifest listing the chunk hashes in order:
+
+    {"chunks": [<hash>, ...], "size": <bytes>}
+
+Content is fetched from peers only when it is read: the manifest first, then the chunks the store is missing,
+several at once from different peers. Every chunk is checked against its hash as it arrives, so a peer cannot
+substitute content. Requests name the ledger and the blob root as well as the chunk, and a peer only serves
+chunks of blobs referred to by that ledger, so the members of one ledger cannot read the blobs of another
+ledger sharing the store.
+"""
+
+from privledge import settings
+from privledge import utils
+
+import base64
+import io
+import json
+import os
+import tempfile
+
+
+def _is_hash(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def ref(root, size):
+    """Return the message of a blob block referring to content with this root hash and size"""
+    return json.dumps({'root': root, 'size': size}, sort_keys=True)
+
+
+def parse_ref(message):
+    """Return (root hash, size) from a blob block message; raises ValueError if it is not a blob reference"""
+    try:
+        reference = json.loads(message)
+        root, size = reference['root'], reference['size']
+    except (TypeError, KeyError, ValueError):
+        raise ValueError('Blob block message is not a blob reference', message)
+
+    if not _is_hash(root) or not isinstance(size, int) or size < 0:
+        raise ValueError('Blob block message is not a blob reference', message)
+    return root, size
+
+
+class BlobStore:
+    """Chunks on local disk, each in a file named by its hash"""
+
+    def __init__(self, directory, chunk_size=settings.BLOB_CHUNK):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, chunk_hash):
+        return os.path.join(self.directory, chunk_hash[:2], chunk_hash)
+
+    def has(self, chunk_hash):
+        return os.path.exists(self._path(chunk_hash))
+
+    def read(self, chunk_hash):
+        """Return the chunk with this hash, or None if it is not stored"""
+        # The hash may come from a peer, so it must not name a path outside the store
+        if not _is_hash(chunk_hash):
+            return None
+        try:
+            with open(self._path(chunk_hash), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, data):
+        """Store a chunk unless it is already stored; returns its hash"""
+        chunk_hash = utils.gen_hash(data)
+        path = self._path(chunk_hash)
+        if os.path.exists(path):
+            return chunk_hash
+
+        # Write to a temporary file and rename it, so a chunk is never seen half written
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        return chunk_hash
+
+    def contains(self, root, chunk_hash):
+        """Return whether chunk_hash is the blob root itself or one of the chunks in its stored manifest"""
+        if not _is_hash(root) or not _is_hash(chunk_hash):
+            return False
+        if chunk_hash == root:
+            return True
+        manifest = self.manifest(root)
+        return manifest is not None and chunk_hash in manifest['chunks']
+
+    def put_stream(self, stream):
+        """Store the content read from a binary stream; returns (root hash, size)"""
+        chunks = []
+        size = 0
+        while True:
+            data = stream.read(self.chunk_size)
+            if len(data) == 0:
+                break
+            chunks.append(self.write(data))
+            size += len(data)
+
+        return self.write(json.dumps({'chunks': chunks, 'size': size}).encode()), size
+
+    def put(self, data):
+        return self.put_stream(io.BytesIO(data))
+
+    def manifest(self, root):
+        """Return the manifest of the blob root, or None if it is not stored"""
+        data = self.read(root)
+        return json.loads(data.decode()) if data is not None else None
+
+    def missing(self, root):
+        """Return the hashes of the chunks of the blob root that are not stored (the root itself if its manifest
+        is not)"""
+        manifest = self.manifest(root)
+        if manifest is None:
+            return [root]
+        return [chunk_hash for chunk_hash in manifest['chunks'] if not self.has(chunk_hash)]
+
+    def get(self, root):
+        """Return the content of the blob root; raises KeyError if any of it is not stored"""
+        manifest = self.manifest(root)
+        if manifest is None:
+            raise KeyError(root)
+
+        parts = []
+        for chunk_hash in manifest['chunks']:
+            data = self.read(chunk_hash)
+            if data is None:
+                raise KeyError(chunk_hash)
+            parts.append(data)
+        return b''.join(parts)
+
+
+def _fetch_chunk(store, ledger_id, root, chunk_hash, peers):
+    """Fetch one chunk of the blob root from the first of peers that has it; returns True once it is stored"""
+    from privledge import messaging
+    from privledge import peers as peers_table
+
+    for peer in peers:
+        message = messaging.request(peer, settings.MSG_TYPE_BLOB, {'ledger': ledger_id, 'root': root,
+                                                                   'hash': chunk_hash})
+        if message.msg_type != settings.MSG_TYPE_SUCCESS:
+            continue
+
+        data = base64.b64decode(message.msg)
+        if utils.gen_hash(data) != chunk_hash:
+            utils.log_message("Peer {} sent a chunk that does not match {}".format(peer, chunk_hash))
+            peers_table.failed(peer)
+            continue
+
+        peers_table.succeeded(peer)
+        store.write(data)
+        return True
+    return False
+
+
+def fetch(store, ledger_id, root, peers, workers=settings.BLOB_FETCH_WORKERS):
+    """Fetch the parts of the blob root that the store is missing from peers, several chunks at a time and each
+    from a different peer first. Returns True once the whole blob is stored."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    peers = list(peers)
+    if not store.has(root) and not _fetch_chunk(store, ledger_id, root, root, peers):
+        return False
+
+    missing = store.missing(root)
+    if len(missing) == 0:
+        return True
+    if len(peers) == 0:
+        return False
+
+    def fetch_nth(i):
+        # Start each chunk at a different peer, falling back to the others
+        start = i % len(peers)
+        return _fetch_chunk(store, ledger_id, root, missing[i], peers[start:] + peers[:start])
+
+    with ThreadPoolExecutor(min(workers, len(missing))) as pool:
+        return all(pool.map(fetch_nth, range(len(missing))))
@@ -1,11 +1,7 @@
 import json
 from enum import Enum
 
-from Crypto.Hash import SHA256
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.PublicKey import RSA
-
-
+from privledge import metrics
 from privledge import utils
 
 
@@ -13,26 +9,48 @@ class BlockType(Enum):
     key = 0         # message is public key
     revoke = 1      # message is public key
     text = 2        # message is text
+    blob = 3        # message is a reference to content in the blob store (see blobs.ref)
 
     def repr_json(self):
         return self.name
 
 class Block:
-    def __init__(self, blocktype, predecessor, message, signature=None, signatory_hash=None):
+    def __init__(self, blocktype, predecessor, message, signature=None, signatory_hash=None, timestamp=None):
         self.blocktype = blocktype
         self.predecessor = predecessor
         self.message = message
         self.signature = signature
         self.signatory_hash = signatory_hash
+        self.timestamp = timestamp      # Seconds since the epoch, signed with the body; optional
+
+    def __setattr__(self, name, value):
+        # Any change to a public field invalidates the cached block and message hashes
+        if not name.startswith('_'):
+            self.__dict__.pop('_hash', None)
+            self.__dict__.pop('_message_hash', None)
+            self.__dict__.pop('_wire', None)
+        super(Block, self).__setattr__(name, value)
 
     # message_hash is used primarily for key lookup
     @property
     def message_hash(self):
-        return utils.gen_hash(self.message)
+        if '_message_hash' not in self.__dict__:
+            self._message_hash = utils.gen_hash(self.message)
+        return self._message_hash
 
     @property
     def hash(self):
-        return utils.gen_hash(self.__repr__())
+        if '_hash' not in self.__dict__:
+            self._hash = utils.gen_hash(self.__repr__())
+        return self._hash
+
+    @property
+    def wire(self):
+        """The json this block travels as inside a message (see repr_json). Cached, so a block is serialized
+        once however many peers it is sent to."""
+        if '_wire' not in self.__dict__:
+            self._wire = json.dumps(self.repr_json())
+        return self._wire
 
     @property
     def hash_body(self):
@@ -43,10 +61,14 @@ class Block:
     def body(self):
         """This generates a json string for signing; excludes signature fields"""
 
-        body = {k: v for k, v in self.__dict__.items() if
-                k != 'signature' and k != 'signatory_hash' and k != 'ptr_previous'}
+        body = {k: v for k, v in self._fields() if k != 'signature' and k != 'signatory_hash'}
         return json.dumps(body, cls=utils.ComplexEncoder, sort_keys=True)
 
+    def _fields(self):
+        # A block without a timestamp encodes exactly as blocks did before timestamps existed
+        return [(k, v) for k, v in self.__dict__.items()
+                if k != 'ptr_previous' and not k.startswith('_') and not (k == 'timestamp' and v is None)]
+
     # @property
     # def signature_decoded(self):
     #     return base64.b64decode(self.signature)
@@ -65,13 +87,17 @@ class Block:
         return self.predecessor is None and self.is_self_signed
 
     def sign(self, privkey):
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import PKCS1_v1_5
+
         # Sign the block body hash
         h = SHA256.new(self.body.encode('utf-8'))
         signer = PKCS1_v1_5.new(privkey)
 
         # Set the block signature values
-        self.signature = utils.encode(signer.sign(h))
-        self.signatory_hash = utils.gen_hash(utils.encode_key(privkey))
+        with metrics.histogram('block_sign_seconds', 'Time spent signing block bodies').time():
+            self.signature = utils.encode(signer.sign(h))
+        self.signatory_hash = utils.key_hash(privkey)
 
         # Validate our signature is correct
         if not self.validate(privkey.publickey()):
@@ -82,13 +108,17 @@ class Block:
 
     def validate(self, pubkey):
         """Validate this block's signature with the supplied public key"""
+        from Crypto.Hash import SHA256
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
 
         # If pubkey is a string, turn it into a key object
         if isinstance(pubkey, str):
             pubkey = RSA.importKey(utils.decode(pubkey))
 
         signer = PKCS1_v1_5.new(pubkey)
-        return signer.verify(SHA256.new(self.body.encode('utf-8')), utils.decode(self.signature))
+        with metrics.histogram('block_verify_seconds', 'Time spent verifying block signatures').time():
+            return signer.verify(SHA256.new(self.body.encode('utf-8')), utils.decode(self.signature))
 
     def __str__(self):
         return '\t\tType: {}{}\n' \
@@ -96,18 +126,74 @@ class Block:
                '\t\tMessage: {}\n' \
                '\t\tMessage Hash: {}\n' \
                '\t\tSignatory Hash: {}{}\n' \
-               '\t\tPredecessor: {}' \
+               '\t\tPredecessor: {}{}' \
             .format(self.blocktype.name, ' (root)' if self._is_root else '',
                     utils.hash_color(self.hash),
                     self.message[:64],
                     utils.hash_color(self.message_hash),
                     utils.hash_color(self.signatory_hash), ' (self-signed)' if self.is_self_signed else '',
-                    'None' if self._is_root else utils.hash_color(self.predecessor))
+                    'None' if self._is_root else utils.hash_color(self.predecessor),
+                    '' if self.timestamp is None else '\n\t\tTimestamp: {}'.format(utils.format_time(self.timestamp)))
 
     def __repr__(self):
-        body = {k: v for k, v in self.__dict__.items() if k != 'ptr_previous'}
-        return json.dumps(body, cls=utils.ComplexEncoder, sort_keys=True)
+        return json.dumps(dict(self._fields()), cls=utils.ComplexEncoder, sort_keys=True)
+
+    def repr_json(self):
+        # On the wire a block travels as its routing fields plus its raw json, so a receiver can route,
+        # deduplicate or reject it without decoding the body (see LazyBlock)
+        return {'hash': self.hash, 'predecessor': self.predecessor, 'block': self.__repr__()}
+
+
+class LazyBlock:
+    """A received block that has only had its routing fields (hash, predecessor) decoded.
+
+    The raw block json is kept as received and only decoded into a Block when any other field is accessed,
+    so duplicate or rejected blocks are discarded without parsing their message or signature."""
+
+    def __init__(self, raw, hash, predecessor):
+        self.raw = raw
+        self.hash = hash
+        self.predecessor = predecessor
+        self._block = None
+        self._wire = None
+
+    def materialize(self):
+        """Decode the raw json into a Block, checking it matches the routing fields it was sent with. Raises
+        ValueError for anything a peer could send that is not such a block."""
+
+        if self._block is None:
+            try:
+                block = json.loads(self.raw, object_hook=utils.message_decoder)
+                matches = isinstance(block, Block) and block.predecessor == self.predecessor and \
+                    block.hash == self.hash
+            except (KeyError, TypeError, AttributeError) as e:
+                raise ValueError('Block could not be decoded', self.hash, e)
+
+            if not matches:
+                raise ValueError('Block does not match the hash and predecessor it was sent with', self.hash)
+
+            self._block = block
+
+        return self._block
+
+    @property
+    def wire(self):
+        if self._wire is None:
+            self._wire = json.dumps(self.repr_json())
+        return self._wire
+
+    def __getattr__(self, name):
+        # Only called for fields we have not decoded yet
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __str__(self):
+        return str(self.materialize())
+
+    def __repr__(self):
+        return self.raw
 
     def repr_json(self):
-        return self.__dict__
+        return {'hash': self.hash, 'predecessor': self.predecessor, 'block': self.raw}
 
@@ -0,0 +1,326 @@
+""" Local control API for running the daemon headless
+
+A Unix domain socket accepts newline-delimited JSON requests:
+
+    {"id": 1, "cmd": "block", "args": {"type": "text", "message": "hello"}}
+
+and answers each with one line, in request order:
+
+    {"id": 1, "ok": true, "result": {"hash": "..."}}
+    {"id": 2, "ok": false, "error": "..."}
+
+Clients may pipeline: write any number of requests before reading the responses.
+"""
+
+from privledge import daemon
+from privledge import metrics
+from privledge import peers
+from privledge import settings
+from privledge import utils
+
+import json
+import os
+import signal
+import socket
+import threading
+
+
+# Command handlers: each takes the request args dict and returns a json serializable result #
+
+def _node(args):
+    """The node a request targets: args['ledger'] (id or unique prefix) or the current ledger"""
+    if args.get('ledger') is None:
+        node = daemon.current
+    else:
+        node = daemon.find(args['ledger'])
+
+    if node is None:
+        raise ValueError("Not a member of ledger {}".format(args.get('ledger', '')))
+    return node
+
+
+def _block_json(block, index=None):
+    result = json.loads(block.__repr__())
+    result['hash'] = block.hash
+    if index is not None:
+        result['index'] = index
+    return result
+
+
+def _key(args):
+    if args.get('key') is None or args['key'] == 'gen':
+        privkey = utils.gen_privkey()
+    else:
+        privkey = utils.get_key(args['key'])
+        if privkey is None:
+            raise ValueError("Could not import the provided key")
+
+    daemon.set_key(privkey)
+    return {'hash': utils.key_hash(privkey), 'key': utils.encode_key(privkey)}
+
+
+def _metrics(args):
+    return metrics.values()
+
+
+def _init(args):
+    if args.get('key') is None or args['key'] == 'gen':
+        privkey = utils.gen_privkey()
+    else:
+        privkey = utils.get_key(args['key'])
+        if privkey is None:
+            raise ValueError("Could not import the provided key")
+
+    return {'ledger': daemon.create_ledger(privkey).id}
+
+
+def _join(args):
+    if 'ledger' not in args:
+        raise ValueError("You must provide the ledger id to join")
+
+    if args.get('member') is not None:
+        member = tuple(args['member'])
+    else:
+        # Find a member through discovery
+        members = daemon.discover().get(args['ledger'])
+        if not members:
+            raise ValueError("Could not discover a member of ledger {}".format(args['ledger']))
+        member = list(members)[0]
+
+    node = daemon.join_ledger(args['ledger'], member)
+    if node is None:
+        raise ValueError("Could not join ledger {} through {}".format(args['ledger'], member))
+    return {'ledger': node.id, 'height': len(node.ledger)}
+
+
+def _export(args):
+    if 'file' not in args:
+        raise ValueError("You must provide the file to write the archive to")
+    node = _node(args)
+    return {'ledger': node.id, 'blocks': daemon.export_ledger(node, args['file'])}
+
+
+def _import(args):
+    if 'file' not in args:
+        raise ValueError("You must provide the archive to import")
+    member = tuple(args['member']) if args.get('member') is not None else None
+
+    node = daemon.import_ledger(args['file'], member)
+    return {'ledger': node.id, 'height': len(node.ledger)}
+
+
+def _verify(args):
+    from privledge import audit
+    return audit.verify(_node(args).ledger.snapshot(), args.get('processes'))
+
+
+def _block(args):
+    node = _node(args)
+    try:
+        future = daemon.submit_block(node, args.get('type', 'text'), args['message'])
+    except KeyError as e:
+        raise ValueError("{} is not a valid blocktype".format(e))
+
+    # Resolved after the rest of the chunk has been submitted, so pipelined blocks are signed as one batch
+    return _Pending(future, lambda block_hash: {'hash': block_hash})
+
+
+def _ledger(args):
+    ledger = _node(args).ledger.snapshot()
+
+    if args.get('since') is not None or args.get('until') is not None:
+        since = float(args['since']) if args.get('since') is not None else None
+        until = float(args['until']) if args.get('until') is not None else None
+        limit = int(args['limit']) if args.get('limit') is not None else None
+        idx, blocks = ledger.time_range(since, until, limit)
+        return [_block_json(block, i) for i, block in zip(idx, blocks)]
+
+    blocks = ledger.slice_ledger(args.get('from'))
+    if blocks is None:
+        raise ValueError("Block {} is not in the ledger".format(args['from']))
+
+    start = len(ledger) - len(blocks)
+    if args.get('limit') is not None:
+        blocks = blocks[:int(args['limit'])]
+
+    return [_block_json(block, start + i) for i, block in enumerate(blocks)]
+
+
+def _status(args):
+    ledgers = []
+    for node in list(daemon.nodes.values()):
+        ledger = node.ledger.snapshot()
+        ledgers.append({'ledger': node.id,
+                        'height': len(ledger),
+                        'tail': ledger.tail.hash,
+                        'peers': list(node.peers.keys()),
+                        'peer_stats': [peers.get(address).repr_json() for address in peers.rank(node.peers.keys())],
+                        'root': node.is_root(),
+                        'syncing': None if node.sync is None else {'height': node.sync.height}})
+
+    return {'current': daemon.current.id if daemon.current is not None else None, 'ledgers': ledgers}
+
+
+def _keys(args):
+    ledger = _node(args).ledger.snapshot()
+    return [{'hash': key_hash, 'active': state.active, 'block': state.block.hash}
+            for key_hash, state in ledger.keys().items()]
+
+
+def _search(args):
+    node = _node(args)
+    idx, blocks = node.ledger.search(args['query'], args.get('by', 'block') == 'block')
+    return [_block_json(block, i) for i, block in zip(idx, blocks)]
+
+
+class _Pending:
+    """A result that is still being computed: a future and how to turn its value into the response result"""
+
+    def __init__(self, future, result):
+        self.future = future
+        self.result = result
+
+
+COMMANDS = {
+    'key': _key,
+    'metrics': _metrics,
+    'init': _init,
+    'join': _join,
+    'export': _export,
+    'import': _import,
+    'verify': _verify,
+    'block': _block,
+    'ledger': _ledger,
+    'status': _status,
+    'search': _search,
+    'keys': _keys,
+}
+
+
+def _dispatch(line):
+    """Start handling a request line; returns (request id, result or _Pending, error)"""
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get('id')
+        command = COMMANDS.get(request.get('cmd'))
+        if command is None:
+            raise ValueError("Unknown command: {}".format(request.get('cmd')))
+
+        return request_id, command(request.get('args') or {}), None
+
+    except (ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+        return request_id, None, e
+
+
+def handle_lines(lines):
+    """Handle a list of request lines and return the response lines, in request order"""
+    started = [_dispatch(line) for line in lines]
+
+    responses = []
+    for request_id, result, error in started:
+        if isinstance(result, _Pending):
+            try:
+                result = result.result(result.future.result())
+            except Exception as e:
+                # Whatever failed committing this block, the client gets an error line rather than a dropped
+                # connection
+                error = e
+
+        if error is None:
+            response = {'id': request_id, 'ok': True, 'result': result}
+        else:
+            response = {'id': request_id, 'ok': False, 'error': str(error)}
+        responses.append(json.dumps(response, cls=utils.ComplexEncoder) + '\n')
+
+    return responses
+
+
+def handle(line):
+    """Handle a single request line and return the response line"""
+    return handle_lines([line])[0]
+
+
+# Socket Threads #
+
+class ControlServer(threading.Thread):
+    def __init__(self, path=settings.CONTROL_SOCKET):
+        super(ControlServer, self).__init__()
+        utils.log_message("Starting Control Server Thread")
+        self.daemon = True
+        self.path = path
+        self.stop = threading.Event()
+
+        # Remove a stale socket left behind by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        os.chmod(path, 0o600)
+        self._socket.listen(settings.CONTROL_BACKLOG)
+        self._socket.settimeout(0.5)
+
+    def run(self):
+        utils.log_message("Listening for control requests on {0}".format(self.path))
+        try:
+            while not self.stop.is_set():
+                try:
+                    client_socket, address = self._socket.accept()
+                except socket.timeout:
+                    continue
+                ControlConnectionThread(client_socket).start()
+        finally:
+            self._socket.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class ControlConnectionThread(threading.Thread):
+    def __init__(self, client_socket):
+        super(ControlConnectionThread, self).__init__()
+        self.daemon = True
+        self._socket = client_socket
+
+    def run(self):
+        buffer = b''
+        try:
+            while True:
+                data = self._socket.recv(settings.CONTROL_RECV_BYTES)
+                if not data:
+                    break
+
+                # Answer every complete request in this chunk with a single write, so pipelined requests
+                # are not held up by one syscall per response
+                lines = (buffer + data).split(b'\n')
+                buffer = lines.pop()
+                responses = handle_lines([line.decode() for line in lines if len(line.strip()) > 0])
+                if len(responses) > 0:
+                    self._socket.sendall(''.join(responses).encode())
+
+        except OSError as e:
+            utils.log_message("Control connection closed: {}".format(e), utils.Level.MEDIUM)
+        finally:
+            self._socket.close()
+
+
+def run(path=settings.CONTROL_SOCKET):
+    """Run the daemon without a shell until interrupted, serving the control socket at path"""
+
+    server = ControlServer(path)
+    server.start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    utils.log_message("Privledge daemon running headless, control socket {}".format(path), utils.Level.FORCE)
+    try:
+        while not stop.is_set():
+            stop.wait(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop.set()
+        server.join()
+        for ledger_id in list(daemon.nodes.keys()):
+            daemon.leave_ledger(ledger_id)
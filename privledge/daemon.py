@@ -1,56 +1,257 @@
 """ A daemon thread manager that can be controlled from the privledge shell
+
+One process can host any number of ledgers. Each ledger's state (ledger, peers, signing key) lives in a
+LedgerNode; the UDP and TCP listeners and the heartbeat thread are shared by all of them and route incoming
+messages to the right node by ledger id.
 """
 
 from privledge import block
+from privledge import metrics
+from privledge import peers
 from privledge import settings
 from privledge import utils
 from privledge import messaging
 from privledge.ledger import Ledger
 
+from collections import OrderedDict
+from datetime import datetime
 import json
+import random
 import socket
+import threading
+import time
 
-ledger = None
-peers = dict()
+nodes = dict()          # Ledger id -> LedgerNode
+current = None          # The node the shell is operating on
 disc_ledgers = dict()
-disc_peers = set()
-privkey = None
+privkey = None          # Default key, used by ledgers created or joined from now on
 _udp_thread = None
 _udp_hb_thread = None
+_pex_thread = None
 _tcp_thread = None
+_metrics_thread = None
+_query_thread = None
+_blob_store = None
+
+metrics.gauge('threads', 'Live threads in this process').set_function(threading.active_count)
+metrics.gauge('ledgers', 'Ledgers hosted by this process').set_function(lambda: len(nodes))
+metrics.gauge('peers', 'Known live peers across all ledgers')\
+    .set_function(lambda: sum(len(node.peers) for node in list(nodes.values())))
+metrics.gauge('ledger_height', 'Blocks across all local ledgers')\
+    .set_function(lambda: sum(len(node.ledger) for node in list(nodes.values())))
+
+
+class LedgerNode:
+    """The state of a single ledger hosted by this daemon"""
+
+    def __init__(self, ledger, privkey=None, ledger_id=None):
+        self.ledger = ledger
+        self.peers = dict()             # Peer address -> time of its last heartbeat; see add_peer and remove_peer
+        self.peer_tails = dict()        # Peer address -> tail hash from its last heartbeat
+        self.peer_log = OrderedDict()   # Peer address -> peer list version it was added at, oldest first
+        self.peer_version = 0
+        self.peer_epoch = random.getrandbits(32)    # Tells exchange partners our versions restarted
+        self.peer_seen = dict()         # Peer address -> (epoch, version) of its peer list we have caught up to
+        self._peer_lock = threading.Lock()
+        self.disc_peers = set()
+        self.privkey = privkey
+        self.mempool = None             # Started with the first block submitted to this ledger
+        self.rejected = OrderedDict()   # Tails of branches that lost fork choice against ours
+        self.sync = None                # ChainSync streaming the chain after a join or falling behind
+        self._ledger_id = ledger_id     # Known before the root block arrives when joining
+
+    @property
+    def id(self):
+        if self.ledger.id is not None:
+            return self.ledger.id
+        return self._ledger_id
+
+    def add_peer(self, address):
+        """Record that a peer is alive; returns True if it is new to us, in which case it gets the next peer
+        list version"""
+        with self._peer_lock:
+            new = address not in self.peers
+            self.peers[address] = datetime.now()
+            if new:
+                self.peer_version += 1
+                self.peer_log[address] = self.peer_version
+                self.peer_log.move_to_end(address)
+            return new
+
+    def remove_peer(self, address):
+        with self._peer_lock:
+            self.peers.pop(address, None)
+            self.peer_tails.pop(address, None)
+            self.peer_log.pop(address, None)
+            self.peer_seen.pop(address, None)
+
+    def peer_delta(self, since, limit):
+        """Return (version, addresses, more): the live peers added after version since, oldest first and at most
+        limit of them. version is that of the last one returned, to be asked for next; more is True if peers
+        were left out."""
+        with self._peer_lock:
+            # Versions grow along the log, so only its end is walked
+            delta = []
+            for address, version in reversed(self.peer_log.items()):
+                if version <= since:
+                    break
+                delta.append((address, version))
+            delta.reverse()
+
+            if len(delta) > limit:
+                return delta[limit - 1][1], [address for address, version in delta[:limit]], True
+            return self.peer_version, [address for address, version in delta], False
+
+    def reject(self, tail_hash):
+        """Remember a losing tail so heartbeats announcing it do not trigger another sync"""
+        self.rejected[tail_hash] = None
+        while len(self.rejected) > settings.FORK_REJECTED_SIZE:
+            self.rejected.popitem(last=False)
+
+    def is_root(self):
+        # The ledger id is the hash of the root key, so compare hashes rather than re-encoding our key
+        if self.ledger is not None and self.ledger.root is not None and self.privkey is not None:
+            return self.ledger.id == utils.key_hash(self.privkey)
+        else:
+            return False
 
 
 def joined():
-    return ledger is not None
+    return current is not None
 
 
 def is_root():
-    if ledger is not None and ledger.root is not None and privkey is not None:
-        return ledger.root.message == utils.encode_key(privkey)
-    else:
-        return False
+    return current is not None and current.is_root()
+
+
+def signing_key():
+    """The key used to sign new blocks on the current ledger"""
+    if current is not None and current.privkey is not None:
+        return current.privkey
+    return privkey
+
+
+def set_key(key):
+    """Use key for the current ledger and any ledger created or joined from now on"""
+    global privkey
+
+    privkey = key
+    if current is not None:
+        current.privkey = key
+
+
+def find(ledger_id):
+    """Return the node hosting the ledger with the given id (or unique id prefix), or None"""
+    if ledger_id in nodes:
+        return nodes[ledger_id]
+
+    matches = [node for id, node in list(nodes.items()) if id.startswith(ledger_id)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def select(ledger_id):
+    """Make the ledger with the given id (or unique id prefix) the current one; returns the node or None"""
+    global current
+
+    node = find(ledger_id)
+    if node is not None:
+        current = node
+    return node
+
+
+def _add_node(node):
+    global current
+
+    nodes[node.id] = node
+    current = node
+
+    # The listeners are shared by every ledger, start them with the first one
+    ledger_listeners(True)
+
+
+def new_ledger(ledger_id):
+    """Return an empty Ledger, bounded to settings.LEDGER_WINDOW blocks in memory when that is set"""
+    if settings.LEDGER_WINDOW is None:
+        return Ledger()
+
+    return Ledger(settings.LEDGER_WINDOW, settings.LEDGER_COLD_DIR, 'privledge-{}-'.format(ledger_id))
 
 
 # Create a ledger with a new public and private key
 def create_ledger(key):
-    global ledger, privkey
-
     # Create root block
-    root_block = block.Block(block.BlockType.key, None, utils.encode_key(key))
+    root_block = block.Block(block.BlockType.key, None, utils.encode_key(key), timestamp=round(time.time(), 3))
     root_block.sign(key)
 
-    ledger = Ledger()
+    ledger = new_ledger(utils.key_hash(key))
     ledger.append(root_block)
-    privkey = key
 
-    # Start Listeners
-    ledger_listeners(True)
+    node = LedgerNode(ledger, key)
+    _add_node(node)
+    return node
+
+
+def submit_block(node, blocktype, message):
+    """Queue a new block for the node's ledger, signed with the node's key; returns a Future resolving to the
+    block hash. Raises KeyError for an unknown blocktype; the future raises ValueError if the block is rejected."""
+    from privledge.mempool import Mempool
+
+    key = node.privkey if node.privkey is not None else privkey
+    if key is None:
+        raise ValueError("You must have a private key added before you may create a block")
+
+    if node.mempool is None:
+        node.mempool = Mempool(node)
+        node.mempool.start()
+
+    return node.mempool.submit(blocktype, message, key)
+
+
+def add_block(node, blocktype, message):
+    """Add a block to the node's ledger and wait for it to be committed; returns the block hash.
+    Raises KeyError for an unknown blocktype and ValueError if the block is rejected."""
+    return submit_block(node, blocktype, message).result()
+
+
+def blob_store():
+    """The local blob store, opened on first use"""
+    global _blob_store
+
+    if _blob_store is None:
+        from privledge.blobs import BlobStore
+        _blob_store = BlobStore(settings.BLOB_DIR)
+    return _blob_store
+
+
+def submit_blob(node, stream):
+    """Store the content of a binary stream in the blob store and queue a blob block referring to it; returns
+    a Future resolving to the block hash"""
+    from privledge import blobs
+
+    root, size = blob_store().put_stream(stream)
+    return submit_block(node, 'blob', blobs.ref(root, size))
+
+
+def read_blob(node, message):
+    """Return the content a blob block message refers to, fetching what the blob store is missing from the
+    node's peers. Raises ValueError if the message is not a blob reference or the content cannot be found."""
+    from privledge import blobs
+
+    root, size = blobs.parse_ref(message)
+    store = blob_store()
+    if len(store.missing(root)) > 0 and not blobs.fetch(store, node.id, root, peers.rank(node.peers.keys())):
+        raise ValueError('No peer could supply the content of blob', root)
+    return store.get(root)
 
 
 def ledger_listeners(start):
-    global _udp_thread, _udp_hb_thread, _tcp_thread
+    global _udp_thread, _udp_hb_thread, _tcp_thread, _pex_thread
 
     if start:
+        # Listeners are shared, so only the first ledger starts them
+        if _udp_thread is not None:
+            return
+
         # Spawn UDP Persistent Listener thread
         _udp_thread = messaging.UDPListener(settings.BIND_IP, settings.BIND_PORT)
         _udp_thread.start()
@@ -63,6 +264,10 @@ def ledger_listeners(start):
         _udp_hb_thread = messaging.UDPHeartbeat()
         _udp_hb_thread.start()
 
+        # Spawn Peer Exchange thread
+        _pex_thread = messaging.PeerExchange()
+        _pex_thread.start()
+
     else:
         # Kill udp listener thread
         if _udp_thread is not None:
@@ -85,43 +290,90 @@ def ledger_listeners(start):
             _udp_hb_thread.join()
             _udp_hb_thread = None
 
+        # Kill peer exchange thread
+        if _pex_thread is not None:
+            utils.log_message("Killing Peer Exchange Thread...")
+            _pex_thread.stop.set()
+            _pex_thread.join()
+            _pex_thread = None
+
+
+def metrics_endpoint(start, port=settings.METRICS_PORT):
+    """Start or stop the local metrics text endpoint; returns the bound address when started"""
+    global _metrics_thread
+
+    if start:
+        if _metrics_thread is None:
+            _metrics_thread = metrics.MetricsServer(settings.METRICS_BIND_IP, port)
+            _metrics_thread.start()
+        return _metrics_thread.address
+
+    elif _metrics_thread is not None:
+        utils.log_message("Killing Metrics Server Thread...")
+        _metrics_thread.stop.set()
+        _metrics_thread.join()
+        _metrics_thread = None
+
+
+def query_endpoint(start, port=settings.QUERY_PORT):
+    """Start or stop the local read-only query server; returns the bound address when started"""
+    global _query_thread
+
+    if start:
+        if _query_thread is None:
+            from privledge import query
+            _query_thread = query.QueryServer(settings.QUERY_BIND_IP, port)
+            _query_thread.start()
+        return _query_thread.address
+
+    elif _query_thread is not None:
+        utils.log_message("Killing Query Server Thread...")
+        _query_thread.stop.set()
+        _query_thread.join()
+        _query_thread = None
+
 
 # Join a ledger with a specified public key
 def join_ledger(public_key_hash, member):
-    global ledger
-
-    # Check to make sure we aren't part of a ledger yet
-    if joined():
-        print("You are already a member of a ledger")
+    # Check to make sure we aren't part of this ledger yet
+    if public_key_hash in nodes:
+        print("You are already a member of this ledger")
         return
 
     utils.log_message("Spawning TCP Connection Thread to {0}".format(member))
-    join_message = messaging.Message(settings.MSG_TYPE_JOIN, public_key_hash).prep_tcp()
-    thread = messaging.TCPMessageThread(member, join_message)
-    thread.start()
-    thread.join()
 
     # If the message is a success, import the key
     try:
 
-        message = json.loads(thread.message, object_hook=utils.message_decoder)
+        # A busy member asks us to come back later; wait it out a few times before giving up
+        for attempt in range(3):
+            message = messaging.request(member, settings.MSG_TYPE_JOIN, public_key_hash)
+            if message.msg_type != settings.MSG_TYPE_BUSY:
+                break
+            time.sleep(max(0, messaging._busy_until.get(tuple(member), 0) - time.time()))
 
         if message.msg_type == settings.MSG_TYPE_SUCCESS:
             key = utils.get_key(message.msg)
-            key_hash = utils.gen_hash(utils.encode_key(key))
+            key_hash = utils.key_hash(key)
 
             if public_key_hash == key_hash:
                 # Hooray! We have a match
                 utils.log_message("Joined ledger {}".format(public_key_hash), utils.Level.FORCE)
+                node = LedgerNode(new_ledger(public_key_hash), privkey, public_key_hash)
 
-                # Sync Ledger
-                messaging.block_sync(member)
+                # The root key is confirmed: become reachable now, and take the first page of blocks (which
+                # carries the root block) while the rest of the chain streams in the background
+                ledger_listeners(True)
+                _catch_up(node, member)
 
-                # Request peers
-                messaging.peer_sync(member)
+                if node.ledger.root is None:
+                    node.ledger.close()
+                    if len(nodes) == 0:
+                        ledger_listeners(False)
+                    raise ValueError('Member did not send the root block')
 
-                # Start Listeners
-                ledger_listeners(True)
+                _add_node(node)
+                return node
 
             else:
                 raise ValueError('Public key returned does not match requested hash: {0}'.format(key_hash))
@@ -133,22 +385,103 @@ def join_ledger(public_key_hash, member):
         utils.log_message("Not a valid response from {0}: {1}".format(member, e))
 
 
-def leave_ledger():
-    global ledger, _udp_thread, _tcp_thread
+def _catch_up(node, member):
+    """Request peers from member alongside the first page of the blocks we are missing, and stream any further
+    pages in the background"""
+    peer_thread = threading.Thread(target=messaging.peer_sync, args=(node, member))
+    peer_thread.start()
+    height = messaging.block_sync(node, member, settings.SYNC_PAGE_BLOCKS)
+    peer_thread.join()
 
-    # Kill the listners
-    ledger_listeners(False)
+    if height is not None and len(node.ledger) < height:
+        messaging.chain_sync(node, member, height)
 
-    if ledger is not None:
-        message = "Left ledger {0}".format(ledger.id)
-        ledger = None
-    else:
-        message = "Not a member of a ledger, cannot leave"
 
-    return message
+def export_ledger(node, path):
+    """Write the node's ledger to an archive at path; returns the number of blocks written"""
+    from privledge import archive
+    return archive.export(node.ledger.snapshot(), path)
+
+
+def import_ledger(path, member=None, processes=None):
+    """Host the ledger in the archive at path, then sync the blocks added since it was written from member (by
+    default, a member found through discovery). Signatures are checked in bulk on processes worker processes
+    (default: all cores). Returns the node. Raises ValueError if the archive is damaged, its blocks do not
+    verify or the ledger is already hosted."""
+    from privledge import archive
+    from privledge import audit
+
+    reader = archive.Archive(path)
+    try:
+        if reader.ledger in nodes:
+            raise ValueError('Already a member of ledger', reader.ledger)
+
+        ledger = new_ledger(reader.ledger)
+
+        def appended():
+            # Build the ledger while the audit checks signatures in bulk; it stays private to us until the
+            # audit has passed, so the one-by-one signature check on append is skipped
+            for imported in reader:
+                ledger.append(imported, verified=True)
+                yield ledger.tail
+
+        try:
+            result = audit.verify(appended(), processes)
+            if result['invalid'] is not None:
+                raise ValueError('Archive block {} is invalid: {}'.format(result['invalid'], result['reason']))
+            if ledger.id != reader.ledger or ledger.tail.hash != reader.tail:
+                raise ValueError('Archive blocks do not match its ledger id and tail', reader.ledger)
+        except ValueError:
+            ledger.close()
+            raise
+    finally:
+        reader.close()
+
+    node = LedgerNode(ledger, privkey)
+    _add_node(node)
+    utils.log_message("Imported {} block(s) of ledger {} from {}".format(len(ledger), node.id, path),
+                      utils.Level.FORCE)
+
+    if member is None:
+        members = discover().get(node.id)
+        member = next(iter(members)) if members else None
+    if member is not None:
+        _catch_up(node, member)
+
+    return node
+
+
+def leave_ledger(ledger_id=None):
+    """Leave the given ledger (default: the current one)"""
+    global current
+
+    node = current if ledger_id is None else nodes.get(ledger_id)
+
+    if node is None:
+        return "Not a member of a ledger, cannot leave"
+
+    del nodes[node.id]
+    sync = node.sync
+    if sync is not None:
+        sync.stop.set()
+        sync.join()
+    if node.mempool is not None:
+        node.mempool.stop.set()
+        node.mempool.join()
+        node.mempool = None
+    node.ledger.close()
+    if current is node:
+        current = next(iter(nodes.values()), None)
+
+    # Kill the listeners once no ledgers are left
+    if len(nodes) == 0:
+        ledger_listeners(False)
+
+    return "Left ledger {0}".format(node.id)
 
 
-def discover(ip='<broadcast>', port=settings.BIND_PORT, timeout = settings.DISCOVERY_TIMEOUT):
+def discover(ip='<broadcast>', port=None, timeout = settings.DISCOVERY_TIMEOUT):
+    port = settings.BIND_PORT if port is None else port
 
     utils.log_message("Starting Discovery for {} seconds".format(timeout))
 
@@ -185,7 +518,7 @@ def discover(ip='<broadcast>', port=settings.BIND_PORT, timeout = settings.DISCO
 
                     # Received response
                     # Is the response our own ledger?
-                    if address[0] == ip_self:
+                    if address == (ip_self, settings.BIND_PORT) or messaging.is_self(address):
                         continue
                     # Is the hash already in our list?
                     if message.msg not in results:
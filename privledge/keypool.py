@@ -0,0 +1,146 @@
+""" Background RSA key pre-generation on worker processes
+
+RSA key generation is CPU bound and takes seconds per 2048-bit key, so a pool of worker processes keeps a
+queue of ready keys topped up to a configurable depth. utils.gen_privkey takes keys from the pool when it is
+running; generate() produces a batch of keys across all cores.
+"""
+
+from privledge import settings
+from privledge import utils
+
+import multiprocessing
+import queue
+import threading
+
+_pool = None
+
+
+def _generate(keylength):
+    """Worker process entry point; keys cross the process boundary DER encoded"""
+    from Crypto.PublicKey import RSA
+    return RSA.generate(keylength).exportKey('DER')
+
+
+def process_pool(processes=None):
+    """Return a ProcessPoolExecutor of processes worker processes (default: all cores) for CPU bound work, such
+    as key generation here or signature checks in audit. The caller shuts it down."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Spawn rather than fork: the daemon is multi-threaded by the time a pool is started
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _import(der):
+    from Crypto.PublicKey import RSA
+    return RSA.importKey(der)
+
+
+class KeyPool:
+    def __init__(self, depth=settings.KEYPOOL_DEPTH, keylength=settings.KEY_LENGTH, processes=None):
+        self.depth = depth
+        self.keylength = keylength
+        self._keys = queue.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._executor = process_pool(processes)
+        self._refill()
+
+    @property
+    def ready(self):
+        return self._keys.qsize()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def get(self, timeout=None):
+        """Return a pre-generated key, waiting for the next one if the pool has been drained"""
+        with self._lock:
+            if self._keys.qsize() + self._pending == 0:
+                self._submit()
+
+        der = self._keys.get(timeout=timeout)
+        self._refill()
+        return _import(der)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=False)
+
+    def _refill(self):
+        with self._lock:
+            while not self._closed and self._keys.qsize() + self._pending < self.depth:
+                self._submit()
+
+    def _submit(self):
+        self._pending += 1
+        self._executor.submit(_generate, self.keylength).add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            utils.log_message("Key generation failed: {}".format(future.exception()))
+            return
+
+        self._keys.put(future.result())
+
+
+def start(depth=settings.KEYPOOL_DEPTH, keylength=settings.KEY_LENGTH, processes=None):
+    global _pool
+
+    if _pool is None:
+        utils.log_message("Starting key pool ({} keys, {}-bit)".format(depth, keylength))
+        _pool = KeyPool(depth, keylength, processes)
+    else:
+        _pool.depth = depth
+        _pool._refill()
+
+    return _pool
+
+
+def stop():
+    global _pool
+
+    if _pool is not None:
+        utils.log_message("Stopping key pool")
+        _pool.close()
+        _pool = None
+
+
+def status():
+    """Return (ready, pending, depth) for the running pool, or None"""
+    if _pool is None:
+        return None
+    return _pool.ready, _pool.pending, _pool.depth
+
+
+def take(keylength=settings.KEY_LENGTH):
+    """Return a key from the running pool, or None if no pool of that key length is running"""
+    if _pool is None or _pool.keylength != keylength:
+        return None
+    return _pool.get()
+
+
+def generate(count, keylength=settings.KEY_LENGTH, processes=None, save=False, filename='id_rsa', location=''):
+    """Generate count keys across processes (default: all cores). When saving, key i is written
+    through utils.save_key as <location><filename>_<i> and <location><filename>_<i>.pub"""
+
+    utils.log_message("Generating {0} {1}-bit RSA keys".format(count, keylength))
+
+    executor = process_pool(processes)
+    try:
+        keys = [_import(der) for der in executor.map(_generate, [keylength] * count)]
+    finally:
+        executor.shutdown()
+
+    if save:
+        for i, key in enumerate(keys):
+            utils.save_key(key, '{}_{}'.format(filename, i), location)
+
+    return keys
@@ -1,15 +1,101 @@
-from privledge.block import BlockType
-from privledge import utils
+from privledge.block import BlockType, LazyBlock
+from privledge.storage import ColdStore, TieredList
+from privledge import blobs
+from privledge import metrics
+from privledge import settings
 
-class Ledger:
-    def __init__(self):
-        self.tail = None
-        self.root = None
-        self._list = []
+from array import array
+from bisect import bisect_left
+import threading
+import time
+
+
+def fork_wins(height, tail_hash, other_height, other_tail_hash):
+    """Deterministic fork choice: True if the other chain should replace ours.
+    The longer chain wins; between chains of equal height the lowest tail hash wins, so every node picks the
+    same branch no matter which side it is on."""
+    return (other_height, tail_hash) > (height, other_tail_hash)
+
+
+class KeyState:
+    """The state of one key: the last key or revoke block for it, and its imported public key"""
+
+    def __init__(self, block):
+        self.block = block
+        self._public_key = None
+
+    @property
+    def hash(self):
+        return self.block.message_hash
+
+    @property
+    def active(self):
+        return self.block.blocktype is BlockType.key
+
+    @property
+    def public_key(self):
+        """The key object, imported on first use and kept for every later signature check"""
+        if self._public_key is None:
+            from Crypto.PublicKey import RSA
+            from privledge import utils
+            self._public_key = RSA.importKey(utils.decode(self.block.message))
+        return self._public_key
+
+
+class TimeIndex:
+    """Positions and timestamps of the timestamped blocks of a ledger, in chain order.
+
+    Timestamps may step back by up to the clock tolerance, so alongside each one the index keeps the latest
+    timestamp seen up to that block. That running maximum is sorted and is what gets bisected; it is never more
+    than the tolerance ahead of the block's own timestamp. Like the key history the index is only appended to,
+    and shared by views, which ignore entries past their length.
+    """
+
+    def __init__(self, positions=None, stamps=None, latest=None):
+        self.positions = array('Q') if positions is None else positions
+        self.stamps = array('d') if stamps is None else stamps
+        self.latest = array('d') if latest is None else latest
+
+    def add(self, pos, timestamp):
+        # Positions last, so a reader that finds a position can read its timestamps
+        self.latest.append(max(timestamp, self.latest[-1]) if len(self.latest) > 0 else timestamp)
+        self.stamps.append(timestamp)
+        self.positions.append(pos)
+
+    def truncated(self, length):
+        """Return a new TimeIndex of the entries for the first length blocks"""
+        count = bisect_left(self.positions, length)
+        return TimeIndex(self.positions[:count], self.stamps[:count], self.latest[:count])
+
+    def bounds(self, length, since=None, until=None):
+        """Return the entries (lo, hi) that may hold timestamps in [since, until) among the first length blocks"""
+        count = bisect_left(self.positions, length)
+        lo = 0 if since is None else bisect_left(self.latest, since, 0, count)
+        hi = count if until is None else bisect_left(self.latest, until + settings.LEDGER_CLOCK_SKEW, lo, count)
+        return lo, hi
+
+
+class LedgerView:
+    """An immutable view of the ledger as of one append
+
+    Blocks are only ever appended to the shared list, index and key history, so a view keeps references to
+    them plus the length, root and tail it was taken at: readers never block appends and never see a
+    half-applied one.
+    """
+
+    def __init__(self, blocks, index, keys, times, blobs, root, tail):
+        self._list = blocks
+        self._index = index     # Shared with the ledger; positions past our length are newer than this view
+        self._keys = keys
+        self._times = times
+        self._blobs = blobs
+        self._length = len(blocks)
+        self.root = root
+        self.tail = tail
 
     @property
     def list(self):
-        return self._list
+        return self
 
     @property
     def id(self):
@@ -18,17 +104,38 @@ class Ledger:
         else:
             return None
 
+    def position(self, block_hash):
+        """Return the position of the block with this hash, or None if it is not in this view"""
+        pos = self._index.get(block_hash)
+        if pos is None and isinstance(self._list, TieredList):
+            # Only the blocks in memory are indexed
+            pos = self._list.find_cold(block_hash, self._length)
+        return pos if pos is not None and pos < self._length else None
+
+    def locator(self):
+        """Return block hashes from the tail back to the root at exponentially growing steps (tail, tail-1,
+        tail-2, tail-4, ...), so a peer can find our last common block in one round trip"""
+        hashes = []
+        pos, step = self._length - 1, 1
+        while pos > 0:
+            hashes.append(self._list[pos].hash)
+            if len(hashes) > 1:
+                step *= 2
+            pos -= step
+
+        if self._length > 0:
+            hashes.append(self._list[0].hash)
+        return hashes
+
     def slice_ledger(self, block_hash = None):
         # Return the whole list if no specific block hash is given
         if block_hash is None:
-            return self._list
-        else:
-            # Step through the entire ledger in reverse order
-            for i, block in utils.reverse_enumerate(self._list):
-                # If we have a match, return the sublist
-                if block.hash == block_hash:
-                    return self._list[i+1:]
+            return self._list[:self._length]
 
+        pos = self.position(block_hash)
+        if pos is not None:
+            return self._list[pos+1:self._length]
+        else:
             # The requested block isn't in our ledger! Return None
             return None
 
@@ -41,22 +148,21 @@ class Ledger:
         """
 
         # Walk backward through the list
-        end = len(self._list) - 1
+        end = self._length - 1
 
         # Prepare return lists
         idx = []
         blocks = []
 
         if match_block:
-            while end >= 0:
-                if self.list[end].hash == query:
-                    idx.append(end)
-                    blocks.append(self._list[end])
-
-                end -= 1
+            # Block hashes are unique, so use the index
+            pos = self.position(query)
+            if pos is not None:
+                idx.append(pos)
+                blocks.append(self._list[pos])
         else:
             while end >= 0:
-                if self.list[end].message_hash == query:
+                if self._list[end].message_hash == query:
                     idx.append(end)
                     blocks.append(self._list[end])
 
@@ -64,18 +170,242 @@ class Ledger:
 
         return idx, blocks
 
-    def append(self, block):
+    def time_range(self, since=None, until=None, limit=None):
+        """Return ([positions], [blocks]) of the timestamped blocks with since <= timestamp < until (either bound
+        may be None), oldest first and at most limit of them, in O(log n + k)"""
+        lo, hi = self._times.bounds(self._length, since, until)
+
+        idx = []
+        blocks = []
+        for i in range(lo, hi):
+            if limit is not None and len(idx) >= limit:
+                break
+            stamp = self._times.stamps[i]
+            if (since is None or stamp >= since) and (until is None or stamp < until):
+                idx.append(self._times.positions[i])
+                blocks.append(self._list[self._times.positions[i]])
+        return idx, blocks
+
+    def time_bounds(self, since=None, until=None):
+        """Return positions (start, end) such that the blocks in between cover every block timestamped in
+        [since, until)"""
+        lo, hi = self._times.bounds(self._length, since, until)
+        start = self._times.positions[lo] if lo < hi else self._length
+        end = self._times.positions[hi] if hi < bisect_left(self._times.positions, self._length) else self._length
+        return min(start, end), end
+
+    def key_state(self, key_hash):
+        """Return the KeyState of the key with this hash, or None if it was never added"""
+        history = self._keys.get(key_hash, ())
+        for pos, state in reversed(history):
+            if pos < self._length:
+                return state
+        return None
+
+    def references_blob(self, root):
+        """Return whether a blob block in this view refers to the blob root"""
+        pos = self._blobs.get(root) if isinstance(root, str) else None
+        return pos is not None and pos < self._length
+
+    def keys(self):
+        """Return {key hash: KeyState} for every key that has been added, including revoked ones"""
+        states = dict()
+        for key_hash in list(self._keys.keys()):
+            state = self.key_state(key_hash)
+            if state is not None:
+                states[key_hash] = state
+        return states
+
+    def active_keys(self):
+        """Return {message hash: key block} for every key that has been added and not since revoked"""
+        return {key_hash: state.block for key_hash, state in self.keys().items() if state.active}
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._list[slice(*item.indices(self._length))]
+        if item < 0:
+            item += self._length
+        if not 0 <= item < self._length:
+            raise IndexError('Ledger index out of range', item)
+        return self._list[item]
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self._list[i]
+
+    def __contains__(self, block_hash):
+        return self.position(block_hash) is not None
+
+    def __len__(self):
+        return self._length
+
+
+class Ledger:
+    """The chain of accepted blocks
+
+    Appends are serialized by a single writer lock, which callers may also hold (`with ledger.lock:`) to read
+    the tail and append on top of it atomically. Reads go through snapshot() and never take the lock.
+
+    With a window, the ledger runs in bounded-memory mode: only the last window to 2 * window blocks stay in
+    memory (and in the hash index), older blocks are paged out to a file created in cold_dir and read back on demand, and
+    forks can only be resolved within the blocks still in memory. The key history and the blob
+    roots referred to are always kept in memory.
+    """
+
+    def __init__(self, window=None, cold_dir=None, prefix='privledge-'):
+        self.lock = threading.RLock()
+        self._list = [] if window is None else TieredList(window, ColdStore(cold_dir, prefix))
+        self._index = dict()    # Block hash -> position in _list (blocks in memory only)
+        self._keys = dict()     # Key hash -> [(position, KeyState)], oldest first
+        self._times = TimeIndex()
+        self._blobs = dict()    # Blob root -> position of the first blob block referring to it
+        self._view = LedgerView(self._list, self._index, self._keys, self._times, self._blobs, None, None)
+
+    def close(self):
+        """Release the on-disk storage of a bounded-memory ledger"""
+        if isinstance(self._list, TieredList):
+            self._list.close()
+
+    def snapshot(self):
+        """Return an immutable view of the ledger as it is now"""
+        return self._view
+
+    # Reads on the ledger itself see the latest snapshot
+
+    @property
+    def tail(self):
+        return self._view.tail
+
+    @property
+    def root(self):
+        return self._view.root
+
+    @property
+    def list(self):
+        return self._view
+
+    @property
+    def id(self):
+        return self._view.id
+
+    def slice_ledger(self, block_hash = None):
+        return self._view.slice_ledger(block_hash)
+
+    def search(self, query, match_block=True):
+        return self._view.search(query, match_block)
+
+    def keys(self):
+        return self._view.keys()
+
+    def active_keys(self):
+        return self._view.active_keys()
+
+    def time_range(self, since=None, until=None, limit=None):
+        return self._view.time_range(since, until, limit)
+
+    def append(self, block, verified=False):
+        """Validate and append a block. verified skips checking its signature, for blocks whose signatures have
+        already been checked against this chain (see audit.verify); everything else is still checked."""
+        with metrics.histogram('ledger_append_seconds', 'Time spent validating and appending a block').time():
+            with self.lock:
+                self._append(block, verified)
+        metrics.counter('ledger_blocks_appended_total', 'Blocks accepted onto the ledger').inc()
+
+    def reorganize(self, ancestor_hash, blocks):
+        """Replace everything after the block ancestor_hash with blocks, validating the new branch first.
+        Returns the blocks that were dropped; raises ValueError (leaving the ledger untouched) if the ancestor is
+        unknown or any new block is rejected.
+
+        The new branch is built on a copy, so views taken before the switch keep reading the old branch."""
+
+        with self.lock:
+            view = self._view
+            pos = view.position(ancestor_hash)
+            if pos is None:
+                raise ValueError('Fork point is not in the ledger', ancestor_hash)
+
+            branch = self._branch(pos + 1)
+            for block in blocks:
+                branch._append(block)
+
+            self._list, self._index, self._keys, self._times, self._blobs, self._view = \
+                branch._list, branch._index, branch._keys, branch._times, branch._blobs, branch._view
+
+        metrics.counter('ledger_reorganizations_total', 'Forks resolved by switching to another branch').inc()
+        return view[pos+1:]
+
+    def _branch(self, length):
+        """Return a new Ledger holding the first length blocks of this one. Raises ValueError in bounded-memory
+        mode if blocks that have been paged out would be dropped."""
+        if isinstance(self._list, TieredList):
+            blocks = self._list.truncated(length)
+        else:
+            blocks = self._list[:length]
+
+        branch = Ledger.__new__(Ledger)
+        branch.lock = threading.RLock()
+        branch._list = blocks
+        branch._index = {h: pos for h, pos in self._index.items() if pos < length}
+        branch._keys = dict()
+        for key_hash, history in self._keys.items():
+            history = [(pos, state) for pos, state in history if pos < length]
+            if len(history) > 0:
+                branch._keys[key_hash] = history
+        branch._times = self._times.truncated(length)
+        branch._blobs = {root: pos for root, pos in self._blobs.items() if pos < length}
+        branch._view = LedgerView(blocks, branch._index, branch._keys, branch._times, branch._blobs, self.root,
+                                  blocks[length - 1])
+        return branch
+
+    def _publish(self, block, root=None):
+        """Add a validated block and publish the new view; the list, index and key history are written before
+        the view that covers them, so readers never see a position they cannot read"""
+        pos = len(self._list)
+        self._index[block.hash] = pos
+        block.wire     # Encode the block for sending now, while it is the only copy being worked on
+        if block.blocktype is BlockType.key or block.blocktype is BlockType.revoke:
+            self._keys.setdefault(block.message_hash, []).append((pos, KeyState(block)))
+        if block.timestamp is not None:
+            self._times.add(pos, block.timestamp)
+        if block.blocktype is BlockType.blob:
+            self._blobs.setdefault(blobs.parse_ref(block.message)[0], pos)
+
+        if isinstance(self._list, TieredList):
+            # Paged out blocks are found through the file from now on
+            for evicted in self._list.append(block):
+                del self._index[evicted.hash]
+        else:
+            self._list.append(block)
+
+        self._view = LedgerView(self._list, self._index, self._keys, self._times, self._blobs,
+                                root if root is not None else self._view.root, block)
+
+    def _append(self, block, verified=False):
+        # Cheap checks on the routing fields first, so lazily received blocks we would reject are never decoded.
+        # Only a block that does not extend our tail can be one we already have, so a normal append never looks
+        # its hash up
+        if self.tail is not None and block.predecessor != self.tail.hash:
+            if block.hash in self:
+                raise ValueError('Block is already in the ledger', block.hash)
+            raise ValueError('Predecessor hash does not match the last accepted block', block.predecessor,
+                             self.tail.hash)
+
+        if isinstance(block, LazyBlock):
+            block = block.materialize()
+        self._check_time(block)
+        if block.blocktype is BlockType.blob:
+            blobs.parse_ref(block.message)
+
         # Adding root (must be self-signed and key)
         if block.predecessor is None and self.root is None:
 
             # Check the block has the right type and is self-signed
-            if block.blocktype is not BlockType.key or not block.validate(block.message):
+            if block.blocktype is not BlockType.key or not block.is_self_signed or \
+                    not (verified or block.validate(block.message)):
                 raise ValueError('Cannot add root block unless it is self-signed and of blocktype \'key\'',
                                  block.blocktype)
 
-            self.root = block
-            self.tail = block
-            self._list.append(block)
+            self._publish(block, root=block)
 
         # Do some checks to make sure block is valid
         else:
@@ -86,25 +416,39 @@ class Ledger:
                                  self.tail.hash)
 
             # Check that block signer (signatory_hash) is present on our ledger and valid
-            if not self.validate_block(block):
+            if not self.validate_block(block, verified):
                 raise ValueError('The block is not signed by an accepted key', block.signature)
 
             # Hash is correct, Signatory Exists, Signature is Valid: Add to ledger!
-            self._list.append(block)
-            self.tail = block
+            self._publish(block)
+
+    def _check_time(self, block):
+        """Timestamps are optional, but one that is given may not step back more than the clock tolerance from
+        the latest in the chain, or run ahead of our clock by more than it"""
+        if block.timestamp is None:
+            return
+
+        if not isinstance(block.timestamp, (int, float)) or isinstance(block.timestamp, bool):
+            raise ValueError('Block timestamp is not a number', block.timestamp)
+        if block.timestamp > time.time() + settings.LEDGER_CLOCK_SKEW:
+            raise ValueError('Block timestamp is in the future', block.timestamp)
+        if len(self._times.latest) > 0 and block.timestamp < self._times.latest[-1] - settings.LEDGER_CLOCK_SKEW:
+            raise ValueError('Block timestamp is older than the blocks before it', block.timestamp,
+                             self._times.latest[-1])
 
     # Ensure that the provided hash is valid and has not been revoked
-    def validate_block(self, block):
-        # Search through the ledger for blocks with a message hash that matches the signatory hash
-        idx, signatory = self.search(block.signatory_hash, match_block=False)
+    def validate_block(self, block, verified=False):
+        # Look up the signatory hash in the key state
+        signatory = self._view.key_state(block.signatory_hash)
 
         # Check that the most recent block was of type key (not revoke)
-        if signatory is not None and \
-                len(signatory) > 0 and \
-                signatory[0].blocktype is BlockType.key:
-            return block.validate(signatory[0].message)
+        if signatory is not None and signatory.active:
+            return verified or block.validate(signatory.public_key)
         else:
             return False
 
+    def __contains__(self, block_hash):
+        return block_hash in self._view
+
     def __len__(self):
-        return len(self._list)
+        return len(self._view)
@@ -1,5 +1,12 @@
 from privledge import settings
-from privledge import PrivledgeShell
+
+# Options given before the command: option -> (setting, type)
+OPTIONS = {
+    '--port': ('BIND_PORT', int),           # UDP and TCP port to listen on, so several nodes can share a host
+    '--hb-freq': ('MSG_HB_FREQ', float),    # Seconds between heartbeats
+    '--window': ('LEDGER_WINDOW', int),     # Keep only the last N blocks of each ledger in memory
+    '--cold-dir': ('LEDGER_COLD_DIR', str), # Where blocks outside the window are stored
+}
 
 
 # STARTUP
@@ -9,12 +16,32 @@ def main():
 
     # Debug on if argument present
     import sys
-    if len(sys.argv) > 1 and sys.argv[1] == 'debug':
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] == 'debug':
         settings.debug = True
         print("Debug mode is {}".format(settings.debug))
+        args = args[1:]
+
+    # eg `pls --window 10000 headless`
+    while len(args) > 1 and args[0] in OPTIONS:
+        name, type = OPTIONS[args[0]]
+        setattr(settings, name, type(args[1]))
+        args = args[2:]
+
+    # Run without a shell, controlled through a local socket: `pls headless [socket path] [query port]`
+    if len(args) > 0 and args[0] == 'headless':
+        from privledge import control
+        if len(args) > 2:
+            from privledge import daemon
+            daemon.query_endpoint(True, int(args[2]))
+        control.run(args[1] if len(args) > 1 else settings.CONTROL_SOCKET)
+        return
+
+    # Start up shell (imported here so that settings and argument handling stay cheap)
+    from privledge.shell import PrivledgeShell
 
-    # Start up shell
-    PrivledgeShell()
+    # Any remaining arguments are run as a single shell command, eg `pls key gen`
+    PrivledgeShell(' '.join(args) if len(args) > 0 else None)
 
 
 if __name__ == '__main__':
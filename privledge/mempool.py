@@ -0,0 +1,140 @@
+""" Pending block queue for a hosted ledger
+
+Producers (the shell, the control socket, any number of threads) submit blocks and get a future back. A single
+committer thread per ledger drains whatever has queued up, signs the batch in order on top of the current tail,
+appends it under the ledger's writer lock and then announces the new tail to peers once for the whole batch, so
+a burst of writes costs one lock hold and one heartbeat rather than one of each per block.
+"""
+
+from privledge import block
+from privledge import metrics
+from privledge import settings
+from privledge import utils
+
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+
+def _timestamp(tail):
+    # Never behind the tail, so a batch signed within one clock tick still reads in order
+    now = round(time.time(), 3)
+    return now if tail.timestamp is None else max(now, tail.timestamp)
+
+
+class Mempool(threading.Thread):
+    def __init__(self, node, batch=settings.MEMPOOL_BATCH, size=settings.MEMPOOL_SIZE):
+        super(Mempool, self).__init__()
+        utils.log_message("Starting Mempool Thread for {}".format(node.id))
+        self.daemon = True
+        self.stop = threading.Event()
+        self.node = node
+        self.batch = batch
+        self._queue = queue.Queue(size)
+        self._closed = False     # Set once the committer has stopped taking blocks
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def submit(self, blocktype, message, key):
+        """Queue a block for signing with key; returns a Future resolving to the block hash once committed.
+        Raises KeyError for an unknown blocktype. Blocks while the queue is full. Once the committer has stopped
+        the future fails straight away."""
+
+        item = (block.BlockType[blocktype], message, key, Future())
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+
+        # The committer fails what is queued when it stops; if it stopped around our put, fail it ourselves
+        if self._closed:
+            self._fail_queued()
+            if not item[3].done():
+                item[3].set_exception(ValueError('Left the ledger before the block was added'))
+
+        metrics.counter('mempool_submitted_total', 'Blocks submitted to the mempool').inc()
+        return item[3]
+
+    def _fail_queued(self):
+        while True:
+            try:
+                future = self._queue.get_nowait()[3]
+            except queue.Empty:
+                break
+            if not future.done():
+                future.set_exception(ValueError('Left the ledger before the block was added'))
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                try:
+                    pending = [self._queue.get(timeout=0.5)]
+                except queue.Empty:
+                    continue
+
+                # Take whatever else queued up while we waited, up to a batch
+                while len(pending) < self.batch:
+                    try:
+                        pending.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                try:
+                    self._commit(pending)
+                except Exception as e:
+                    # Whatever went wrong, no producer of this batch is left waiting
+                    utils.log_message("Mempool batch for {} failed: {!r}".format(self.node.id, e))
+                    for item in pending:
+                        if not item[3].done():
+                            item[3].set_exception(e)
+
+        finally:
+            # Fail anything still queued, and anything submitted from now on, so no producer waits forever
+            self._closed = True
+            self._fail_queued()
+
+    def _commit(self, pending):
+        start = time.perf_counter()
+        committed = 0
+        ledger = self.node.ledger
+
+        with ledger.lock:
+            for blocktype, message, key, future in pending:
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                try:
+                    new_block = block.Block(blocktype, ledger.tail.hash, message, timestamp=_timestamp(ledger.tail))
+                    new_block.sign(key)
+                    ledger.append(new_block)
+                except Exception as e:
+                    # A rejected block (ValueError) is routine; anything else, such as a failed signature
+                    # (RuntimeError), is logged, and either way only this block's producer hears about it
+                    if not isinstance(e, ValueError):
+                        utils.log_message("Could not commit a block to {}: {!r}".format(self.node.id, e))
+                    future.set_exception(e)
+                    continue
+
+                future.set_result(new_block.hash)
+                committed += 1
+
+        metrics.histogram('mempool_batch_blocks', 'Blocks committed per mempool batch',
+                          buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)).observe(committed)
+        metrics.histogram('mempool_batch_seconds', 'Time spent signing and committing a mempool batch')\
+            .observe(time.perf_counter() - start)
+
+        if committed > 0:
+            self._announce()
+
+    def _announce(self):
+        """Send the new tail to every live peer straight away instead of waiting for the next heartbeat"""
+        from privledge.messaging import UDPHeartbeat
+
+        tail = self.node.ledger.tail.hash
+        for target in list(self.node.peers.keys()):
+            UDPHeartbeat._send(target, {self.node.id: tail})
@@ -1,15 +1,29 @@
 import json
+import queue
+import random
 import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from socket import *
 
 from privledge import daemon
-from privledge import ledger
+from privledge import metrics
+from privledge import peers
+from privledge import profiling
 from privledge import settings
 from privledge import utils
 
 lock = threading.Lock()
+_busy_until = dict()    # Target address -> time before which it asked us not to send requests
+_responses = OrderedDict()  # (ledger id, ancestor hash, tail hash, limit) -> encoded ledger response
+_responses_lock = threading.Lock()
+_sync_lock = threading.Lock()   # Starting and finishing ChainSync threads
+
+
+def _observe_size(protocol, direction, size):
+    metrics.histogram('message_bytes', 'Size of messages on the wire', metrics.SIZE_BUCKETS,
+                      protocol=protocol, direction=direction).observe(size)
 
 
 # Message Class #
@@ -28,54 +42,275 @@ class Message:
         return self.__dict__
 
 
-# Send a request to the target with the block hash
-# Target should return all subsequent blocks not including source of block_hash
-def block_sync(target, block_hash=None):
-    utils.log_message("Requesting blocks from {0}".format(target), utils.Level.MEDIUM)
+def request(target, msg_type, msg=None):
+    """Send a TCP request and return the response Message. While a saturated target's retry-after time has
+    not passed, returns a busy Message without contacting it."""
+    tuple_target = tuple(target)
+    if time.time() < _busy_until.get(tuple_target, 0):
+        metrics.counter('tcp_requests_deferred_total', 'Requests not sent to a peer that asked us to back off').inc()
+        return Message(settings.MSG_TYPE_BUSY)
 
-    ledger_message = Message(settings.MSG_TYPE_LEDGER, block_hash).prep_tcp()
-    thread = TCPMessageThread(target, ledger_message)
+    start = time.perf_counter()
+    thread = TCPMessageThread(target, Message(msg_type, msg).prep_tcp())
     thread.start()
     thread.join()
 
+    # Every exchange feeds the peer table that sync sources are chosen from
+    if not thread.ok:
+        peers.failed(tuple_target)
+        return Message(settings.MSG_TYPE_FAILURE)
+    peers.observe_transfer(tuple_target, len(thread.message), time.perf_counter() - start)
+
     message = json.loads(thread.message, object_hook=utils.message_decoder)
+    if message.msg_type == settings.MSG_TYPE_BUSY:
+        _busy_until[tuple_target] = time.time() + message.msg.get("retry_after", settings.TCP_RETRY_AFTER)
+    else:
+        _busy_until.pop(tuple_target, None)
+    return message
+
+
+def ledger_response(node, ledger, ancestor, limit=None):
+    """Return the encoded response to a ledger request: the blocks of the ledger snapshot after ancestor (at
+    most limit of them), with the snapshot's height and tail so a peer taking pages knows how far it has to go.
+
+    The response is assembled from the blocks' cached wire encodings rather than serialized, and recent ones
+    are kept by (ancestor, tail), so peers catching up on the same new blocks after a heartbeat share one."""
+    key = (node.id, ancestor, ledger.tail.hash, limit)
+    with _responses_lock:
+        response = _responses.get(key)
+        if response is not None:
+            _responses.move_to_end(key)
+    metrics.counter('ledger_response_cache_total', 'Ledger responses served from the cache or assembled',
+                    result='miss' if response is None else 'hit').inc()
+    if response is not None:
+        return response
+
+    start = 0 if ancestor is None else ledger.position(ancestor) + 1
+    end = len(ledger) if limit is None else min(len(ledger), start + limit)
+    blocks = ledger[start:end]
+    response = utils.append_len(
+        '{{"msg_type": {}, "msg": {{"ancestor": {}, "height": {}, "tail": {}, "blocks": [{}]}}}}'.format(
+            json.dumps(settings.MSG_TYPE_SUCCESS), json.dumps(ancestor), len(ledger), json.dumps(ledger.tail.hash),
+            ', '.join(block.wire for block in blocks))).encode()
+
+    if len(blocks) <= settings.SYNC_CACHE_BLOCKS:
+        with _responses_lock:
+            _responses[key] = response
+            while len(_responses) > settings.SYNC_CACHE_SIZE:
+                _responses.popitem(last=False)
+    return response
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def fetch_range(target, ledger_id, since=None, until=None, limit=None):
+    """Return the target's blocks of a ledger timestamped from since up to until (seconds since the epoch,
+    either may be None) as (ancestor hash, blocks), oldest first and at most limit of them, or None if the
+    request failed. The range may take in a few untimestamped or out of order blocks at its ends. Blocks are
+    decoded but not verified or added to any ledger."""
+    from privledge.block import Block, LazyBlock
+
+    range_request = {"ledger": ledger_id, "since": since, "until": until}
+    if limit is not None:
+        range_request["limit"] = limit
+
+    message = request(target, settings.MSG_TYPE_LEDGER, range_request)
+    if message.msg_type != settings.MSG_TYPE_SUCCESS:
+        utils.log_message("Could not fetch blocks from {}: {}".format(target, message.msg_type))
+        return None
+
+    response = message.msg if isinstance(message.msg, dict) else dict()
+    ancestor, blocks = response.get("ancestor"), response.get("blocks", [])
+    try:
+        if not (ancestor is None or isinstance(ancestor, str)) or not isinstance(blocks, list):
+            raise ValueError('Not a ledger response')
+        blocks = [block.materialize() if isinstance(block, LazyBlock) else block for block in blocks]
+        if not all(isinstance(block, Block) for block in blocks):
+            raise ValueError('Not a list of blocks')
+    except ValueError as e:
+        utils.log_message("Peer {} sent an invalid ledger response: {}".format(target, e))
+        return None
+    return ancestor, blocks
 
-    # Add received blocks to our ledger
-    if daemon.ledger is None:
-        daemon.ledger = ledger.Ledger()
+
+# Send a request to the target with the ledger id and a locator of our chain
+# Target returns the last block we have in common and all of its blocks after it (or the first limit of them)
+# Returns the target's height, or None if the sync failed
+def block_sync(node, target, limit=None):
+    utils.log_message("Requesting blocks from {0}".format(target), utils.Level.MEDIUM)
+    start = time.perf_counter()
+
+    sync_request = {"ledger": node.id, "locator": node.ledger.snapshot().locator()}
+    if limit is not None:
+        sync_request["limit"] = limit
+    message = request(target, settings.MSG_TYPE_LEDGER, sync_request)
+
+    if message.msg_type != settings.MSG_TYPE_SUCCESS:
+        utils.log_message("Could not synchronize blocks from {}: {}".format(target, message.msg_type))
+        return None
+
+    response = message.msg if isinstance(message.msg, dict) else dict()
+    ancestor, blocks = response.get("ancestor"), response.get("blocks", [])
+    # The peer's height and tail are optional; without them a fork is judged on the blocks sent
+    height = response.get("height") if isinstance(response.get("height"), int) else None
+    tail = response.get("tail") if isinstance(response.get("tail"), str) else None
+    rebase = []
+
+    from privledge.block import Block, LazyBlock
+    if not isinstance(blocks, list) or not (ancestor is None or isinstance(ancestor, str)) or \
+            not all(isinstance(b, (Block, LazyBlock)) and isinstance(b.hash, str) for b in blocks):
+        utils.log_message("Peer {} sent a ledger response that is not a list of blocks".format(target))
+        peers.failed(target)
+        return None
 
     try:
-        for block in message.msg:
-            daemon.ledger.append(block)
+        with node.ledger.lock:
+            ledger = node.ledger.snapshot()
+
+            # Blocks arrive lazily decoded; the ones we already have are dropped on their hash alone
+            skip = 0
+            while skip < len(blocks) and blocks[skip].hash in ledger:
+                ancestor = blocks[skip].hash
+                skip += 1
+            if skip > 0:
+                metrics.counter('sync_blocks_duplicate_total', 'Blocks received through block_sync we already had')\
+                    .inc(skip)
+            blocks = blocks[skip:]
+
+            if len(blocks) == 0:
+                pass
+
+            elif ancestor is None and len(ledger) > 0:
+                raise ValueError('Peer has no block in common with our ledger', target)
+
+            elif ancestor is None or ancestor == ledger.tail.hash:
+                # Our tail is on the peer's chain: fast forward
+                for block in blocks:
+                    node.ledger.append(block)
+                metrics.counter('sync_blocks_total', 'Blocks appended through block_sync').inc(len(blocks))
+
+            else:
+                rebase = _resolve_fork(node, ledger, target, ancestor, blocks, height, tail)
+
     except ValueError as e:
+        metrics.counter('sync_errors_total', 'Block syncs aborted by a rejected block').inc()
         utils.log_message(e)
+        peers.failed(target)
+        height = None
+
+    else:
+        peers.succeeded(target)
+        if height is None:
+            height = len(node.ledger)
+
+    # Outside the lock: the mempool needs it to commit
+    for block in rebase:
+        daemon.submit_block(node, block.blocktype.name, block.message)
+    metrics.counter('sync_blocks_rebased_total', 'Blocks from a losing branch re-submitted on the winner')\
+        .inc(len(rebase))
+
+    metrics.histogram('block_sync_seconds', 'Duration of a block_sync round').observe(time.perf_counter() - start)
+
+    utils.log_message("Successfully synchronized {} block(s) from {}".format(len(blocks), target), utils.Level.HIGH)
+    return height
+
+
+def _resolve_fork(node, ledger, target, ancestor, blocks, height=None, tail=None):
+    """Both chains grew from ancestor: keep the branch fork choice picks. Returns our own blocks from a losing
+    branch, to be re-based onto the winner through the mempool. Called with the ledger's writer lock held.
+    height and tail describe the peer's whole chain when blocks is only the first page of its branch."""
+    from privledge.ledger import fork_wins
+
+    metrics.counter('sync_forks_total', 'Forks detected while synchronizing').inc()
+    pos = ledger.position(ancestor)
+    if pos is None:
+        raise ValueError('Peer sent a branch from a block we do not have', target, ancestor)
+    if height is None or tail is None:
+        height, tail = pos + 1 + len(blocks), blocks[-1].hash
+
+    if not fork_wins(len(ledger), ledger.tail.hash, height, tail):
+        # Keep ours; the peer switches when it syncs from us. Remember their tail so its heartbeats are ignored
+        utils.log_message("Fork with {} at {}: keeping our branch".format(target, ancestor), utils.Level.MEDIUM)
+        node.reject(tail)
+        return []
+
+    utils.log_message("Fork with {} at {}: switching to their branch".format(target, ancestor), utils.Level.MEDIUM)
+    try:
+        dropped = node.ledger.reorganize(ancestor, blocks)
+    except ValueError:
+        node.reject(tail)
+        raise
+
+    # Blocks we signed can be signed again on top of the new tail; blocks from other writers are re-based by
+    # their own nodes when they see the fork
+    key = node.privkey if node.privkey is not None else daemon.privkey
+    if key is None:
+        return []
+
+    key_hash = utils.key_hash(key)
+    kept = {(block.blocktype, block.message) for block in blocks}
+    return [block for block in dropped
+            if block.signatory_hash == key_hash and (block.blocktype, block.message) not in kept]
+
+
+# Ask the target for the peers it has added since the version of its peer list we last caught up to
+# Returns True if it has more to send than fitted in one response
+def peer_sync(node, target):
+    utils.log_message("Requesting peers from {0}".format(target), utils.Level.MEDIUM)
+    start = time.perf_counter()
+    target = tuple(target)
 
-    utils.log_message("Successfully synchronized {} block(s) from {}".format(len(message.msg), target), utils.Level.HIGH)
+    epoch, since = node.peer_seen.get(target, (None, 0))
+    message = request(target, settings.MSG_TYPE_PEER, {"ledger": node.id, "epoch": epoch, "since": since})
 
+    if message.msg_type != settings.MSG_TYPE_SUCCESS:
+        utils.log_message("Could not synchronize peers from {}: {}".format(target, message.msg_type))
+        return False
 
-def peer_sync(target):
-    utils.log_message("Requesting peers from {0}".format(target), utils.Level.MEDIUM)
+    if isinstance(message.msg, list):
+        # A node without versioned peer lists sends all of its peers
+        delta, more = message.msg, False
+    else:
+        delta, more = message.msg.get("peers", []), message.msg.get("more", False)
 
-    ledger_message = Message(settings.MSG_TYPE_PEER, None).prep_tcp()
-    thread = TCPMessageThread(target, ledger_message)
-    thread.start()
-    thread.join()
+    # Peers are (ip, port) addresses, so several nodes can share a host
+    learned = 0
+    for peer in delta:
+        if not is_self(tuple(peer)) and node.add_peer(tuple(peer)):
+            learned += 1
 
-    message = json.loads(thread.message, object_hook=utils.message_decoder)
+    node.add_peer(target)
+    peers.succeeded(target)
+    if isinstance(message.msg, dict):
+        node.peer_seen[target] = (message.msg.get("epoch"), message.msg.get("version", 0))
 
-    for peer in message.msg:
-        daemon.peers[peer] = datetime.now()
+    metrics.counter('peers_learned_total', 'Peers first learned of through peer exchange').inc(learned)
+    metrics.histogram('peer_sync_seconds', 'Duration of a peer_sync round').observe(time.perf_counter() - start)
+    utils.log_message("Synchronized {} peer(s) from {}, {} new".format(len(delta), target, learned),
+                      utils.Level.MEDIUM)
+    return more
 
-    daemon.peers[target[0]] = datetime.now()
 
-    utils.log_message("Successfully synchronized {} peer(s) from {}".format(len(message.msg), target), utils.Level.MEDIUM)
+def is_self(address):
+    """True if address is this node's own listener on the loopback interface"""
+    return address[1] == settings.BIND_PORT and address[0] in ('127.0.0.1', 'localhost')
 
 
 # TCP Thread Classes #
 
 # Persistent TCP Listener thread that listens for messages
 class TCPListener(threading.Thread):
-    def __init__(self, ip=settings.BIND_IP, port=settings.BIND_PORT):
+    """Accepts ledger connections and hands them to a bounded pool of worker threads.
+
+    Connections beyond what the pool can run or queue, or beyond a peer's share of it, are answered straight
+    away with a busy status and a retry-after time instead of being queued without limit. A connection only
+    shows the peer's ip, so an ip gets a share for every peer node known to listen on it: nodes sharing a host
+    or a NAT address do not turn each other away."""
+
+    def __init__(self, ip=settings.BIND_IP, port=settings.BIND_PORT, workers=settings.TCP_WORKERS,
+                 queued=settings.TCP_QUEUE, per_peer=settings.TCP_PER_PEER):
         super(TCPListener, self).__init__()
         with lock:
             utils.log_message("Starting TCP Listener Thread")
@@ -85,43 +320,134 @@ class TCPListener(threading.Thread):
         self.stop = threading.Event()
         self.stop.clear()
 
+        # Bind here so the port is open by the time the caller returns, and a busy port is reported once
         self.tcp_server_socket = socket(AF_INET, SOCK_STREAM)
+        try:
+            self.tcp_server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.tcp_server_socket.settimeout(0.5)
+            self.tcp_server_socket.bind((self._ip, self._port))
+            self.tcp_server_socket.listen(settings.TCP_BACKLOG)
+        except OSError as e:
+            print("Could not bind to port: {0}".format(e))
+            self.stop.set()
+
+        self._workers = workers
+        self._limit = workers + queued
+        self._per_peer = per_peer
+        self._active = 0
+        self._active_by_peer = dict()   # Peer ip -> connections being handled or queued
+        self._active_lock = threading.Lock()
+        self._rejected = queue.Queue()  # Turned away sockets, half closed, waiting for the peer to hang up
+        metrics.gauge('tcp_connections_active', 'Inbound TCP connections being handled or queued')\
+            .set_function(lambda: self._active)
 
     def run(self):
+        from concurrent.futures import ThreadPoolExecutor
+
         # Listen for ledger client connection requests
         with lock:
             utils.log_message("Listening for ledger messages on port {0}".format(self._port))
 
+        pool = ThreadPoolExecutor(self._workers, thread_name_prefix='TCPWorker')
+        drainer = threading.Thread(target=self._drain, name='TCPDrain', daemon=True)
+        drainer.start()
         try:
-            self.tcp_server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            self.tcp_server_socket.setblocking(False)
-            self.tcp_server_socket.bind((self._ip, self._port))
-            self.tcp_server_socket.listen(5)
-
-            # List for managing spawned threads
-            socket_threads = []
-
-            # Non-blocking socket loop that can be interrupted with a signal/event
-            while True and not self.stop.is_set():
+            # Accept loop with a timeout, so it can be interrupted with an event without spinning
+            while not self.stop.is_set():
+                profiling.checkpoint()
                 try:
                     client_socket, address = self.tcp_server_socket.accept()
+                except timeout:
+                    continue
 
-                    # Spawn thread
-                    client_thread = TCPConnectionThread(client_socket)
-                    client_thread.start()
-                    socket_threads.append(client_thread)
-
-                except Exception as e:
+                reason = self._admit(address[0])
+                if reason is not None:
+                    metrics.counter('tcp_connections_rejected_total', 'Inbound TCP connections turned away',
+                                    reason=reason).inc()
+                    self._reject(client_socket)
                     continue
 
-            # Clean up all the threads
-            for thread in socket_threads:
-                thread.join()
+                metrics.counter('tcp_connections_total', 'Inbound TCP connections accepted').inc()
+                client_socket.settimeout(settings.TCP_TIMEOUT)
+                pool.submit(self._handle, client_socket, address[0])
 
-        except Exception as e:
-            print("Could not bind to port: {0}".format(e))
         finally:
             self.tcp_server_socket.close()
+            pool.shutdown(wait=True)
+            drainer.join()
+
+    def _admit(self, peer):
+        """Count a new connection from peer in, or return why it must be turned away"""
+        with self._active_lock:
+            if self._active >= self._limit:
+                return 'saturated'
+            active = self._active_by_peer.get(peer, 0)
+            if active >= self._per_peer and active >= self._per_peer * self._nodes_at(peer):
+                return 'peer_limit'
+
+            self._active += 1
+            self._active_by_peer[peer] = self._active_by_peer.get(peer, 0) + 1
+            return None
+
+    @staticmethod
+    def _nodes_at(ip):
+        """The number of peer nodes of any ledger we host that listen on ip, at least 1"""
+        addresses = {address for node in list(daemon.nodes.values()) for address in list(node.peers)
+                     if address[0] == ip}
+        return max(1, len(addresses))
+
+    def _handle(self, client_socket, peer):
+        try:
+            TCPConnection(client_socket).run()
+        except Exception as e:
+            utils.log_message("Error handling connection from {}: {}".format(peer, e))
+            client_socket.close()
+        finally:
+            with self._active_lock:
+                self._active -= 1
+                self._active_by_peer[peer] -= 1
+                if self._active_by_peer[peer] == 0:
+                    del self._active_by_peer[peer]
+
+    def _reject(self, client_socket):
+        # Closing with the peer's request still unread would reset the connection and lose the busy reply, so
+        # the socket is half closed and left to the drain thread until the peer has read it and hung up
+        try:
+            busy = Message(settings.MSG_TYPE_BUSY, {"retry_after": settings.TCP_RETRY_AFTER}).prep_tcp()
+            client_socket.settimeout(1)
+            client_socket.sendall(busy.encode())
+            client_socket.shutdown(SHUT_WR)
+        except OSError:
+            client_socket.close()
+            return
+        self._rejected.put((client_socket, time.time() + settings.TCP_RETRY_AFTER))
+
+    def _drain(self):
+        """Read and discard what turned away peers send until they close, or until their deadline"""
+        from select import select
+
+        draining = dict()   # Socket -> deadline
+        while not self.stop.is_set() or len(draining) > 0:
+            try:
+                while True:
+                    client_socket, deadline = self._rejected.get(block=len(draining) == 0, timeout=0.5)
+                    draining[client_socket] = deadline
+            except queue.Empty:
+                pass
+            if len(draining) == 0:
+                continue
+
+            readable, _, _ = select(list(draining), [], [], 0.1)
+            now = time.time()
+            for client_socket in list(draining):
+                try:
+                    done = now >= draining[client_socket] or \
+                        (client_socket in readable and len(client_socket.recv(4096)) == 0)
+                except OSError:
+                    done = True
+                if done:
+                    del draining[client_socket]
+                    client_socket.close()
 
 
 # Generic outbound TCP connection handler
@@ -136,6 +462,7 @@ class TCPMessageThread(threading.Thread):
 
         self.message = message
         self._timeout = timeout
+        self.ok = False         # Set once a whole response has been received
 
     def run(self):
         tcp_message_socket = socket(AF_INET, SOCK_STREAM)
@@ -144,21 +471,12 @@ class TCPMessageThread(threading.Thread):
         try:
             tcp_message_socket.connect(self._target)
             tcp_message_socket.sendall(self.message.encode())
+            _observe_size('tcp', 'out', len(self.message))
 
             # Get response
             self.message = ''
-            message_size = None
-
-            while True:
-                if message_size is None:
-                    data = tcp_message_socket.recv(settings.MSG_SIZE_BYTES)
-                    # Convert first message size to an integer
-                    message_size = int(data.decode())
-                elif len(self.message) < message_size:
-                    data = tcp_message_socket.recv(4096)
-                    self.message += data.decode()
-                else:
-                    break
+            message_size, self.message = utils.read_message(tcp_message_socket)
+            _observe_size('tcp', 'in', message_size)
 
         except ValueError as e:
             with lock:
@@ -170,6 +488,7 @@ class TCPMessageThread(threading.Thread):
                     tcp_message_socket.getsockname()[0], self.message, e))
 
         else:
+            self.ok = True
             with lock:
                 utils.log_message(
                     "Received Response from {0} {1}: {2}{3}"
@@ -181,70 +500,117 @@ class TCPMessageThread(threading.Thread):
 
 
 # Generic inbound TCP connection handler
-class TCPConnectionThread(threading.Thread):
+class TCPConnection:
+    """Handles one inbound request; run on a TCPListener worker thread"""
+
     def __init__(self, socket):
-        super(TCPConnectionThread, self).__init__()
         with lock:
-            utils.log_message("Spawning TCP Connection Thread from {0}".format(socket.getsockname()))
+            utils.log_message("Handling TCP Connection from {0}".format(socket.getpeername()))
         self._socket = socket
 
     def run(self):
+        with profiling.thread_profile():
+            self._handle()
+
+    def _handle(self):
 
         # Get message
-        message = ''
-        message_size = None
         try:
-            while True:
-                if message_size is None:
-                    data = self._socket.recv(settings.MSG_SIZE_BYTES)
-                    # Convert first message size to an integer
-                    message_size = int(data.decode())
-                elif len(message) < message_size:
-                    data = self._socket.recv(4096)
-                    message += data.decode()
-                else:
-                    break
+            message_size, message = utils.read_message(self._socket)
         except ValueError as e:
-            utils.log_message('Received invalid packet from {0}'.format(self._socket.getsockname()))
+            utils.log_message('Received invalid packet from {0}: {1}'.format(self._socket.getsockname(), e))
+            self._socket.close()
             return
 
         with lock:
             utils.log_message("Received message from {0}:\n{1}".format(self._socket.getsockname(), message), utils.Level.MEDIUM)
+        _observe_size('tcp', 'in', message_size)
 
         message = json.loads(message, object_hook=utils.message_decoder)
+        metrics.counter('messages_received_total', 'Messages received by type', type=message.msg_type).inc()
 
         # JOIN LEDGER
         if message.msg_type == settings.MSG_TYPE_JOIN:
-            if message.msg == daemon.ledger.id:
+            node = daemon.nodes.get(message.msg)
+            if node is not None:
                 # Respond with success and the root key
-                response = Message(settings.MSG_TYPE_SUCCESS, daemon.ledger.root.message).prep_tcp()
+                response = Message(settings.MSG_TYPE_SUCCESS, node.ledger.root.message).prep_tcp()
                 self._respond(response)
                 return
             else:
                 self._respond_error()
                 return
         elif message.msg_type == settings.MSG_TYPE_PEER:
-            # Respond with list of peers
-            peer_list = list(daemon.peers.keys())
+            versioned = isinstance(message.msg, dict)
+            node = daemon.nodes.get(message.msg.get("ledger") if versioned else message.msg)
+            if node is None:
+                self._respond_error()
+                return
+
+            if not versioned:
+                # Respond with list of peers
+                peer_list = list(node.peers.keys())
+
+                target = self._socket.getsockname()
+                if target in peer_list:
+                    peer_list.remove(target)
+
+                response = Message(settings.MSG_TYPE_SUCCESS, peer_list).prep_tcp()
+                self._respond(response)
+                return
 
-            target = self._socket.getsockname()
-            if target in peer_list:
-                peer_list.remove(target)
+            # Respond with the peers added since the version the requester has, or from the start if our
+            # versions have restarted since it asked
+            since = message.msg.get("since")
+            if message.msg.get("epoch") != node.peer_epoch or not isinstance(since, int) or isinstance(since, bool):
+                since = 0
+            version, delta, more = node.peer_delta(since, settings.PEER_EXCHANGE_MAX)
 
-            response = Message(settings.MSG_TYPE_SUCCESS, peer_list).prep_tcp()
-            self._respond(response)
+            response = {"epoch": node.peer_epoch, "version": version, "peers": delta, "more": more}
+            self._respond(Message(settings.MSG_TYPE_SUCCESS, response).prep_tcp())
             return
 
         elif message.msg_type == settings.MSG_TYPE_LEDGER:
-            # Respond with the ledger
-            ledger_list = daemon.ledger.slice_ledger(message.msg)
+            node = daemon.nodes.get(message.msg.get("ledger")) if isinstance(message.msg, dict) else None
+            if node is None:
+                self._respond_error()
+                return
+
+            # Respond with the blocks after the first locator hash we have (the last block in common)
+            ledger = node.ledger.snapshot()
+            ancestor = next((h for h in message.msg.get("locator", []) if h in ledger), None)
+            limit = message.msg.get("limit")
+            if not isinstance(limit, int) or limit <= 0:
+                limit = None
+
+            # Time range variant: the blocks timestamped from since up to until, with the block before them as
+            # the ancestor (the range may take in a few untimestamped or out of order blocks at its ends)
+            since, until = _number(message.msg.get("since")), _number(message.msg.get("until"))
+            if since is not None or until is not None:
+                start, end = ledger.time_bounds(since, until)
+                ancestor = ledger[start - 1].hash if start > 0 else None
+                limit = end - start if limit is None else min(limit, end - start)
+
+            self._respond(ledger_response(node, ledger, ancestor, limit))
+            return
 
-            if ledger_list is None:
+        elif message.msg_type == settings.MSG_TYPE_BLOB:
+            # A chunk (or manifest) of the blob store, to members of a ledger we host. The store is shared by every
+            # ledger we host, so only chunks of blobs this ledger refers to are served
+            request_msg = message.msg if isinstance(message.msg, dict) else dict()
+            ledger_id, root, chunk_hash = request_msg.get("ledger"), request_msg.get("root"), request_msg.get("hash")
+            node = daemon.nodes.get(ledger_id) if isinstance(ledger_id, str) else None
+            store = daemon.blob_store()
+
+            data = None
+            if node is not None and node.ledger.snapshot().references_blob(root) and store.contains(root, chunk_hash):
+                data = store.read(chunk_hash)
+            if data is None:
                 self._respond_error()
                 return
 
-            response = Message(settings.MSG_TYPE_SUCCESS, ledger_list).prep_tcp()
-            self._respond(response)
+            import base64
+            self._respond(Message(settings.MSG_TYPE_SUCCESS, base64.b64encode(data).decode()).prep_tcp())
             return
 
         # No response, send error status
@@ -260,7 +626,9 @@ class TCPConnectionThread(threading.Thread):
         with lock:
             utils.log_message("Responded with message to {}".format(self._socket.getsockname()))
             utils.log_message(message, utils.Level.MEDIUM)
-        self._socket.sendall(message.encode())
+        data = message if isinstance(message, bytes) else message.encode()
+        self._socket.sendall(data)
+        _observe_size('tcp', 'out', len(data))
         self._socket.shutdown(SHUT_WR)
         self._socket.recv(4096)
         self._socket.close()
@@ -290,49 +658,181 @@ class UDPListener(threading.Thread):
 
         # Non-blocking socket loop that can be interrupted with a signal/event
         while True and not self.stop.is_set():
+            profiling.checkpoint()
             try:
-                data, addr = discovery_socket.recvfrom(1024)
+                data, addr = discovery_socket.recvfrom(settings.MSG_UDP_BYTES)
             except OSError as e:
                 continue
             else:
-                message = json.loads(data.decode(), object_hook=utils.message_decoder)
-                # Decode Message Type
-                if message.msg_type == settings.MSG_TYPE_DISCOVER:
-                    # Discovery Message
+                # A datagram can come from anyone, so one that is malformed is dropped rather than allowed to
+                # stop discovery and heartbeats
+                try:
+                    self._datagram(discovery_socket, data, addr)
+                except Exception as e:
+                    metrics.counter('udp_messages_dropped_total', 'UDP messages dropped as malformed').inc()
                     with lock:
-                        utils.log_message("Received discovery inquiry from {0}, responding...".format(addr),
-                                          utils.Level.MEDIUM)
-                    response = Message(settings.MSG_TYPE_SUCCESS, daemon.ledger.id).__repr__()
-                    discovery_socket.sendto(response.encode(), addr)
+                        utils.log_message("Dropped malformed UDP message from {0}: {1}".format(addr, e))
 
-                elif message.msg_type == settings.MSG_TYPE_HB:
-                    # Heartbeat Message
-                    if "ledger" in message.msg and message.msg["ledger"] == daemon.ledger.id:
+        discovery_socket.close()
 
-                        # Add the source address and port to our list of peers and update the date
-                        daemon.peers[addr[0]] = datetime.now()
+    def _datagram(self, discovery_socket, data, addr):
+        _observe_size('udp', 'in', len(data))
+        message = json.loads(data.decode(), object_hook=utils.message_decoder)
+        if not isinstance(message, Message):
+            raise ValueError('Not a message')
+        metrics.counter('messages_received_total', 'Messages received by type', type=message.msg_type).inc()
+        fields = message.msg if isinstance(message.msg, dict) else dict()
+
+        # Decode Message Type
+        if message.msg_type == settings.MSG_TYPE_DISCOVER:
+            # Discovery Message
+            with lock:
+                utils.log_message("Received discovery inquiry from {0}, responding...".format(addr),
+                                  utils.Level.MEDIUM)
+
+            # Answer once for every ledger we host
+            for ledger_id in list(daemon.nodes.keys()):
+                response = Message(settings.MSG_TYPE_SUCCESS, ledger_id).__repr__()
+                discovery_socket.sendto(response.encode(), addr)
+
+        elif message.msg_type == settings.MSG_TYPE_HB:
+            # Heartbeat Message, batched across every ledger the peer shares with us
+            ledgers, port = fields.get("ledgers"), fields.get("port", settings.BIND_PORT)
+            if not isinstance(ledgers, dict) or not isinstance(port, int) or isinstance(port, bool) or \
+                    not 0 < port < 65536:
+                raise ValueError('Heartbeat without valid ledgers and port')
+
+            # Heartbeats are sent from an ephemeral port; the peer listens on the port it announces
+            peer = (addr[0], port)
+            self._heartbeat(ledgers, peer)
+
+            # Echo the send time back to the peer's listener so it can measure the round trip
+            if _number(fields.get("sent")) is not None:
+                ack = Message(settings.MSG_TYPE_HB_ACK, {"sent": fields["sent"]}).__repr__()
+                discovery_socket.sendto(ack.encode(), peer)
 
-                        # Possible Scenarios:
-                        # Heartbeat tail is same as local tail: Do nothing (in sync)
-                        # Heartbeat tail is in our ledger: Do nothing (out of sync)
-                        # Heartbeat tail is not in our ledger: Synchronize with peer (out of sync)
-                        if "tail" in message.msg:
-                            tail = message.msg["tail"]
+            with lock:
+                utils.log_message("Received heartbeat from {0}".format(addr), utils.Level.LOW)
+
+        elif message.msg_type == settings.MSG_TYPE_HB_ACK:
+            # Heartbeat acknowledgement carries our own send time, so no clock sync is needed
+            sent = _number(fields.get("sent"))
+            if sent is not None:
+                rtt = time.time() - sent
+                metrics.histogram('heartbeat_rtt_seconds', 'Heartbeat round trip time').observe(rtt)
+                peers.observe_rtt(addr, rtt)
+
+    @staticmethod
+    def _heartbeat(ledgers, addr):
+        for ledger_id, tail in ledgers.items():
+            if not isinstance(tail, str):
+                continue
+            node = daemon.nodes.get(ledger_id)
+            if node is None:
+                continue
 
-                            # Check for presence of heartbeat tail in our ledger
-                            idx, blocks = daemon.ledger.search(tail)
+            # Add the source address and port to our list of peers and update the date
+            node.add_peer(addr)
+            node.peer_tails[addr] = tail
+
+            # Possible Scenarios:
+            # Heartbeat tail is same as local tail: Do nothing (in sync)
+            # Heartbeat tail is in our ledger: Do nothing (out of sync)
+            # Heartbeat tail is not in our ledger: Synchronize with peer (out of sync, or forked)
+            # Heartbeat tail lost a fork against our branch: Do nothing (the peer switches to ours)
+            # A node already streaming its chain leaves catching up to that
+            # Every peer announcing this tail can send it to us, so start from the best of them. Catching up goes
+            # a page at a time on its own thread, so it never holds a long chain in one response or stalls
+            # heartbeats
+            if node.sync is None and tail not in node.ledger and tail not in node.rejected:
+                chain_sync(node, peers.best([p for p, t in list(node.peer_tails.items()) if t == tail]),
+                           len(node.ledger) + 1)
+
+
+def chain_sync(node, target, height):
+    """Stream the chain from target up to at least height on a ChainSync thread, unless the node already has
+    one running; returns the node's ChainSync"""
+    with _sync_lock:
+        if node.sync is None:
+            node.sync = ChainSync(node, target, height)
+            node.sync.start()
+        return node.sync
+
+
+# Streams a ledger's chain a page at a time, after a join or once heartbeats show we are behind, so the node
+# keeps heartbeating while it catches up. Each page comes from the best ranked of the member (the peer we
+# started from) and the peers announcing tails we lack.
+class ChainSync(threading.Thread):
+    def __init__(self, node, target, height):
+        super(ChainSync, self).__init__()
+        with lock:
+            utils.log_message("Starting Chain Sync Thread for {}".format(node.id))
+        self.daemon = True
+        self.stop = threading.Event()
+        self.node = node
+        self.member = tuple(target)
+        self.target = self.member   # The source of the last page
+        self.height = height        # The source's height as of the last page
 
-                            # If heartbeat tail is in our ledger, do nothing
-                            # If heartbeat tail isn't in our ledger, synchronize with peer
-                            if len(idx) <= 0:
-                                block_sync((addr[0], settings.BIND_PORT), daemon.ledger.tail.hash)
+    def _sources(self):
+        """The member and every peer whose last announced tail we do not have yet"""
+        ahead = [p for p, t in list(self.node.peer_tails.items())
+                 if t not in self.node.ledger and t not in self.node.rejected]
+        return [self.member] + ahead
 
+    def run(self):
+        while not self.stop.is_set() and len(self.node.ledger) < self.height:
+            # Sources that asked us to back off are skipped until their retry-after time
+            sources = self._sources()
+            ready = [s for s in sources if time.time() >= _busy_until.get(s, 0)]
+            if len(ready) == 0:
+                self.stop.wait(min(_busy_until.get(s, 0) for s in sources) - time.time())
+                continue
 
+            self.target = peers.best(ready)
+            if peers.get(self.target).backing_off:
+                # Every source is failing; heartbeats take over from here
+                break
 
-                        with lock:
-                            utils.log_message("Received heartbeat from {0}".format(addr), utils.Level.LOW)
+            before = len(self.node.ledger)
+            height = block_sync(self.node, self.target, settings.SYNC_PAGE_BLOCKS)
+            if height is None:
+                # Busy or failed: the source is skipped or demoted and the next page comes from another
+                continue
+            if len(self.node.ledger) == before:
+                if self.target == self.member:
+                    # The member has nothing more for us; heartbeats take over from here
+                    break
+                # A peer whose tail lost fork choice or turned out to be ours drops out of the sources
+                continue
+            self.height = max(self.height, height)
+
+        with _sync_lock:
+            if self.node.sync is self:
+                self.node.sync = None
+        utils.log_message("Chain sync for {} finished at {} block(s)".format(self.node.id, len(self.node.ledger)))
 
-        discovery_socket.close()
+
+# Persistent peer exchange thread; gossips peer list changes with a few random peers of each ledger every few
+# heartbeats, so membership spreads in O(log N) rounds without whole peer lists being sent over and over
+class PeerExchange(threading.Thread):
+    def __init__(self):
+        super(PeerExchange, self).__init__()
+        with lock:
+            utils.log_message("Starting Peer Exchange Thread")
+        self.daemon = True
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.wait(settings.MSG_HB_FREQ * settings.PEER_EXCHANGE_INTERVAL):
+            profiling.checkpoint()
+
+            for node in list(daemon.nodes.values()):
+                targets = list(node.peers.keys())
+                for target in random.sample(targets, min(settings.PEER_EXCHANGE_FANOUT, len(targets))):
+                    if self.stop.is_set():
+                        return
+                    peer_sync(node, target)
 
 
 # Persistent UDP Heartbeat Thread; sends hb to peers
@@ -348,27 +848,46 @@ class UDPHeartbeat(threading.Thread):
 
         # Loop through the list of peers and send heartbeat messages
         while True and not self.stop.is_set():
+            profiling.checkpoint()
 
-            for target, last_beat in list(daemon.peers.items()):
-
-                if (last_beat + timedelta(seconds=settings.MSG_HB_TTL)) < datetime.now():
-                    # Check for dead peers
-                    with lock:
-                        utils.log_message("Removing dead peer {0}".format(target), utils.Level.MEDIUM)
-
-                    del daemon.peers[target]
-                else:
-                    # Send heartbeat with root id and tail id to peers
-                    s = socket(AF_INET, SOCK_DGRAM)
+            # Collect the tails of every ledger each live peer shares with us, so a peer gets one heartbeat
+            # for all of them
+            batches = dict()
+            for node in list(daemon.nodes.values()):
+                for target, last_beat in list(node.peers.items()):
 
-                    message_body = {"ledger": daemon.ledger.id,
-                                    "tail": daemon.ledger.tail.hash}
+                    if (last_beat + timedelta(seconds=settings.MSG_HB_TTL)) < datetime.now():
+                        # Check for dead peers
+                        with lock:
+                            utils.log_message("Removing dead peer {0} from {1}".format(target, node.id),
+                                              utils.Level.MEDIUM)
 
-                    message = Message(settings.MSG_TYPE_HB, message_body).__repr__()
+                        node.remove_peer(target)
+                    else:
+                        batches.setdefault(target, dict())[node.id] = node.ledger.tail.hash
 
-                    s.sendto(message.encode(), (target, settings.BIND_PORT))
-                    utils.log_message("Heartbeat sent to {0}".format(target), utils.Level.LOW)
-                    s.close()
+            for target, ledgers in batches.items():
+                self._send(target, ledgers)
 
             # Sleep the required time between heartbeats
             time.sleep(settings.MSG_HB_FREQ)
+
+    @staticmethod
+    def _send(target, ledgers):
+        # Send heartbeats with root id and tail id to peers, splitting very large batches over several datagrams
+        s = socket(AF_INET, SOCK_DGRAM)
+        items = list(ledgers.items())
+
+        for i in range(0, len(items), settings.MSG_HB_BATCH):
+            message_body = {"ledgers": dict(items[i:i+settings.MSG_HB_BATCH]),
+                            "port": settings.BIND_PORT,
+                            "sent": time.time()}
+
+            message = Message(settings.MSG_TYPE_HB, message_body).__repr__()
+
+            s.sendto(message.encode(), target)
+            _observe_size('udp', 'out', len(message))
+            metrics.counter('heartbeats_sent_total', 'Heartbeat datagrams sent to peers').inc()
+
+        utils.log_message("Heartbeat sent to {0} for {1} ledger(s)".format(target, len(items)), utils.Level.LOW)
+        s.close()
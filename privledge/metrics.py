@@ -0,0 +1,302 @@
+""" Lightweight runtime metrics registry (counters, gauges and histograms) with a Prometheus-like text exposition
+"""
+
+from privledge import settings
+from privledge import utils
+
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+# Default histogram buckets, in seconds (latencies)
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Default histogram buckets, in bytes (message sizes)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_lock = threading.Lock()
+_registry = dict()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = 0
+
+    def samples(self):
+        return [(self.name, self.labels, self._value)]
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._value = 0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Evaluate the gauge lazily by calling function whenever it is read"""
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                return 0
+        return self._value
+
+    def reset(self):
+        if self._function is None:
+            self.set(0)
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help='', labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._count += 1
+            self._sum += value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def sum(self):
+        return self._sum
+
+    @property
+    def max(self):
+        return self._max
+
+    @property
+    def mean(self):
+        return self._sum / self._count if self._count > 0 else 0
+
+    def percentile(self, p):
+        """Estimate the p-th percentile (0-100) as the upper bound of the bucket it falls in"""
+        if self._count == 0:
+            return 0
+
+        rank = p / 100.0 * self._count
+        cumulative = 0
+        for i, count in enumerate(self._counts):
+            cumulative += count
+            if cumulative >= rank and count > 0:
+                return min(self.buckets[i], self._max) if i < len(self.buckets) else self._max
+        return self._max
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._count = 0
+            self._sum = 0
+            self._max = None
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self._counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', self.labels + (('le', bound),), cumulative))
+        samples.append((self.name + '_sum', self.labels, self._sum))
+        samples.append((self.name + '_count', self.labels, self._count))
+        return samples
+
+
+def _get(cls, name, help, labels, **kwargs):
+    key = _key(name, labels)
+    metric = _registry.get(key)
+    if metric is None:
+        with _lock:
+            metric = _registry.get(key)
+            if metric is None:
+                metric = cls(name, help, key[1], **kwargs)
+                _registry[key] = metric
+    return metric
+
+
+def counter(name, help='', **labels):
+    return _get(Counter, name, help, labels)
+
+
+def gauge(name, help='', **labels):
+    return _get(Gauge, name, help, labels)
+
+
+def histogram(name, help='', buckets=TIME_BUCKETS, **labels):
+    return _get(Histogram, name, help, labels, buckets=buckets)
+
+
+def reset():
+    """Zero every registered metric; function gauges are left alone"""
+    for metric in list(_registry.values()):
+        metric.reset()
+
+
+def render():
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    described = set()
+
+    for metric in sorted(list(_registry.values()), key=lambda m: (m.name, m.labels)):
+        name = settings.METRICS_PREFIX + metric.name
+        if name not in described:
+            described.add(name)
+            if metric.help:
+                lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+
+        for sample_name, labels, value in metric.samples():
+            lines.append('{}{}{} {}'.format(settings.METRICS_PREFIX, sample_name, _format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def values():
+    """Return {sample name with labels: value} for every sample of every registered metric"""
+    result = dict()
+    for metric in list(_registry.values()):
+        for sample_name, labels, value in metric.samples():
+            result[sample_name + _format_labels(labels)] = value
+    return result
+
+
+def summary():
+    """Return human readable lines describing every registered metric"""
+    lines = []
+
+    for metric in sorted(list(_registry.values()), key=lambda m: (m.kind, m.name, m.labels)):
+        name = metric.name + _format_labels(metric.labels)
+        if isinstance(metric, Histogram):
+            if metric.count == 0:
+                continue
+            if metric.name.endswith('_seconds'):
+                fmt = '{:.2f}ms'
+                scale = 1000
+            else:
+                fmt = '{:.0f}'
+                scale = 1
+            lines.append('{}: count={} mean={} p50={} p95={} p99={} max={}'.format(
+                name, metric.count,
+                fmt.format(metric.mean * scale),
+                fmt.format(metric.percentile(50) * scale),
+                fmt.format(metric.percentile(95) * scale),
+                fmt.format(metric.percentile(99) * scale),
+                fmt.format(metric.max * scale)))
+        else:
+            lines.append('{}: {}'.format(name, metric.value))
+
+    return lines
+
+
+# Local text endpoint #
+
+def _handler_class():
+    # http.server is only needed once the endpoint is started
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            utils.log_message("Metrics request from {}: {}".format(self.address_string(), format % args),
+                              utils.Level.LOW)
+
+    return MetricsHandler
+
+
+class MetricsServer(threading.Thread):
+    def __init__(self, ip=settings.METRICS_BIND_IP, port=settings.METRICS_PORT):
+        from http.server import HTTPServer
+
+        super(MetricsServer, self).__init__()
+        utils.log_message("Starting Metrics Server Thread")
+        self.daemon = True
+        self.stop = threading.Event()
+
+        # Bind here so port errors are raised to the caller
+        self._server = HTTPServer((ip, port), _handler_class())
+        self._server.timeout = 0.5
+        self.address = self._server.server_address
+
+    def run(self):
+        utils.log_message("Serving metrics on {0}:{1}".format(*self.address))
+        try:
+            while not self.stop.is_set():
+                self._server.handle_request()
+        finally:
+            self._server.server_close()
@@ -0,0 +1,111 @@
+""" Peer performance table for choosing sync sources
+
+Every peer address we exchange messages with gets a Peer record, shared by all the ledgers it serves:
+
+    rtt          smoothed heartbeat round trip time, measured from heartbeat acknowledgements
+    throughput   smoothed bytes per second of its larger responses to our TCP requests
+    failures     requests in a row that failed or sent blocks we rejected; each one doubles the time the peer
+                 is passed over, up to PEER_BACKOFF_MAX. Only a response we accept clears them
+
+rank() orders candidate peers by the time each is expected to take to send a sync page, so catch-up prefers
+the nearest and fastest replicas. A peer that has not been measured yet is assumed to be average, and peers
+backing off go last rather than being dropped, so a lone peer is still tried.
+"""
+
+from privledge import metrics
+from privledge import settings
+
+import threading
+import time
+
+
+class Peer:
+    def __init__(self, address):
+        self.address = address
+        self.rtt = None             # Seconds
+        self.throughput = None      # Bytes per second
+        self.failures = 0
+        self.backoff_until = 0
+
+    @property
+    def backing_off(self):
+        return time.time() < self.backoff_until
+
+    def score(self):
+        """Expected seconds to send us PEER_SCORE_BYTES; lower is better"""
+        rtt = self.rtt if self.rtt is not None else settings.PEER_DEFAULT_RTT
+        throughput = self.throughput if self.throughput is not None else settings.PEER_DEFAULT_THROUGHPUT
+        return rtt + settings.PEER_SCORE_BYTES / throughput
+
+    def repr_json(self):
+        return {'address': list(self.address),
+                'rtt': self.rtt,
+                'throughput': self.throughput,
+                'failures': self.failures,
+                'backoff': max(0.0, self.backoff_until - time.time()),
+                'score': self.score()}
+
+
+_table = dict()     # Address -> Peer
+_lock = threading.Lock()
+
+
+def get(address):
+    """Return the Peer record of an address, creating it on first use"""
+    address = tuple(address)
+    with _lock:
+        peer = _table.get(address)
+        if peer is None:
+            peer = _table[address] = Peer(address)
+        return peer
+
+
+def _smooth(previous, sample):
+    if previous is None:
+        return sample
+    return previous + settings.PEER_SMOOTHING * (sample - previous)
+
+
+def observe_rtt(address, seconds):
+    peer = get(address)
+    peer.rtt = _smooth(peer.rtt, max(0.0, seconds))
+
+
+def observe_transfer(address, size, seconds):
+    """Record the time a response took to arrive. Only responses of PEER_MIN_TRANSFER bytes or more say anything
+    about throughput; smaller ones are dominated by the round trip. Whether the response was any good is up to
+    the caller (see succeeded and failed)."""
+    peer = get(address)
+    if size >= settings.PEER_MIN_TRANSFER and seconds > 0:
+        peer.throughput = _smooth(peer.throughput, size / seconds)
+
+
+def succeeded(address):
+    """Clear a peer's failures once a response from it has been accepted"""
+    peer = get(address)
+    peer.failures = 0
+    peer.backoff_until = 0
+
+
+def failed(address):
+    """Demote a peer: pass it over for PEER_BACKOFF seconds, doubling with every failure in a row"""
+    peer = get(address)
+    peer.failures += 1
+    peer.backoff_until = time.time() + min(settings.PEER_BACKOFF_MAX,
+                                           settings.PEER_BACKOFF * 2 ** (peer.failures - 1))
+    metrics.counter('peer_failures_total', 'Requests to peers that failed or sent blocks we rejected').inc()
+
+
+def rank(addresses):
+    """Return addresses best first: peers not backing off by score, then the others by when they may be tried
+    again"""
+    records = [get(address) for address in set(tuple(a) for a in addresses)]
+    ready = sorted((peer for peer in records if not peer.backing_off), key=Peer.score)
+    waiting = sorted((peer for peer in records if peer.backing_off), key=lambda peer: peer.backoff_until)
+    return [peer.address for peer in ready + waiting]
+
+
+def best(addresses):
+    """Return the best of addresses, or None if there are none"""
+    ranked = rank(addresses)
+    return ranked[0] if len(ranked) > 0 else None
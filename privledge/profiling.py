@@ -0,0 +1,160 @@
+""" On-demand CPU (cProfile) and memory (tracemalloc) profiling of a running node
+"""
+
+from privledge import settings
+from privledge import utils
+
+from contextlib import contextmanager
+import io
+import threading
+import time
+
+# cProfile, pstats and tracemalloc are imported when profiling is first requested
+
+_lock = threading.Lock()
+_active = threading.Event()
+_profilers = dict()     # Thread name -> cProfile.Profile currently collecting
+_finished = []          # Profiles whose thread stopped collecting (or exited)
+_snapshot = None        # tracemalloc baseline for diffs
+
+
+# CPU Profiling #
+
+def checkpoint():
+    """Called by long-running threads on every loop iteration.
+    cProfile can only be switched on or off from the thread being profiled, so each thread enables or
+    disables its own profiler here when profiling is toggled from the shell."""
+
+    name = threading.current_thread().name
+
+    if _active.is_set():
+        if name not in _profilers:
+            import cProfile
+            profiler = cProfile.Profile()
+            with _lock:
+                _profilers[name] = profiler
+            profiler.enable()
+
+    elif name in _profilers:
+        with _lock:
+            profiler = _profilers.pop(name)
+        profiler.disable()
+        with _lock:
+            _finished.append(profiler)
+
+
+@contextmanager
+def thread_profile():
+    """Profile a short-lived thread (eg a TCP connection) for its lifetime if profiling is active"""
+
+    checkpoint()
+    try:
+        yield
+    finally:
+        name = threading.current_thread().name
+        if name in _profilers:
+            with _lock:
+                profiler = _profilers.pop(name)
+            profiler.disable()
+            with _lock:
+                _finished.append(profiler)
+
+
+def cpu_active():
+    return _active.is_set()
+
+
+def cpu_start():
+    global _finished
+
+    with _lock:
+        _finished = []
+    _active.set()
+    utils.log_message("CPU profiling started", utils.Level.FORCE)
+
+
+def cpu_stop(timeout=settings.MSG_HB_FREQ + 1):
+    """Stop profiling and return the merged pstats.Stats, or None if no thread reported any data.
+    Waits up to timeout seconds for threads to reach their next checkpoint and hand in their profile."""
+
+    _active.clear()
+
+    deadline = time.time() + timeout
+    while len(_profilers) > 0 and time.time() < deadline:
+        time.sleep(0.05)
+
+    with _lock:
+        profiles = list(_finished)
+        if len(_profilers) > 0:
+            utils.log_message("Threads did not report in time: {}".format(', '.join(_profilers.keys())))
+
+    if len(profiles) == 0:
+        return None
+
+    import pstats
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+    return stats
+
+
+def format_stats(stats, sort='cumulative', limit=25):
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+# Memory Profiling #
+
+def mem_active():
+    import tracemalloc
+    return tracemalloc.is_tracing()
+
+
+def mem_start(frames=1):
+    global _snapshot
+    import tracemalloc
+
+    _snapshot = None
+    tracemalloc.start(frames)
+    utils.log_message("Memory tracing started ({} frame(s))".format(frames), utils.Level.FORCE)
+
+
+def mem_stop():
+    global _snapshot
+    import tracemalloc
+
+    _snapshot = None
+    tracemalloc.stop()
+
+
+def mem_snapshot(limit=10, key_type='lineno'):
+    """Take a snapshot, keep it as the baseline for mem_diff and return the top allocation sites"""
+    global _snapshot
+    import tracemalloc
+
+    _snapshot = _filter(tracemalloc.take_snapshot())
+    return _snapshot.statistics(key_type)[:limit]
+
+
+def mem_diff(limit=10, key_type='lineno'):
+    """Compare a new snapshot to the baseline and return the top growing allocation sites"""
+    global _snapshot
+    import tracemalloc
+
+    if _snapshot is None:
+        return mem_snapshot(limit, key_type)
+
+    current = _filter(tracemalloc.take_snapshot())
+    stats = current.compare_to(_snapshot, key_type)[:limit]
+    _snapshot = current
+    return stats
+
+
+def _filter(snapshot):
+    import tracemalloc
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
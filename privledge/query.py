@@ -0,0 +1,173 @@
+""" Read-only local HTTP/JSON query server for applications that only read the ledger
+
+    GET /ledgers                            hosted ledgers with their height and tail
+    GET /ledgers/<id>/tail                  the tail block
+    GET /ledgers/<id>/blocks/<hash>         a block by hash
+    GET /ledgers/<id>/blocks?start=i&end=j  blocks i (inclusive) to j (exclusive) by height; negative heights
+                                            count back from the tail, so start=-10 is the last ten blocks
+    GET /ledgers/<id>/blocks?since=t&until=u  blocks timestamped from t up to u (seconds since the epoch)
+    GET /ledgers/<id>/keys                  keys that are currently active
+
+Ledger ids may be given as a unique prefix. Responses carry an ETag tied to the ledger tail (or the block hash
+for single blocks, which never change) and honour If-None-Match, and serialized responses are cached until the
+tail moves (single blocks until a reorganization drops them from the chain), so polling readers cost a
+dictionary lookup and never touch the consensus path.
+"""
+
+from privledge import daemon
+from privledge import settings
+from privledge import utils
+
+from collections import OrderedDict
+import json
+import threading
+
+_cache = OrderedDict()      # (ledger id, path) -> (etag, body)
+_cache_lock = threading.Lock()
+
+
+class NotFound(Exception):
+    pass
+
+
+def _block_json(block, height):
+    result = json.loads(block.__repr__())
+    result['hash'] = block.hash
+    result['height'] = height
+    return result
+
+
+def _render(ledger, parts, params):
+    """Return (etag, result) for a ledger resource"""
+    tail = ledger.tail.hash
+
+    if parts == ['tail']:
+        return tail, _block_json(ledger.tail, len(ledger) - 1)
+
+    elif parts == ['keys']:
+        return tail, [{'hash': h, 'key': block.message} for h, block in ledger.active_keys().items()]
+
+    elif len(parts) == 2 and parts[0] == 'blocks':
+        idx, blocks = ledger.search(parts[1])
+        if len(blocks) == 0:
+            raise NotFound(parts[1])
+        # Blocks are immutable, so their hash is a permanent ETag
+        return parts[1], _block_json(blocks[0], idx[0])
+
+    elif parts == ['blocks'] and ('since' in params or 'until' in params):
+        since = float(params['since']) if 'since' in params else None
+        until = float(params['until']) if 'until' in params else None
+        idx, blocks = ledger.time_range(since, until, settings.QUERY_MAX_RANGE)
+        return tail, [_block_json(block, i) for i, block in zip(idx, blocks)]
+
+    elif parts == ['blocks']:
+        # Bounds are normalized against this snapshot like slice indices, so heights match the blocks returned
+        start, end, _ = slice(int(params.get('start', 0)), int(params.get('end', len(ledger)))).indices(len(ledger))
+        end = min(end, start + settings.QUERY_MAX_RANGE)
+        return tail, [_block_json(block, start + i) for i, block in enumerate(ledger[start:end])]
+
+    raise NotFound('/'.join(parts))
+
+
+def respond(path):
+    """Return (status, etag, body bytes) for a request path, serving from the cache while the tail is unchanged"""
+    from urllib.parse import urlsplit, parse_qsl
+
+    url = urlsplit(path)
+    parts = [part for part in url.path.split('/') if len(part) > 0]
+    params = dict(parse_qsl(url.query))
+
+    if parts == ['ledgers']:
+        views = [(node.id, node.ledger.snapshot()) for node in list(daemon.nodes.values())]
+        body = [{'ledger': id, 'height': len(view), 'tail': view.tail.hash} for id, view in views]
+        return 200, None, json.dumps(body).encode()
+
+    if len(parts) < 3 or parts[0] != 'ledgers':
+        raise NotFound(url.path)
+
+    node = daemon.find(parts[1])
+    if node is None:
+        raise NotFound(parts[1])
+
+    # Every response is rendered from one snapshot, so it is consistent with the ETag it is cached under
+    ledger = node.ledger.snapshot()
+    key = (node.id, path)
+    tail = ledger.tail.hash
+
+    with _cache_lock:
+        cached = _cache.get(key)
+        # A single block stays valid under a new tail for as long as the block is still on the chain; a block
+        # hash always comes with the same height
+        if cached is not None and (cached[0] == tail or (cached[0] == parts[-1] and parts[-1] in ledger)):
+            _cache.move_to_end(key)
+            return 200, cached[0], cached[1]
+
+    etag, result = _render(ledger, parts[2:], params)
+    body = json.dumps(result, cls=utils.ComplexEncoder).encode()
+
+    with _cache_lock:
+        _cache[key] = (etag, body)
+        while len(_cache) > settings.QUERY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return 200, etag, body
+
+
+def _handler_class():
+    from http.server import BaseHTTPRequestHandler
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                status, etag, body = respond(self.path)
+            except NotFound as e:
+                status, etag, body = 404, None, json.dumps({'error': 'Not found: {}'.format(e)}).encode()
+            except ValueError as e:
+                status, etag, body = 400, None, json.dumps({'error': str(e)}).encode()
+
+            if etag is not None and self.headers.get('If-None-Match') == '"{}"'.format(etag):
+                self.send_response(304)
+                self.send_header('ETag', '"{}"'.format(etag))
+                self.end_headers()
+                return
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if etag is not None:
+                self.send_header('ETag', '"{}"'.format(etag))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            utils.log_message("Query request from {}: {}".format(self.address_string(), format % args),
+                              utils.Level.LOW)
+
+    return QueryHandler
+
+
+class QueryServer(threading.Thread):
+    def __init__(self, ip=settings.QUERY_BIND_IP, port=settings.QUERY_PORT):
+        from http.server import HTTPServer
+        from socketserver import ThreadingMixIn
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        super(QueryServer, self).__init__()
+        utils.log_message("Starting Query Server Thread")
+        self.daemon = True
+        self.stop = threading.Event()
+
+        # Bind here so port errors are raised to the caller
+        self._server = ThreadingHTTPServer((ip, port), _handler_class())
+        self._server.timeout = 0.5
+        self.address = self._server.server_address
+
+    def run(self):
+        utils.log_message("Serving ledger queries on {0}:{1}".format(*self.address))
+        try:
+            while not self.stop.is_set():
+                self._server.handle_request()
+        finally:
+            self._server.server_close()
@@ -3,17 +3,95 @@ BIND_IP = ''
 BIND_PORT = 2525
 
 # Messaging Defaults
-MSG_SIZE_BYTES = 4
+MSG_SIZE_BYTES = 4   # Digits in the length prefix of a TCP message
+MSG_SIZE_EXTENDED = '####'      # Marks a message too long for that; MSG_SIZE_EXTENDED_BYTES digits of length follow
+MSG_SIZE_EXTENDED_BYTES = 10
 MSG_TYPE_HB = 'hb'
+MSG_TYPE_HB_ACK = 'hback'
 MSG_TYPE_DISCOVER = 'discover'
 MSG_TYPE_JOIN = 'join'
 MSG_TYPE_PEER = 'peers'
 MSG_TYPE_LEDGER = 'ledger'
+MSG_TYPE_BLOB = 'blob'
 MSG_TYPE_SUCCESS = '200'
 MSG_TYPE_FAILURE = '404'
+MSG_TYPE_BUSY = '503'
 MSG_HB_FREQ = 5 # Minimum time in seconds between HB checks to peers
 MSG_HB_TTL = 10*MSG_HB_FREQ  # Minimum time in seconds for HB to determine peer is dead
 MSG_HB_TIMEOUT = 3 # Time in seconds for a hb messsage to timeout
+MSG_HB_BATCH = 100  # Maximum ledgers covered by a single heartbeat datagram
+MSG_UDP_BYTES = 65507  # Largest UDP datagram we accept
+
+# TCP Listener Defaults
+TCP_BACKLOG = 64        # Connections the OS queues before we accept them
+TCP_WORKERS = 16        # Threads handling inbound requests
+TCP_QUEUE = 64          # Accepted requests waiting for a worker before new ones are turned away
+TCP_PER_PEER = 4        # Requests from one peer node handled or queued at once
+TCP_RETRY_AFTER = 1.0   # Seconds a turned away peer is asked to wait
+TCP_TIMEOUT = 10        # Seconds a worker waits on a slow peer
+
+# Ledger Defaults
+LEDGER_WINDOW = None            # Blocks kept in memory per ledger (None: all of them)
+LEDGER_COLD_DIR = '/tmp'        # Where older blocks are paged out to when LEDGER_WINDOW is set
+LEDGER_CLOCK_SKEW = 300         # Seconds a block timestamp may trail the chain's latest or lead our clock
+
+# Sync Defaults
+SYNC_CACHE_SIZE = 64        # Encoded ledger responses kept for peers asking for the same blocks
+SYNC_CACHE_BLOCKS = 1000    # Responses with more blocks than this are not kept
+SYNC_PAGE_BLOCKS = 500      # Blocks taken per request while a joining node streams the chain
+
+# Peer Selection Defaults
+PEER_DEFAULT_RTT = 0.05             # Seconds assumed for a peer whose round trip has not been measured
+PEER_DEFAULT_THROUGHPUT = 1 << 20   # Bytes per second assumed for a peer whose transfers have not been measured
+PEER_SCORE_BYTES = 256 * 1024       # Transfer size peers are compared on, about one sync page
+PEER_MIN_TRANSFER = 16 * 1024       # Smallest response that counts towards a peer's throughput
+PEER_SMOOTHING = 0.3                # Weight of each new sample in a peer's smoothed RTT and throughput
+PEER_BACKOFF = 1.0                  # Seconds a failing peer is passed over, doubled for each failure in a row
+PEER_BACKOFF_MAX = 60
+
+# Peer Exchange Defaults
+PEER_EXCHANGE_INTERVAL = 4      # Heartbeats between peer exchange rounds
+PEER_EXCHANGE_FANOUT = 3        # Random peers of each ledger exchanged with per round
+PEER_EXCHANGE_MAX = 256         # Most peers sent in one exchange response; the rest follow in later rounds
+
+# Fork Defaults
+FORK_REJECTED_SIZE = 256    # Losing tails remembered per ledger
+
+# Mempool Defaults
+MEMPOOL_BATCH = 64      # Most blocks signed and committed together
+MEMPOOL_SIZE = 4096     # Submissions queued before producers are made to wait
+
+# Blob Store Defaults
+BLOB_DIR = '/tmp/privledge-blobs'
+BLOB_CHUNK = 256 * 1024     # Bytes per chunk; a chunk travels base64 encoded in a single TCP message
+BLOB_FETCH_WORKERS = 4      # Chunks fetched from peers at once
+
+# Audit Defaults
+AUDIT_CHUNK = 2000      # Signatures checked per worker task by a full-chain audit
+
+# Shell Defaults
+SHELL_PAGE_BLOCKS = 10      # Blocks shown per page by 'ledger' before asking to continue
+COLOR_CACHE_SIZE = 4096     # Colorized hashes kept for redisplay
+
+# Key Defaults
+KEY_LENGTH = 2048
+KEYPOOL_DEPTH = 4   # Keys kept ready by the background key pool
+
+# Control Socket Defaults
+CONTROL_SOCKET = '/tmp/privledge.sock'
+CONTROL_BACKLOG = 16
+CONTROL_RECV_BYTES = 65536
+
+# Metrics Defaults
+METRICS_BIND_IP = '127.0.0.1'   # Metrics endpoint is local-only by default
+METRICS_PORT = 9525
+METRICS_PREFIX = 'privledge_'
+
+# Query Server Defaults
+QUERY_BIND_IP = '127.0.0.1'     # Query server is local-only by default
+QUERY_PORT = 9526
+QUERY_MAX_RANGE = 1000          # Most blocks returned by one range request
+QUERY_CACHE_SIZE = 256          # Serialized responses kept for repeat requests
 
 
 def init():
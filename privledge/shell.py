@@ -2,11 +2,16 @@ from cmd import Cmd
 from privledge import utils
 from privledge import settings
 from privledge import daemon
-from privledge import block
-from datetime import datetime
+from privledge import keypool
+from privledge import messaging
+from privledge import metrics
+from privledge import peers
+from privledge import profiling
 
+import shlex
 import socket
 import os
+import sys
 
 
 # Helper class for exit functionality
@@ -31,6 +36,11 @@ class ExitCmd(Cmd):
         """Exit the interpreter."""
         return True
 
+    @staticmethod
+    def do_EOF(args):
+        """Exit the interpreter at the end of piped input."""
+        return True
+
 
 # Helper class for shell command functionality
 class ShellCmd(Cmd, object):
@@ -43,9 +53,14 @@ class ShellCmd(Cmd, object):
 # Base Privledge Shell Class
 class PrivledgeShell(ExitCmd, ShellCmd):
 
-    def __init__(self):
+    def __init__(self, command=None):
         super(PrivledgeShell, self).__init__()
 
+        # Run a single command non-interactively if one was given
+        if command is not None:
+            self.onecmd(command)
+            return
+
         # Start the command loop - these need to be the last lines in the initializer
         self.update_prompt()
         self.cmdloop('Welcome to Privledge Shell...')
@@ -73,7 +88,7 @@ class PrivledgeShell(ExitCmd, ShellCmd):
                     privkey = utils.gen_privkey()
                 else:
                     # Generate and save RSA key
-                    privkey = utils.gen_privkey(True, args_list[0])
+                    privkey = utils.gen_privkey(True, args_list[1])
 
             else:
                 # Try to import provided key
@@ -85,8 +100,7 @@ class PrivledgeShell(ExitCmd, ShellCmd):
 
         # If we made it this far we have a valid key
         # Store generated key in our daemon for now
-        daemon.create_ledger(privkey)
-        hash = daemon.ledger.id
+        hash = daemon.create_ledger(privkey).id
 
         print("\nPublic Key Hash: {0}".format(hash))
         utils.log_message("Added key ({0}) as a new Root of Trust".format(hash), utils.Level.FORCE)
@@ -136,13 +150,13 @@ class PrivledgeShell(ExitCmd, ShellCmd):
         # Parse the arguments
         if 'peers' in args:
             # Check that we're even a member of a ledger
-            if daemon.ledger is None or daemon.ledger.id is None:
+            if daemon.current is None:
                 print("You may not search for peers without being a member of a ledger.")
                 return
             peers = True
             args.remove('peers')
         if 'cached' in args:
-            cached = len(daemon.disc_peers)>0 if peers else len(daemon.disc_ledgers)
+            cached = len(daemon.current.disc_peers)>0 if peers else len(daemon.disc_ledgers)
             args.remove('cached')
             utils.log_message("Using cached results" if cached else "Bypassing cache because no results in cache.")
         if len(args) > 0:
@@ -162,21 +176,22 @@ class PrivledgeShell(ExitCmd, ShellCmd):
 
             if peers:
                 # If we're looking for peers, we're only looking for ledger ids that match ours
-                daemon.disc_peers = daemon.disc_ledgers.get(daemon.ledger.id, set())
+                daemon.current.disc_peers = daemon.disc_ledgers.get(daemon.current.id, set())
 
         # Display the results
         if peers:
-            print("Found {} peers".format(str(len(daemon.disc_peers))))
-            if len(daemon.disc_peers) > 0:
+            node = daemon.current
+            print("Found {} peers".format(str(len(node.disc_peers))))
+            if len(node.disc_peers) > 0:
                 added_peer_count = 0
-                for idx, addr in enumerate(daemon.disc_peers):
-                    is_peer = addr[0] in daemon.peers
-                    print("{} | {}{}"
-                          .format(idx+1, '(peer) ' if is_peer else '', addr[0]))
+                for idx, addr in enumerate(node.disc_peers):
+                    is_peer = addr in node.peers
+                    print("{} | {}{}:{}"
+                          .format(idx+1, '(peer) ' if is_peer else '', addr[0], addr[1]))
 
                     # Add non-peers to peer list
                     if not is_peer:
-                        daemon.peers[addr[0]] = datetime.now()
+                        node.add_peer(addr)
                         added_peer_count += 1
 
                     print("Added {} peers to peer list".format(added_peer_count))
@@ -186,7 +201,7 @@ class PrivledgeShell(ExitCmd, ShellCmd):
             if len(daemon.disc_ledgers) > 0:
                 member = ''
                 for idx,ledger in enumerate(daemon.disc_ledgers):
-                    if daemon.ledger is not None and daemon.ledger.id == ledger.strip():
+                    if ledger.strip() in daemon.nodes:
                         member = '(peer)'
                     else:
                         member = ''
@@ -220,81 +235,497 @@ class PrivledgeShell(ExitCmd, ShellCmd):
         # Pass the daemon the hash and members
         daemon.join_ledger(list(daemon.disc_ledgers.keys())[number-1], list(list(daemon.disc_ledgers.values())[number-1])[0])
 
+    def do_export(self, args):
+        """Write the current ledger to an archive file, to bootstrap other nodes without pulling it over the network
+
+        Arguments:
+        file: the archive to write
+        """
+
+        if not daemon.joined():
+            print("You must be joined to a ledger to export it")
+            return
+        if len(args.strip()) == 0:
+            print("You must provide a file to write the archive to")
+            return
+
+        try:
+            count = daemon.export_ledger(daemon.current, args.strip())
+        except OSError as e:
+            print("Could not write the archive: {}".format(e))
+            return
+        print("Wrote {} block(s) of ledger {} to {}".format(count, daemon.current.id, args.strip()))
+
+    def do_import(self, args):
+        """Host the ledger in an archive file, then sync the blocks added since it was written
+
+        Arguments:
+        file: the archive to read
+        ip[:port] (optional): the member to sync from (default: discover one)
+        """
+
+        args_list = args.split()
+        if len(args_list) == 0:
+            print("You must provide an archive to import")
+            return
+
+        member = None
+        if len(args_list) > 1:
+            ip, _, port = args_list[1].partition(':')
+            try:
+                member = (ip, int(port) if len(port) > 0 else settings.BIND_PORT)
+            except ValueError:
+                print("You did not provide a valid port: '{}'".format(port))
+                return
+
+        try:
+            node = daemon.import_ledger(args_list[0], member)
+        except (OSError, ValueError) as e:
+            print("Could not import the archive: {}".format(e))
+            return
+
+        print("Imported {} block(s) of ledger {}".format(len(node.ledger), node.id))
+        if node.sync is not None:
+            print("Catching up on the remaining {} block(s) from {}".format(node.sync.height - len(node.ledger),
+                                                                          node.sync.target))
+        self.update_prompt()
+
+    def do_verify(self, args):
+        """Check the whole current ledger: block hashes, predecessor links, and every signature against the keys
+        active at its height
+
+        Arguments:
+        processes (optional): worker processes checking signatures (default: one per core)
+        """
+        from privledge import audit
+
+        if not daemon.joined():
+            print("You must be joined to a ledger to verify it")
+            return
+
+        try:
+            processes = int(args) if len(args.strip()) > 0 else None
+        except ValueError:
+            print("If you provide a number of processes, provide a valid integer")
+            return
+
+        # Progress is rewritten in place on one line, which is ended before the result is printed
+        shown = False
+
+        def progress(verified, total):
+            nonlocal shown
+            shown = True
+            print("\rVerified {} of {} blocks".format(verified, total), end='', flush=True)
+
+        result = audit.verify(daemon.current.ledger.snapshot(), processes, progress=progress)
+        if shown:
+            print()
+        print("Verified {} of {} blocks in {:.2f}s ({:.0f} blocks/s)".format(
+            result['verified'], result['height'], result['seconds'], result['rate'] or 0))
+
+        if result['invalid'] is None:
+            print("The ledger is valid")
+        else:
+            print("First invalid block at height {}: {}".format(result['invalid'], result['reason']))
+
     def do_leave(self, args):
-        """Leave the currently joined ledger"""
+        """Leave the current ledger"""
 
         print(daemon.leave_ledger())
+        self.update_prompt()
+
+    def do_use(self, args):
+        """Switch the ledger the shell operates on
+
+        Arguments:
+        n: Use the n-th ledger in the list shown by status
+        id: Use the ledger with this id (a unique prefix is enough)
+        """
+
+        ledger_ids = list(daemon.nodes.keys())
+        args = args.strip()
+
+        if len(args) == 0:
+            print("You must provide a ledger number or id. Use the `status` command to show hosted ledgers.")
+            return
+
+        if args.isdigit() and 0 < int(args) <= len(ledger_ids):
+            args = ledger_ids[int(args)-1]
+
+        if daemon.select(args) is None:
+            print("No single hosted ledger matches '{}'".format(args))
+        else:
+            print("Using ledger {}".format(daemon.current.id))
+
+        self.update_prompt()
 
     def do_status(self, args):
-        """Show current ledger status"""
+        """Show current ledger status
+
+        Arguments:
+        detail: also print the peers of the current ledger with their measured round trip and throughput, and its
+            Root of Trust
+        """
 
-        if daemon.ledger is not None:
+        if daemon.current is not None:
             # Print ledger status
-            print("You are a member of ledger {0} and connected to {1} peers.".format(daemon.ledger.id,
-                                                                                      len(daemon.peers)))
+            print("You are a member of ledger {0} and connected to {1} peers.".format(daemon.current.id,
+                                                                                      len(daemon.current.peers)))
+            sync = daemon.current.sync
+            if sync is not None:
+                print("Catching up: {} of {} blocks received from {}".format(len(daemon.current.ledger), sync.height,
+                                                                             sync.target))
+            # Other ledgers hosted by this daemon
+            if len(daemon.nodes) > 1:
+                for idx, node in enumerate(daemon.nodes.values()):
+                    print("{} | {}{}: {} blocks, {} peers".format(idx+1, '(current) ' if node is daemon.current else '',
+                                                              node.id, len(node.ledger), len(node.peers)))
+
             # Detailed
             if args.lower() == 'detail':
+                print("\nPeers, best sync source first:")
+                for peer in [peers.get(address) for address in peers.rank(daemon.current.peers.keys())]:
+                    print("\t{}:{}  rtt {}  throughput {}{}".format(
+                        peer.address[0], peer.address[1],
+                        '-' if peer.rtt is None else '{:.1f}ms'.format(peer.rtt * 1000),
+                        '-' if peer.throughput is None else '{:.0f}KB/s'.format(peer.throughput / 1024),
+                        '  backing off after {} failure(s)'.format(peer.failures) if peer.backing_off else ''))
+
                 print("\nRoot of Trust:")
-                print(daemon.ledger.root)
+                print(daemon.current.ledger.root)
         else:
             # Print message if no ledger
             print("You are not a member of a ledger")
 
+    def do_keys(self, args):
+        """List the keys of the current ledger and whether they may sign blocks
+
+        Arguments:
+        all: also list revoked keys
+        """
+
+        if not daemon.joined():
+            print("You must be joined to a ledger to list its keys")
+            return
+
+        ledger = daemon.current.ledger.snapshot()
+        states = ledger.keys()
+        show_revoked = args.lower() == 'all'
+
+        for key_hash, state in states.items():
+            if not state.active and not show_revoked:
+                continue
+            print("{} {}{}\n\t{} by block {}".format(utils.hash_color(key_hash),
+                                                   'active' if state.active else 'revoked',
+                                                   ' (root)' if key_hash == ledger.id else '',
+                                                   'Added' if state.active else 'Revoked',
+                                                   utils.hash_color(state.block.hash)))
+
+        active = sum(1 for state in states.values() if state.active)
+        print("{} active key(s), {} revoked".format(active, len(states) - active))
+
+    def do_stats(self, args):
+        """Show runtime metrics
+
+        Arguments:
+        (none): print a summary of all counters, gauges and histograms
+        reset: zero all counters and histograms
+        serve [port]: expose metrics as text on a local port (default 9525)
+        stop: stop the metrics endpoint
+        """
+
+        args = args.lower().split()
+
+        if len(args) == 0:
+            lines = metrics.summary()
+            if len(lines) == 0:
+                print("No metrics have been recorded yet")
+            for line in lines:
+                print(line)
+        elif args[0] == 'reset':
+            metrics.reset()
+            print("Metrics have been reset")
+        elif args[0] == 'serve':
+            try:
+                port = int(args[1]) if len(args) > 1 else settings.METRICS_PORT
+                address = daemon.metrics_endpoint(True, port)
+                print("Serving metrics at http://{0}:{1}/metrics".format(*address))
+            except (ValueError, OSError) as e:
+                print("Could not start the metrics endpoint: {}".format(e))
+        elif args[0] == 'stop':
+            daemon.metrics_endpoint(False)
+            print("Stopped the metrics endpoint")
+        else:
+            print("Unknown argument(s): {}".format(' '.join(args)))
+
+    def do_query(self, args):
+        """Serve the hosted ledgers read-only over local HTTP/JSON
+
+        Arguments:
+        serve [port]: start the query server on a local port (default 9526)
+        stop: stop the query server
+
+        Endpoints: /ledgers, /ledgers/<id>/tail, /ledgers/<id>/blocks/<hash>,
+        /ledgers/<id>/blocks?start=&end= and /ledgers/<id>/keys
+        """
+
+        args = args.lower().split()
+
+        if len(args) > 0 and args[0] == 'serve':
+            try:
+                port = int(args[1]) if len(args) > 1 else settings.QUERY_PORT
+                address = daemon.query_endpoint(True, port)
+                print("Serving ledger queries at http://{0}:{1}/ledgers".format(*address))
+            except (ValueError, OSError) as e:
+                print("Could not start the query server: {}".format(e))
+        elif len(args) > 0 and args[0] == 'stop':
+            daemon.query_endpoint(False)
+            print("Stopped the query server")
+        else:
+            print("Unknown argument(s): {}".format(' '.join(args)))
+
+    def do_profile(self, args):
+        """Profile the running node without restarting it
+
+        Command: profile cpu|mem action [options]
+
+        Arguments:
+        cpu start: start cProfile on the listener, heartbeat and connection threads
+        cpu stop [sort] [n] [path]: stop and print the top n (default 25) functions sorted by sort
+            (default cumulative), optionally dumping the raw stats to path
+        mem start [frames]: start tracemalloc, recording frames (default 1) per allocation
+        mem snapshot [n]: print the top n (default 10) allocation sites and keep them as a baseline
+        mem diff [n]: print the top n allocation sites that grew since the last snapshot
+        mem stop: stop tracemalloc
+        """
+
+        args = args.split()
+        if len(args) < 2:
+            print("You must provide a profiler (cpu|mem) and an action")
+            return
+
+        profiler, action, options = args[0].lower(), args[1].lower(), args[2:]
+
+        try:
+            if profiler == 'cpu' and action == 'start':
+                profiling.cpu_start()
+
+            elif profiler == 'cpu' and action == 'stop':
+                if not profiling.cpu_active():
+                    print("CPU profiling is not running")
+                    return
+
+                print("Waiting for threads to report...")
+                stats = profiling.cpu_stop()
+                if stats is None:
+                    print("No profile data was collected")
+                    return
+
+                sort = options[0] if len(options) > 0 else 'cumulative'
+                limit = int(options[1]) if len(options) > 1 else 25
+                print(profiling.format_stats(stats, sort, limit))
+                if len(options) > 2:
+                    stats.dump_stats(options[2])
+                    print("Saved profile to {}".format(options[2]))
+
+            elif profiler == 'mem' and action == 'start':
+                profiling.mem_start(int(options[0]) if len(options) > 0 else 1)
+
+            elif profiler == 'mem' and action in ('snapshot', 'diff'):
+                if not profiling.mem_active():
+                    print("Memory tracing is not running. Try 'profile mem start'")
+                    return
+
+                limit = int(options[0]) if len(options) > 0 else 10
+                if action == 'snapshot':
+                    stats = profiling.mem_snapshot(limit)
+                else:
+                    stats = profiling.mem_diff(limit)
+
+                for stat in stats:
+                    print(stat)
+
+                # Counts of the structures most likely to grow
+                print("\nLedger blocks: {}".format(sum(len(node.ledger) for node in daemon.nodes.values())))
+                print("Hash color cache entries: {}".format(utils.hash_color.cache_info().currsize))
+                if daemon._tcp_thread is not None:
+                    print("TCP connections active: {}".format(daemon._tcp_thread._active))
+
+            elif profiler == 'mem' and action == 'stop':
+                profiling.mem_stop()
+                print("Memory tracing stopped")
+
+            else:
+                print("Unknown argument(s): {} {}".format(profiler, action))
+
+        except (ValueError, KeyError) as e:
+            print("Could not profile: {}".format(e))
+
     def do_ledger(self, args):
-        """Print the ledger
+        """Print the ledger, newest blocks first. Blocks are read and formatted as they are shown, and at a
+        terminal the output pauses after every page, so even a very long ledger can be browsed.
 
         Arguments:
         n (default 3): print the last n blocks. If n = 0, print entire ledger
+        --offset k: start k blocks back from the tail
+        --type blocktype: only print blocks of this type (key|revoke|text|blob)
+        --match text: only print blocks whose message contains text
+        --since time, --until time: only print the blocks timestamped in this range. A time is epoch seconds, an
+            ISO date or date and time (2024-05-21, 2024-05-21T14:30), or an age (30m, 1h, 2d)
+        --from ip[:port]: read the --since/--until range from that member of the ledger rather than our copy, up
+            to a sync page of blocks. Their heights are shown if we have the block before them; they are not
+            verified
+        When filtering, every matching block is printed unless n is given.
         """
 
         # Ensure we are joined to a ledger
-        if daemon.ledger is None:
+        if daemon.current is None:
             print("You are not a member of a ledger. Please join or create one first")
             return
 
-        n = 3
-        ledger_list = None
+        ledger = daemon.current.ledger.snapshot()
 
-        # Parse arguments
+        n = None
+        offset = 0
+        blocktype = None
+        match = None
+        since = None
+        until = None
+        source = None
+
+        # Parse arguments; quotes group a --match text with spaces
         try:
-            if len(args) > 0:
-                n = int(args)
-        except ValueError:
-            print("If you provide an argument, provide a valid integer")
+            args_list = shlex.split(args)
+        except ValueError as e:
+            print("Could not parse the arguments: {}".format(e))
             return
+        while len(args_list) > 0:
+            arg = args_list.pop(0)
+            try:
+                if arg.startswith('--'):
+                    if arg not in ('--offset', '--type', '--match', '--since', '--until', '--from'):
+                        print("Unknown option {}".format(arg))
+                        return
+                    if len(args_list) == 0:
+                        print("Provide a value after {}".format(arg))
+                        return
+
+                    value = args_list.pop(0)
+                    if arg == '--offset':
+                        offset = int(value)
+                    elif arg == '--type':
+                        blocktype = value.lower()
+                    elif arg == '--match':
+                        match = value
+                    elif arg == '--since':
+                        since = utils.parse_time(value)
+                    elif arg == '--until':
+                        until = utils.parse_time(value)
+                    else:
+                        ip, _, port = value.partition(':')
+                        source = (ip, int(port) if len(port) > 0 else settings.BIND_PORT)
+                else:
+                    n = int(arg)
+            except ValueError as e:
+                if arg == '--from':
+                    print("You did not provide a valid port: '{}'".format(value))
+                else:
+                    print(e if arg in ('--since', '--until') else "If you provide an argument, provide a valid integer")
+                return
+
+        filtered = any(f is not None for f in (blocktype, match, since, until))
+        if n is None:
+            n = 0 if filtered else 3
+
+        # Positions to walk back through, in our ledger or in the blocks fetched from a member; the time index
+        # narrows a time range to the blocks that can be in it
+        blocks, base = ledger, 0
+        if source is not None:
+            if since is None and until is None:
+                print("--from reads a time range; give --since and/or --until as well")
+                return
+
+            fetched = messaging.fetch_range(source, daemon.current.id, since, until, settings.SYNC_PAGE_BLOCKS)
+            if fetched is None:
+                print("Could not fetch blocks from {}:{}".format(*source))
+                return
 
-        ledger_list = daemon.ledger.list[-n:]
+            ancestor, blocks = fetched
+            pos = ledger.position(ancestor) if ancestor is not None else -1
+            base = pos + 1 if pos is not None else None
+            print("\nFetched {} block(s) covering the range from {}:{}, not verified".format(len(blocks), *source))
+            if len(blocks) == settings.SYNC_PAGE_BLOCKS:
+                print("Only the first {} blocks of the range were fetched".format(len(blocks)))
+            start, end = 0, max(0, len(blocks) - offset)
 
-        # Prepare iterator
-        revers_iter = None
-        if n <= 0 or n >= len(daemon.ledger.list) - 1:
-            reverse_iter = range(len(daemon.ledger.list)-1, -1, -1)
         else:
-            reverse_iter = range(len(daemon.ledger.list) - 1, len(daemon.ledger.list) - 1 - n, -1)
+            start, end = 0, max(0, min(len(ledger), len(ledger) - offset))
+            if since is not None or until is not None:
+                start, stop = ledger.time_bounds(since, until)
+                end = min(end, stop)
+
+        def wanted(block):
+            if blocktype is not None and block.blocktype.name != blocktype:
+                return False
+            if match is not None and match not in block.message:
+                return False
+            if since is not None or until is not None:
+                if block.timestamp is None or (since is not None and block.timestamp < since) or \
+                        (until is not None and block.timestamp >= until):
+                    return False
+            return True
 
         print('\n')
-
-        # Print each block in reverse order
-        for i in reverse_iter:
-            print('r' if i is 0 else i, end='')
-            print(daemon.ledger.list[i])
+        shown = 0
+        i = end - 1
+        while i >= start and (n <= 0 or shown < n):
+            block = blocks[i]
+            i -= 1
+            if filtered and not wanted(block):
+                continue
+
+            height = base + i + 1 if base is not None else '?'
+            print('r' if height == 0 else height, end='')
+            print(block)
             print('\n')
+            shown += 1
+
+            if shown % settings.SHELL_PAGE_BLOCKS == 0 and i >= start and (n <= 0 or shown < n) and not self._more():
+                return
+
+        if filtered:
+            if shown == 0:
+                print("No blocks match")
+            elif i >= start:
+                print('\t\t...{} earlier blocks not searched...\n'.format(i - start + 1))
+            return
 
         # Check to ensure root was printed
-        if 0 not in reverse_iter:
-            print('\t\t...{} hidden blocks...\n'.format(len(daemon.ledger.list) - len(reverse_iter) - 1))
+        if i >= 0:
+            if i > 0:
+                print('\t\t...{} hidden blocks...\n'.format(i))
             print('r', end='')
-            print(daemon.ledger.root)
+            print(ledger.root)
             print('\n')
 
+    @staticmethod
+    def _more():
+        """Pause between pages of output at a terminal; returns False if the user asked to stop"""
+        if not (sys.stdin.isatty() and sys.stdout.isatty()):
+            return True
+        try:
+            return input('-- Enter for more, q to stop -- ').strip().lower() not in ('q', 'quit')
+        except EOFError:
+            return False
+
     def do_block(self, args):
         """Add a block to the ledger.
 
         Command: block blocktype message
 
         Arguments:
-        blocktype: key|revoke|text
-        message: based on blocktype, may be public key or arbitrary text
+        blocktype: key|revoke|text|blob
+        message: based on blocktype, may be public key, arbitrary text or a blob reference (see 'blob')
 
         eg: block key MIIEpAIBAAKCAQEAxWLpWMCgNDXmN/G+w3bRiunslFoGDiZzYx1C0i...
         """
@@ -303,7 +734,7 @@ class PrivledgeShell(ExitCmd, ShellCmd):
         if len(args) < 2:
             print("You must provide the blocktype and message to create a block")
             return
-        elif daemon.privkey is None:
+        elif daemon.signing_key() is None:
             print("You must have a private key added before you may create a block")
             return
         elif not daemon.joined():
@@ -315,20 +746,64 @@ class PrivledgeShell(ExitCmd, ShellCmd):
 
         try:
 
-            blocktype = block.BlockType[blocktype]
-
-            new_block = block.Block(blocktype, daemon.ledger.tail.hash, message)
-            new_block.sign(daemon.privkey)
-
-            daemon.ledger.append(new_block)
+            block_hash = daemon.add_block(daemon.current, blocktype, message)
             print("Added new block to ledger:")
-            print('\n{}\n'.format(new_block))
+            print('\n{}\n'.format(daemon.current.ledger.search(block_hash)[1][0]))
 
         except KeyError as e:
             print("Could not add block: {} is not a valid blocktype".format(e))
         except ValueError as e:
             print("Could not add block: {}".format(e))
 
+    def do_blob(self, args):
+        """Add a file to the ledger as a blob, or read one back. Only a reference to the content goes on the
+        chain; the content is kept in the local blob store and fetched from peers when it is read.
+
+        Arguments:
+        add file: store the file and add a blob block referring to it
+        get hash [file]: write the content of the blob block with this hash to file (default: print it)
+        """
+
+        args_list = args.split()
+        if len(args_list) < 2 or args_list[0].lower() not in ('add', 'get'):
+            print("Usage: blob add <file> | blob get <block hash> [file]")
+            return
+        elif not daemon.joined():
+            print("You must be joined to a ledger in order to use blobs. Try 'init'")
+            return
+
+        if args_list[0].lower() == 'add':
+            if daemon.signing_key() is None:
+                print("You must have a private key added before you may create a block")
+                return
+            try:
+                with open(args_list[1], 'rb') as f:
+                    block_hash = daemon.submit_blob(daemon.current, f).result()
+            except (OSError, ValueError) as e:
+                print("Could not add blob: {}".format(e))
+                return
+            print("Added new block to ledger:")
+            print('\n{}\n'.format(daemon.current.ledger.search(block_hash)[1][0]))
+            return
+
+        blocks = daemon.current.ledger.search(args_list[1])[1]
+        if len(blocks) != 1 or blocks[0].blocktype.name != 'blob':
+            print("No single blob block matches {}".format(args_list[1]))
+            return
+
+        try:
+            data = daemon.read_blob(daemon.current, blocks[0].message)
+        except (KeyError, ValueError) as e:
+            print("Could not read blob: {}".format(e))
+            return
+
+        if len(args_list) > 2:
+            with open(args_list[2], 'wb') as f:
+                f.write(data)
+            print("Wrote {} bytes to {}".format(len(data), args_list[2]))
+        else:
+            print(data.decode(errors='replace'))
+
     def do_key(self, args):
         """Manage your local private key
 
@@ -336,23 +811,61 @@ class PrivledgeShell(ExitCmd, ShellCmd):
         gen: Generate a new RSA key
         pub (default): Prints the public key
         priv: Prints the private key
+        pool [start [depth]|stop]: Show, start or stop the background key pool that pre-generates keys
+        batch n [filename] [location]: Generate n keys across all cores and save them as
+            <location><filename>_<i> (default id_rsa_<i> in the current directory)
         """
 
+        args_list = args.split()
         args = args.lower()
 
-        if len(args) <= 0 or args == 'pub':
-            if daemon.privkey is not None:
-                print(utils.encode_key(daemon.privkey))
+        if len(args_list) > 0 and args_list[0].lower() == 'pool':
+            self._key_pool(args_list[1:])
+        elif len(args_list) > 0 and args_list[0].lower() == 'batch':
+            try:
+                count = int(args_list[1])
+            except (IndexError, ValueError):
+                print("You must provide the number of keys to generate")
+                return
+
+            filename = args_list[2] if len(args_list) > 2 else 'id_rsa'
+            location = args_list[3] if len(args_list) > 3 else ''
+            keypool.generate(count, save=True, filename=filename, location=location)
+            print("Saved {} keys to {}{}_0..{}".format(count, location, filename, count-1))
+        elif len(args) <= 0 or args == 'pub':
+            if daemon.signing_key() is not None:
+                print(utils.encode_key(daemon.signing_key()))
             else:
                 print("You don't have a key to display")
         elif args == 'priv':
-            print(utils.encode_key(daemon.privkey, public=False))
+            print(utils.encode_key(daemon.signing_key(), public=False))
         elif args == 'gen':
-            daemon.privkey = utils.gen_privkey()
+            daemon.set_key(utils.gen_privkey())
             self.do_key('')
         else:
             print("Unknown argument(s): {}".format(args))
 
+    @staticmethod
+    def _key_pool(args):
+        if len(args) > 0 and args[0].lower() == 'start':
+            try:
+                depth = int(args[1]) if len(args) > 1 else settings.KEYPOOL_DEPTH
+            except ValueError:
+                print("If you provide a depth, provide a valid integer")
+                return
+            keypool.start(depth)
+        elif len(args) > 0 and args[0].lower() == 'stop':
+            keypool.stop()
+        elif len(args) > 0:
+            print("Unknown argument(s): {}".format(' '.join(args)))
+            return
+
+        status = keypool.status()
+        if status is None:
+            print("The key pool is not running")
+        else:
+            print("Key pool: {} ready, {} generating, depth {}".format(*status))
+
     def update_prompt(self):
         """Update the prompt based on system variables"""
 
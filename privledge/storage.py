@@ -0,0 +1,190 @@
+""" Bounded-memory block storage
+
+A TieredList keeps the most recent blocks of a ledger in memory and pages older ones out to an append-only
+file, so memory stays flat however long the ledger grows. Each line of the file is a block's hash followed by
+its wire encoding; only an 8 byte offset and a 16 byte index entry per block stay in memory, and paged out
+blocks are read back as LazyBlocks, which are decoded only if their body is needed.
+"""
+
+from privledge import utils
+
+from array import array
+from bisect import bisect_left
+import json
+import os
+import tempfile
+import threading
+
+
+class HashIndex:
+    """Positions of blocks by the first 8 bytes of their hash, in sorted runs of 16 bytes per block
+
+    Each batch of appended blocks becomes a run; runs are merged whenever the last is at least as long as the one
+    before it, so there are O(log n) of them and a lookup is a binary search in each. Prefixes can collide, so a
+    lookup returns candidate positions for the caller to check against the full hash.
+    """
+
+    def __init__(self):
+        self._runs = []     # (prefixes, positions), both sorted by prefix
+
+    @staticmethod
+    def key(block_hash):
+        """The prefix of a hash as an integer, or None if it is not a hex hash"""
+        try:
+            return int(block_hash[:16], 16)
+        except (TypeError, ValueError):
+            return None
+
+    def add_many(self, entries):
+        """Add (prefix, position) entries"""
+        self._runs.append(self._run(entries))
+        while len(self._runs) > 1 and len(self._runs[-1][0]) >= len(self._runs[-2][0]):
+            newer, older = self._runs.pop(), self._runs.pop()
+            self._runs.append(self._run(list(zip(older[0], older[1])) + list(zip(newer[0], newer[1]))))
+
+    @staticmethod
+    def _run(entries):
+        entries = sorted(entries)
+        return array('Q', (prefix for prefix, pos in entries)), array('Q', (pos for prefix, pos in entries))
+
+    def candidates(self, key):
+        for prefixes, positions in self._runs:
+            i = bisect_left(prefixes, key)
+            while i < len(prefixes) and prefixes[i] == key:
+                yield positions[i]
+                i += 1
+
+
+class ColdStore:
+    """An append-only file of blocks addressed by position
+
+    The file is created under a fresh unique name in directory, so stores of the same ledger on one host never
+    share a file, and only this store removes it."""
+
+    def __init__(self, directory, prefix='privledge-'):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix='.blocks')
+        self._file = os.fdopen(fd, 'w+b')
+        self._offsets = array('Q')
+        self._index = HashIndex()
+        self._end = 0
+        self._lock = threading.Lock()   # Appends and reads share one file position
+
+    def append_many(self, blocks):
+        lines = [(block.hash + ' ' + block.wire + '\n').encode() for block in blocks]
+
+        with self._lock:
+            self._file.seek(self._end)
+            start = len(self._offsets)
+            for line in lines:
+                self._offsets.append(self._end)
+                self._end += len(line)
+            self._file.write(b''.join(lines))
+            self._file.flush()
+            self._index.add_many((HashIndex.key(block.hash), start + i) for i, block in enumerate(blocks))
+
+    def _read(self, pos):
+        with self._lock:
+            self._file.seek(self._offsets[pos])
+            return self._file.readline()
+
+    def __getitem__(self, pos):
+        block_hash, record = self._read(pos).split(b' ', 1)
+        record = record.decode().rstrip('\n')
+        block = json.loads(record, object_hook=utils.message_decoder)
+        block._wire = record    # The record is the block's wire encoding
+        return block
+
+    def find(self, block_hash, end=None):
+        """Return the position of the block with this hash among the first end blocks, or None. A miss is
+        answered from the index alone; a hit reads the one record it points at to confirm the full hash."""
+        key = HashIndex.key(block_hash)
+        if key is None:
+            return None
+        target = block_hash.encode()
+        end = len(self._offsets) if end is None else min(end, len(self._offsets))
+
+        with self._lock:
+            for pos in self._index.candidates(key):
+                if pos < end:
+                    self._file.seek(self._offsets[pos])
+                    if self._file.readline().split(b' ', 1)[0] == target:
+                        return pos
+        return None
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.unlink(self.path)
+
+
+class TieredList:
+    """A list of blocks holding at most 2 * window of them in memory; older blocks live in a ColdStore
+
+    Blocks are paged out window at a time, so the cost of a page out is spread over window appends. Positions
+    before base are on disk. Like a list it supports len, indexing, slicing and iteration.
+
+    Paged out blocks are written to disk before the in-memory part is swapped for a shorter one, and the base
+    and in-memory part are swapped together, so a concurrent reader always finds a block in one or the other.
+    """
+
+    def __init__(self, window, cold, hot=None, base=0):
+        self.window = window
+        self._cold = cold
+        self._state = (base, [] if hot is None else hot)
+
+    @property
+    def base(self):
+        return self._state[0]
+
+    def append(self, block):
+        """Append a block; returns the blocks paged out to disk to make room, if any"""
+        base, hot = self._state
+        hot.append(block)
+        if len(hot) < 2 * self.window:
+            return []
+
+        evicted = hot[:self.window]
+        self._cold.append_many(evicted)
+        self._state = (base + len(evicted), hot[self.window:])
+        return evicted
+
+    def truncated(self, length):
+        """Return a new TieredList of the first length blocks, sharing the cold store.
+        Only blocks still in memory can be dropped."""
+        base, hot = self._state
+        if length < base:
+            raise ValueError('Cannot drop blocks that have been paged out to disk', length, base)
+        return TieredList(self.window, self._cold, hot[:length - base], base)
+
+    def find_cold(self, block_hash, end=None):
+        """Return the position of a paged out block (among the first end blocks), or None"""
+        base = self.base
+        return self._cold.find(block_hash, base if end is None else min(base, end))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+
+        base, hot = self._state
+        if item < 0:
+            item += base + len(hot)
+        if item >= base:
+            return hot[item - base]
+        if item < 0:
+            raise IndexError('Ledger index out of range', item)
+        return self._cold[item]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        base, hot = self._state
+        return base + len(hot)
+
+    def close(self):
+        self._cold.close()
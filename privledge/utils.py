@@ -1,19 +1,16 @@
-from xtermcolor import colorize
 from enum import Enum
 from privledge import settings
-from privledge import messaging
-from privledge import block
-from Crypto.PublicKey import RSA
-from Crypto.Hash import SHA256
 
-import random
+# Third party modules (xtermcolor, Crypto, base58) and the messaging/block modules are imported on first use
+# inside the functions that need them, so importing utils (and anything built on it) stays cheap
+import functools
+import hashlib
 import os.path
-import base58
 import json
+import weakref
 from os import chmod
 
-_hashes_fg = dict()
-_hashes_bg = dict()
+_key_hashes = dict()    # id(key) -> (weak reference to the key, key hash)
 
 
 class Level(Enum):
@@ -32,6 +29,8 @@ def log_message(message, debug=Level.HIGH):
 
     if settings.debug >= debug.value:
         # Uses termcolor: https://pypi.python.org/pypi/termcolor
+        from xtermcolor import colorize
+
         color = 0x0000FF
         background = 0xCCCCCC
 
@@ -46,6 +45,7 @@ def log_message(message, debug=Level.HIGH):
 
 
 def get_key(key=None):
+    from Crypto.PublicKey import RSA
 
     # Check for RSA key
     if key is not None:
@@ -76,26 +76,38 @@ def get_key(key=None):
     return None
 
 
-def gen_privkey(save=False, filename='id_rsa', location='', keylength=2048):
-    log_message("Generating {0}-bit RSA key".format(keylength))
+def gen_privkey(save=False, filename='id_rsa', location='', keylength=settings.KEY_LENGTH):
+    from Crypto.PublicKey import RSA
+    from privledge import keypool
+
+    # Use a pre-generated key if the key pool is running
+    key = keypool.take(keylength)
 
-    key = RSA.generate(keylength)
+    if key is None:
+        log_message("Generating {0}-bit RSA key".format(keylength))
+        key = RSA.generate(keylength)
 
     if save:
-        with open("{0}{1}".format(location, filename), 'w') as content_file:
-            chmod("{0}{1}".format(location, filename), 0o0600)
-            content_file.write(key.exportKey())
-        with open("{0}{1}.pub".format(location, filename), 'w') as content_file:
-            content_file.write(key.publickey().exportKey())
+        save_key(key, filename, location)
 
     return key
 
 
+def save_key(key, filename='id_rsa', location=''):
+    with open("{0}{1}".format(location, filename), 'wb') as content_file:
+        chmod("{0}{1}".format(location, filename), 0o0600)
+        content_file.write(key.exportKey())
+    with open("{0}{1}.pub".format(location, filename), 'wb') as content_file:
+        content_file.write(key.publickey().exportKey())
+
+
 def encode(bytestring):
+    import base58
     return base58.b58encode(bytestring)
 
 
 def decode(string):
+    import base58
     return base58.b58decode(string)
 
 
@@ -107,23 +119,103 @@ def encode_key(key, public=True):
 
 
 def gen_hash(message):
+    # hashlib gives the same digest as Crypto.Hash.SHA256 without importing Crypto
     if isinstance(message, str):
-        h = SHA256.new(message.encode('utf-8'))
+        h = hashlib.sha256(message.encode('utf-8'))
     else:
-        h = SHA256.new(message)
+        h = hashlib.sha256(message)
 
     return h.hexdigest()
 
 
+def key_hash(key):
+    """Return the hash of a key's encoded public key (the id it signs under), cached per key object"""
+    cached = _key_hashes.get(id(key))
+    if cached is not None and cached[0]() is key:
+        return cached[1]
+
+    result = gen_hash(encode_key(key))
+    _key_hashes[id(key)] = (weakref.ref(key, lambda ref, id=id(key): _key_hashes.pop(id, None)), result)
+    return result
+
+
 def append_len(message):
-    return str(len(message)).zfill(settings.MSG_SIZE_BYTES) + message
+    # Messages that fit keep the 4 digit prefix, so small messages are framed exactly as they always were. This
+    # is not compatibility with older nodes, whose message formats differ in other ways
+    if len(message) < 10 ** settings.MSG_SIZE_BYTES:
+        return str(len(message)).zfill(settings.MSG_SIZE_BYTES) + message
+    return settings.MSG_SIZE_EXTENDED + str(len(message)).zfill(settings.MSG_SIZE_EXTENDED_BYTES) + message
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 65536))
+        if len(chunk) == 0:
+            raise ValueError('Connection closed before the end of the message', len(data), size)
+        data += chunk
+    return bytes(data)
+
+
+def read_len(sock):
+    """Read the length prefix of a TCP message (see append_len); raises ValueError if it is not one"""
+    data = _recv_exactly(sock, settings.MSG_SIZE_BYTES)
+    if data == settings.MSG_SIZE_EXTENDED.encode():
+        data = _recv_exactly(sock, settings.MSG_SIZE_EXTENDED_BYTES)
+    return int(data.decode())
+
+
+def read_message(sock):
+    """Read a whole length-prefixed TCP message; returns (size, message). Raises ValueError if the prefix is not
+    one, or if the peer closes the connection before the end of the message."""
+    size = read_len(sock)
+    return size, _recv_exactly(sock, size).decode()
+
+
+def format_time(timestamp):
+    from datetime import datetime
+    return datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='seconds')
+
+
+_TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_time(text):
+    """Return seconds since the epoch for a time given as epoch seconds, an ISO date or date and time (local
+    time unless an offset is given), or an age such as 90s, 30m, 1h, 2d or 1w ago. Raises ValueError."""
+    import time
+    from datetime import datetime
+
+    text = text.strip()
+    if len(text) > 1 and text[-1] in _TIME_UNITS:
+        try:
+            return time.time() - float(text[:-1]) * _TIME_UNITS[text[-1]]
+        except ValueError:
+            pass
+
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError("Not a time: '{}'. Use epoch seconds, an ISO date (2024-05-21 or 2024-05-21T14:30) "
+                         "or an age (30m, 1h, 2d)".format(text))
 
 
 def message_decoder(obj):
+    from privledge import block
+    from privledge import messaging
+
     if 'msg_type' in obj and 'msg' in obj:
         return messaging.Message(obj['msg_type'], obj['msg'])
+    elif 'block' in obj and 'hash' in obj:
+        return block.LazyBlock(obj['block'], obj['hash'], obj.get('predecessor'))
     elif 'blocktype' in obj and 'signature' in obj:
-        return block.Block(block.BlockType[obj['blocktype']], obj['predecessor'], obj['message'], obj['signature'], obj['signatory_hash'])
+        return block.Block(block.BlockType[obj['blocktype']], obj['predecessor'], obj['message'], obj['signature'],
+                           obj['signatory_hash'], obj.get('timestamp'))
     return obj
 
 
@@ -143,24 +235,22 @@ def reverse_enumerate(L):
       yield index, L[index]
 
 
+@functools.lru_cache(maxsize=settings.COLOR_CACHE_SIZE)
 def hash_color(hash):
-    global _hashes_fg, _hashes_bg
+    """Colorize a hash. The colors are derived from the hash, so it looks the same everywhere and every time it is
+    shown; only the most recently colorized hashes are kept, since mapping to terminal colors is the slow part."""
+    from xtermcolor import colorize
 
-    if hash not in _hashes_fg:
-        _hashes_fg[hash] = rand_fg()
-        _hashes_bg[hash] = rand_bg()
+    return colorize(hash, rgb=hash_fg(hash), bg=hash_bg(hash))
 
-    return colorize(hash, rgb=_hashes_fg[hash], bg=_hashes_bg[hash])
 
+def hash_fg(hash):
+    """A light foreground color derived from a hash"""
+    r, g, b = hashlib.sha256(hash.encode()).digest()[:3]
+    return ((r >> 1) + 0x80 << 16) | ((g >> 1) + 0x80 << 8) | (b >> 1) + 0x80
 
-def rand_fg():
-    r = random.randrange(0,0x7F) + 0x80
-    g = random.randrange(0,0x7F) + 0x80
-    b = random.randrange(0,0x7F) + 0x80
-    return (r << 16) | (g << 8) | b
 
-def rand_bg():
-    r = random.randrange(0,0x7F)
-    g = random.randrange(0,0x7F)
-    b = random.randrange(0,0x7F)
-    return (r << 16) | (g << 8) | b
\ No newline at end of file
+def hash_bg(hash):
+    """A dark background color derived from a hash"""
+    r, g, b = hashlib.sha256(hash.encode()).digest()[3:6]
+    return (r >> 1 << 16) | (g >> 1 << 8) | b >> 1
\ No newline at end of file
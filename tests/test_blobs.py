@@ -0,0 +1,69 @@
+import time
+
+import pytest
+from Crypto.PublicKey import RSA
+
+from privledge import blobs
+from privledge import daemon
+from privledge import messaging
+from privledge import settings
+from privledge import utils
+from privledge.block import Block, BlockType
+from privledge.ledger import Ledger
+
+from test_messaging import free_port
+
+
+@pytest.fixture(autouse=True)
+def init_settings():
+    settings.init()
+
+
+def hosted_ledger(monkeypatch, key, *blob_roots):
+    """Host a ledger whose blob blocks refer to blob_roots"""
+    ledger = Ledger()
+    root = Block(BlockType.key, None, utils.encode_key(key), timestamp=round(time.time(), 3))
+    root.sign(key)
+    ledger.append(root)
+
+    for blob_root in blob_roots:
+        block = Block(BlockType.blob, ledger.tail.hash, blobs.ref(blob_root, 1), timestamp=round(time.time(), 3))
+        block.sign(key)
+        ledger.append(block)
+
+    node = daemon.LedgerNode(ledger, key)
+    monkeypatch.setitem(daemon.nodes, node.id, node)
+    return node
+
+
+def test_chunks_are_served_only_for_the_ledger_referring_to_them(monkeypatch, tmp_path):
+    store = blobs.BlobStore(str(tmp_path), chunk_size=4)
+    monkeypatch.setattr(daemon, '_blob_store', store)
+
+    ours, _ = store.put(b'our document')
+    theirs, _ = store.put(b'their secret')
+    our_chunk, their_chunk = store.manifest(ours)['chunks'][0], store.manifest(theirs)['chunks'][0]
+
+    key = RSA.generate(1024)
+    node = hosted_ledger(monkeypatch, key, ours)
+    hosted_ledger(monkeypatch, RSA.generate(1024), theirs)
+
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port)
+    listener.start()
+
+    def fetch(root, chunk_hash):
+        return messaging.request(('127.0.0.1', port), settings.MSG_TYPE_BLOB,
+                                 {'ledger': node.id, 'root': root, 'hash': chunk_hash}).msg_type
+
+    try:
+        assert fetch(ours, ours) == settings.MSG_TYPE_SUCCESS
+        assert fetch(ours, our_chunk) == settings.MSG_TYPE_SUCCESS
+
+        # Stored here, but only referred to by the other ledger
+        assert fetch(theirs, theirs) == settings.MSG_TYPE_FAILURE
+        assert fetch(theirs, their_chunk) == settings.MSG_TYPE_FAILURE
+        assert fetch(ours, their_chunk) == settings.MSG_TYPE_FAILURE
+    finally:
+        listener.stop.set()
+        listener.join()
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from privledge import settings
+from privledge import utils
+from privledge.block import LazyBlock
+from privledge.ledger import Ledger
+
+
+@pytest.fixture(autouse=True)
+def init_settings():
+    settings.init()
+
+
+def wire_block(raw):
+    """Decode a block as it arrives in a ledger response"""
+    message = json.dumps({'hash': 'a' * 64, 'predecessor': None, 'block': raw})
+    return json.loads(message, object_hook=utils.message_decoder)
+
+
+malformed = [
+    'not json',
+    json.dumps({'blocktype': 'nonsense', 'predecessor': None, 'message': 'x', 'signature': 'y',
+                'signatory_hash': 'z'}),
+    json.dumps({'blocktype': 'key', 'signature': 'y'}),
+    json.dumps(['blocktype', 'signature']),
+    None,
+    42,
+]
+
+
+@pytest.mark.parametrize('raw', malformed)
+def test_malformed_wire_block_is_rejected(raw):
+    block = wire_block(raw)
+    assert isinstance(block, LazyBlock)
+
+    with pytest.raises(ValueError):
+        block.materialize()
+
+    ledger = Ledger()
+    with pytest.raises(ValueError):
+        ledger.append(block)
+    assert ledger.tail is None
@@ -0,0 +1,30 @@
+import json
+from concurrent.futures import Future
+
+import pytest
+
+from privledge import control
+from privledge import daemon
+from privledge import settings
+from privledge.ledger import Ledger
+
+
+@pytest.fixture(autouse=True)
+def init_settings():
+    settings.init()
+
+
+def test_failed_commit_is_answered_with_an_error(monkeypatch):
+    def submit_block(node, blocktype, message):
+        future = Future()
+        future.set_exception(RuntimeError('signing failed'))
+        return future
+
+    monkeypatch.setattr(daemon, 'current', daemon.LedgerNode(Ledger()))
+    monkeypatch.setattr(daemon, 'submit_block', submit_block)
+
+    lines = [json.dumps({'id': i, 'cmd': 'block', 'args': {'message': 'm{}'.format(i)}}) for i in range(2)]
+    responses = [json.loads(line) for line in control.handle_lines(lines)]
+
+    assert [response['id'] for response in responses] == [0, 1]
+    assert all(not response['ok'] and response['error'] == 'signing failed' for response in responses)
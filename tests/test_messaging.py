@@ -0,0 +1,292 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+from Crypto.PublicKey import RSA
+
+from privledge import daemon
+from privledge import messaging
+from privledge import peers
+from privledge import settings
+from privledge import utils
+from privledge.block import Block, BlockType
+from privledge.ledger import Ledger
+
+
+@pytest.fixture(autouse=True)
+def init_settings():
+    settings.init()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_response(client):
+    size, data = utils.read_message(client)
+    return json.loads(data, object_hook=utils.message_decoder)
+
+
+def test_rejected_request_sees_busy_reply():
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port, workers=1, queued=0, per_peer=0)
+    request = messaging.Message(settings.MSG_TYPE_LEDGER, {"ledger": "x" * 64, "locator": ["y" * 64] * 64})
+
+    data = request.prep_tcp().encode()
+
+    # The listener turns us away while we are still sending, with part of the request unread. The rest of the
+    # request must still go through and the busy reply arrive, rather than the connection being reset
+    client = socket.create_connection(('127.0.0.1', port), timeout=5)
+    try:
+        client.sendall(data[:len(data) // 2])
+        listener.start()
+        time.sleep(0.2)
+        client.sendall(data[len(data) // 2:])
+
+        message = read_response(client)
+        assert message.msg_type == settings.MSG_TYPE_BUSY
+        assert message.msg["retry_after"] == settings.TCP_RETRY_AFTER
+    finally:
+        client.close()
+        listener.stop.set()
+        listener.join()
+
+
+def test_truncated_request_frees_its_worker():
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port, workers=1, queued=0, per_peer=1)
+    listener.start()
+    try:
+        # A length prefix, part of the message, then the peer hangs up
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as client:
+            client.sendall(utils.append_len('{"msg_type": "peers"' + ' ' * 100)[:50].encode())
+        time.sleep(0.2)
+
+        message = messaging.request(('127.0.0.1', port), settings.MSG_TYPE_PEER, {"ledger": "x" * 64, "since": 0})
+        assert message.msg_type == settings.MSG_TYPE_FAILURE
+    finally:
+        listener.stop.set()
+        listener.join()
+
+
+def test_nodes_sharing_an_ip_each_get_a_share(monkeypatch):
+    node = daemon.LedgerNode(Ledger(), ledger_id='x' * 64)
+    node.add_peer(('127.0.0.1', 1111))
+    node.add_peer(('127.0.0.1', 2222))
+    monkeypatch.setitem(daemon.nodes, node.id, node)
+
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port, workers=4, queued=0, per_peer=1)
+    listener.start()
+    target = ('127.0.0.1', port)
+    held = []
+    try:
+        def hold():
+            # A request that is still being sent keeps its slot
+            client = socket.create_connection(target, timeout=5)
+            client.sendall(b'0100{')
+            held.append(client)
+            time.sleep(0.2)
+
+        hold()
+        assert messaging.request(target, settings.MSG_TYPE_PEER, {"ledger": "y" * 64}).msg_type \
+            == settings.MSG_TYPE_FAILURE
+
+        hold()
+        hold()
+        assert messaging.request(target, settings.MSG_TYPE_PEER, {"ledger": "y" * 64}).msg_type \
+            == settings.MSG_TYPE_BUSY
+    finally:
+        for client in held:
+            client.close()
+        listener.stop.set()
+        listener.join()
+
+
+def test_busy_peer_is_deferred_not_demoted():
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port, workers=1, queued=0, per_peer=0)
+    listener.start()
+    target = ('127.0.0.1', port)
+    try:
+        message = messaging.request(target, settings.MSG_TYPE_PEER, {"ledger": "x" * 64, "since": 0})
+
+        assert message.msg_type == settings.MSG_TYPE_BUSY
+        assert messaging._busy_until[target] > time.time()
+        assert peers.get(target).failures == 0
+    finally:
+        listener.stop.set()
+        listener.join()
+
+
+def test_malformed_datagrams_do_not_stop_the_listener():
+    port = free_port()
+    listener = messaging.UDPListener('127.0.0.1', port)
+    listener.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sender.bind(('127.0.0.1', 0))
+        time.sleep(0.2)     # The listener binds once it runs
+        for datagram in ['{"msg_type": "hback", "msg": {"sent": "x"}}',
+                         '{"msg_type": "hb", "msg": {"ledgers": ["x"], "port": "y", "sent": 1}}',
+                         '{"msg_type": "hb", "msg": {"ledgers": {}, "port": 99999}}',
+                         '{"msg_type": "hb", "msg": "ledgers"}',
+                         '{"unexpected": true}',
+                         'not json']:
+            sender.sendto(datagram.encode(), ('127.0.0.1', port))
+
+        ack = messaging.Message(settings.MSG_TYPE_HB_ACK, {"sent": time.time()}).__repr__()
+        sender.sendto(ack.encode(), ('127.0.0.1', port))
+        time.sleep(0.3)
+
+        assert listener.is_alive()
+        assert peers.get(sender.getsockname()).rtt is not None
+    finally:
+        sender.close()
+        listener.stop.set()
+        listener.join()
+
+
+def test_peer_sending_rejected_blocks_keeps_backing_off(monkeypatch):
+    key, stranger = RSA.generate(1024), RSA.generate(1024)
+    root = Block(BlockType.key, None, utils.encode_key(key), timestamp=round(time.time(), 3))
+    root.sign(key)
+
+    ours, theirs = Ledger(), Ledger()
+    ours.append(root)
+    theirs.append(root)
+
+    # The peer serves a block signed by a key that was never added to the ledger
+    forged = Block(BlockType.text, root.hash, 'forged', timestamp=round(time.time(), 3))
+    forged.sign(stranger)
+    theirs._publish(forged)
+    monkeypatch.setitem(daemon.nodes, root.message_hash, daemon.LedgerNode(theirs, key))
+
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port)
+    listener.start()
+    target = ('127.0.0.1', port)
+    try:
+        node = daemon.LedgerNode(ours)
+        for failures in range(1, 4):
+            assert messaging.block_sync(node, target) is None
+            assert peers.get(target).failures == failures
+        assert len(ours) == 1
+    finally:
+        listener.stop.set()
+        listener.join()
+
+
+def serve_once(response):
+    """Answer one request on a free port with response; returns the address"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def answer():
+        with server:
+            client, _ = server.accept()
+            with client:
+                utils.read_message(client)
+                client.sendall(response.prep_tcp().encode())
+
+    threading.Thread(target=answer, daemon=True).start()
+    return server.getsockname()
+
+
+def signed_block(key, predecessor, message):
+    block = Block(BlockType.text, predecessor, message, timestamp=round(time.time(), 3))
+    block.sign(key)
+    return block
+
+
+@pytest.fixture
+def forked():
+    """Our ledger (root, ours) and a block of another branch from root"""
+    key = RSA.generate(1024)
+    root = Block(BlockType.key, None, utils.encode_key(key), timestamp=round(time.time(), 3))
+    root.sign(key)
+    ledger = Ledger()
+    ledger.append(root)
+    ledger.append(signed_block(key, root.hash, 'ours'))
+    return daemon.LedgerNode(ledger, key), root, signed_block(key, root.hash, 'theirs')
+
+
+def test_branch_from_unknown_ancestor_is_rejected(forked):
+    node, root, theirs = forked
+    orphan = signed_block(node.privkey, 'f' * 64, 'orphan')
+    target = serve_once(messaging.Message(settings.MSG_TYPE_SUCCESS, {"ancestor": 'f' * 64, "blocks": [orphan]}))
+
+    assert messaging.block_sync(node, target) is None
+    assert peers.get(target).failures == 1
+    assert len(node.ledger) == 2
+
+
+def test_fork_without_height_is_judged_on_the_blocks_sent(forked):
+    node, root, theirs = forked
+    ours = node.ledger.tail
+    target = serve_once(messaging.Message(settings.MSG_TYPE_SUCCESS, {"ancestor": root.hash, "blocks": [theirs]}))
+
+    assert messaging.block_sync(node, target) == 2
+    assert peers.get(target).failures == 0
+    # Equal heights: the lower tail hash wins
+    assert node.ledger.tail.hash == min(ours.hash, theirs.hash)
+
+
+def timestamped_ledger(key, start, count):
+    """A ledger of a root and count text blocks timestamped 10 seconds apart from start"""
+    ledger = Ledger()
+    root = Block(BlockType.key, None, utils.encode_key(key), timestamp=start)
+    root.sign(key)
+    ledger.append(root)
+    for i in range(1, count + 1):
+        block = Block(BlockType.text, ledger.tail.hash, 'block {}'.format(i), timestamp=start + 10 * i)
+        block.sign(key)
+        ledger.append(block)
+    return ledger
+
+
+def test_time_range_round_trip(monkeypatch):
+    start = round(time.time()) - 1000
+    key = RSA.generate(1024)
+    ledger = timestamped_ledger(key, start, 8)
+    monkeypatch.setitem(daemon.nodes, ledger.id, daemon.LedgerNode(ledger, key))
+
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port)
+    listener.start()
+    target = ('127.0.0.1', port)
+    try:
+        # The range starts right after the ancestor, and runs on past until by up to the clock skew
+        ancestor, blocks = messaging.fetch_range(target, ledger.id, start + 25, start + 55)
+        assert ancestor == ledger.snapshot()[2].hash
+        assert [block.message for block in blocks if block.timestamp < start + 55] == \
+            ['block 3', 'block 4', 'block 5']
+        assert all(block.validate(utils.encode_key(key)) for block in blocks)
+
+        ancestor, blocks = messaging.fetch_range(target, ledger.id, until=start + 15, limit=1)
+        assert ancestor is None and [block.hash for block in blocks] == [ledger.root.hash]
+
+        assert messaging.fetch_range(target, 'y' * 64, start) is None
+    finally:
+        listener.stop.set()
+        listener.join()
+
+
+@pytest.mark.parametrize('size', [1, 9999, 10000, 250000])
+def test_length_prefix_round_trip(size):
+    message = 'x' * size
+    framed = utils.append_len(message)
+    if size < 10000:
+        # Byte for byte the framing of nodes that only know 4 digit prefixes
+        assert framed == '{:04d}'.format(size) + message
+
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        sender.sendall(framed[:6].encode())
+        sender.sendall(framed[6:14].encode())
+        assert utils.read_len(receiver) == size
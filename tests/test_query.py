@@ -0,0 +1,72 @@
+import json
+import time
+from collections import OrderedDict
+
+import pytest
+from Crypto.PublicKey import RSA
+
+from privledge import daemon
+from privledge import query
+from privledge import settings
+from privledge import utils
+from privledge.block import Block, BlockType
+from privledge.ledger import Ledger
+
+
+@pytest.fixture(autouse=True)
+def init_settings():
+    settings.init()
+
+
+@pytest.fixture
+def key():
+    return RSA.generate(1024)
+
+
+@pytest.fixture
+def node(monkeypatch, key):
+    ledger = Ledger()
+    root = Block(BlockType.key, None, utils.encode_key(key), timestamp=round(time.time(), 3))
+    root.sign(key)
+    ledger.append(root)
+
+    node = daemon.LedgerNode(ledger, key)
+    monkeypatch.setitem(daemon.nodes, node.id, node)
+    monkeypatch.setattr(query, '_cache', OrderedDict())
+    return node
+
+
+def text_block(key, predecessor, message):
+    block = Block(BlockType.text, predecessor, message, timestamp=round(time.time(), 3))
+    block.sign(key)
+    return block
+
+
+def get(node, resource):
+    status, etag, body = query.respond('/ledgers/{}/{}'.format(node.id, resource))
+    return json.loads(body.decode())
+
+
+def test_negative_start_counts_back_from_the_tail(node, key):
+    for i in range(5):
+        node.ledger.append(text_block(key, node.ledger.tail.hash, 'block {}'.format(i)))
+
+    blocks = get(node, 'blocks?start=-3')
+    assert [block['height'] for block in blocks] == [3, 4, 5]
+    assert [block['message'] for block in blocks] == ['block 2', 'block 3', 'block 4']
+
+    assert [block['height'] for block in get(node, 'blocks?start=-100&end=-4')] == [0, 1]
+
+
+def test_cached_block_is_dropped_by_reorganization(node, key):
+    ancestor = node.ledger.tail.hash
+    dropped = text_block(key, ancestor, 'dropped')
+    node.ledger.append(dropped)
+
+    assert get(node, 'blocks/' + dropped.hash)['height'] == 1
+
+    node.ledger.reorganize(ancestor, [text_block(key, ancestor, 'winner 1')])
+    node.ledger.append(text_block(key, node.ledger.tail.hash, 'winner 2'))
+
+    with pytest.raises(query.NotFound):
+        get(node, 'blocks/' + dropped.hash)
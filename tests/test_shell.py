@@ -0,0 +1,47 @@
+import time
+
+import pytest
+from Crypto.PublicKey import RSA
+
+from privledge import daemon
+from privledge import messaging
+from privledge import settings
+from privledge import shell
+from privledge.ledger import Ledger
+
+from test_messaging import free_port, timestamped_ledger
+
+
+@pytest.fixture(autouse=True)
+def init_settings():
+    settings.init()
+
+
+def test_ledger_reads_a_time_range_from_a_member(monkeypatch, capsys):
+    start = round(time.time()) - 1000
+    key = RSA.generate(1024)
+    member = timestamped_ledger(key, start, 8)
+    monkeypatch.setitem(daemon.nodes, member.id, daemon.LedgerNode(member, key))
+
+    # We only have the first three blocks
+    ours = Ledger()
+    for block in member.snapshot()[:3]:
+        ours.append(block)
+    monkeypatch.setattr(daemon, 'current', daemon.LedgerNode(ours))
+
+    port = free_port()
+    listener = messaging.TCPListener('127.0.0.1', port)
+    listener.start()
+    try:
+        shell.PrivledgeShell.do_ledger(None, '--since {} --until {} --from 127.0.0.1:{}'
+                                       .format(start + 25, start + 55, port))
+    finally:
+        listener.stop.set()
+        listener.join()
+
+    output = capsys.readouterr().out
+    assert 'not verified' in output
+    for height in (3, 4, 5):
+        assert 'block {}'.format(height) in output
+        assert '\n{}'.format(height) in output
+    assert 'block 2' not in output and 'block 6' not in output
@@ -0,0 +1,42 @@
+import os
+import time
+
+import pytest
+from Crypto.PublicKey import RSA
+
+from privledge import settings
+from privledge import utils
+from privledge.block import Block, BlockType
+from privledge.ledger import Ledger
+
+
+@pytest.fixture(autouse=True)
+def init_settings():
+    settings.init()
+
+
+def test_ledgers_sharing_a_cold_dir_keep_separate_files(tmp_path):
+    key = RSA.generate(1024)
+    root = Block(BlockType.key, None, utils.encode_key(key), timestamp=round(time.time(), 3))
+    root.sign(key)
+
+    # Two nodes following the same ledger on one host
+    first, second = Ledger(4, str(tmp_path)), Ledger(4, str(tmp_path))
+    for ledger in (first, second):
+        ledger.append(root)
+    for i in range(20):
+        for ledger, name in ((first, 'first'), (second, 'second')):
+            block = Block(BlockType.text, ledger.tail.hash, '{} {}'.format(name, i), timestamp=round(time.time(), 3))
+            block.sign(key)
+            ledger.append(block)
+
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert first.snapshot()[3].message == 'first 2'
+    assert second.snapshot()[3].message == 'second 2'
+
+    first.close()
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert second.snapshot()[3].message == 'second 2'
+    assert second.snapshot().position(second.snapshot()[5].hash) == 5
+    second.close()
+    assert os.listdir(str(tmp_path)) == []